@@ -12,7 +12,7 @@
 import os
 
 from pydantic import BaseModel
-from typing import Dict, Annotated, List
+from typing import Dict, Annotated, List, Literal
 
 from fastapi.responses import JSONResponse
 from fastapi.encoders import jsonable_encoder
@@ -59,6 +59,8 @@ class answerDataQuestionRequest(BaseModel):
     vector_search_sample_data_k: int = 3
     disclaimer: bool = True
     verbose: bool = True
+    speculative_vql: bool = os.getenv('SPECULATIVE_VQL', '0') == '1'
+    result_format: Literal["rows", "columnar", "arrow"] = os.getenv('EXECUTION_RESULT_FORMAT', 'rows')
 
 class answerDataQuestionResponse(BaseModel):
     answer: str
@@ -73,6 +75,7 @@ class answerDataQuestionResponse(BaseModel):
     vector_store_search_time: float
     llm_time: float
     total_execution_time: float
+    result_handle: str = ''
 
 @router.get(
         '/answerDataQuestion',
@@ -144,7 +147,7 @@ async def process_data_question(request_data: answerDataQuestionRequest, auth: s
     # Generate session ID for Langfuse debugging purposes
     session_id = generate_session_id(request_data.question)
 
-    vector_search_tables, sample_data, timings = await sdk_ai_tools.get_relevant_tables(
+    vector_search_tables, sample_data, timings, question_context = await sdk_ai_tools.get_relevant_tables(
         query=request_data.question,
         embeddings_provider=request_data.embeddings_provider,
         embeddings_model=request_data.embeddings_model,
@@ -158,17 +161,33 @@ async def process_data_question(request_data: answerDataQuestionRequest, auth: s
         vector_search_sample_data_k=request_data.vector_search_sample_data_k
     )
 
-    with timing_context("llm_time", timings):
-        category, category_response, category_related_questions, sql_category_tokens = await sdk_ai_tools.sql_category(
-            query=request_data.question, 
-            vector_search_tables=vector_search_tables, 
-            llm_provider=request_data.chat_provider,
-            llm_model=request_data.chat_model,
-            mode="data",
-            custom_instructions=request_data.custom_instructions,
-            session_id=session_id
+    # Speculatively generate the VQL while the question is categorized
+    speculative_vql_task = None
+    if request_data.speculative_vql:
+        speculative_vql_task = sdk_answer_question.start_speculative_vql(
+            request=request_data,
+            vector_search_tables=vector_search_tables,
+            session_id=session_id,
+            sample_data=sample_data,
+            auth=auth
         )
 
+    # The speculative generation is cancelled if the question can't be categorized
+    try:
+        with timing_context("llm_time", timings):
+            category, category_response, category_related_questions, sql_category_tokens = await sdk_ai_tools.sql_category(
+                query=request_data.question, 
+                vector_search_tables=vector_search_tables, 
+                llm_provider=request_data.chat_provider,
+                llm_model=request_data.chat_model,
+                mode="data",
+                custom_instructions=request_data.custom_instructions,
+                session_id=session_id
+            )
+    except BaseException:
+        sdk_answer_question.discard_speculative_vql(speculative_vql_task)
+        raise
+
     response = await sdk_answer_question.process_sql_category(
         request=request_data, 
         vector_search_tables=vector_search_tables, 
@@ -176,7 +195,10 @@ async def process_data_question(request_data: answerDataQuestionRequest, auth: s
         auth=auth, 
         timings=timings,
         session_id=session_id,
-        sample_data=sample_data
+        sample_data=sample_data,
+        question_context=question_context,
+        speculative_vql_task=speculative_vql_task,
+        result_format=request_data.result_format
     )
 
     response['tokens'] = add_tokens(response['tokens'], sql_category_tokens)
@@ -9,12 +9,14 @@
  of the license agreement you entered into with DENODO.
 """
 import os
+import json
 import logging
+import itertools
 
-from pydantic import BaseModel
-from typing import Dict, List, Annotated
+from pydantic import BaseModel, Field
+from typing import Dict, List, Annotated, Literal
 
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.encoders import jsonable_encoder
 from fastapi import APIRouter, Depends, HTTPException, Query
 from fastapi.security import HTTPBasic, HTTPBearer, HTTPBasicCredentials, HTTPAuthorizationCredentials
@@ -24,6 +26,9 @@ from utils.data_catalog import get_views_metadata_documents
 from utils.utils import calculate_tokens, schema_summary, prepare_schema, flatten_list, prepare_sample_data_schema
 from api.utils.sdk_utils import handle_endpoint_error
 
+# Views tokenized to estimate the tokens of a whole schema for the logs
+SCHEMA_TOKENS_SAMPLE_SIZE = 20
+
 router = APIRouter()
 security_basic = HTTPBasic(auto_error = False)
 security_bearer = HTTPBearer(auto_error = False)
@@ -39,6 +44,15 @@ def authenticate(
     else:
         raise HTTPException(status_code=401, detail="Authentication required")
 
+def log_schema_tokens(description, db_schema):
+    """Logs the tokens of a schema, extrapolated from a sample of its views instead of tokenizing all of it."""
+    tables = db_schema.get('databaseTables', [])
+    if not tables or not logging.getLogger().isEnabledFor(logging.INFO):
+        return
+    sample = tables[::max(len(tables) // SCHEMA_TOKENS_SAMPLE_SIZE, 1)][:SCHEMA_TOKENS_SAMPLE_SIZE]
+    tokens = sum(calculate_tokens(str(table)) for table in sample) * len(tables) // len(sample)
+    logging.info(f"{description} has ~{tokens} tokens ({len(tables)} views).")
+
 def process_tag(tag_name, request, auth, vector_store, sample_data_vector_store):
     if vector_store:
         last_update = vector_store.get_last_update()
@@ -62,8 +76,7 @@ def process_tag(tag_name, request, auth, vector_store, sample_data_vector_store)
     
     if isinstance(result, dict):
         db_schema = result
-        logging.info(f"Tag schema for {tag_name} has {calculate_tokens(str(db_schema))} tokens.")
-        db_schema_text = [schema_summary(table) for table in db_schema['databaseTables']]
+        log_schema_tokens(f"Tag schema for {tag_name}", db_schema)
         
         if vector_store:
             views = flatten_list(prepare_schema(db_schema, request.embeddings_token_limit))
@@ -78,7 +91,7 @@ def process_tag(tag_name, request, auth, vector_store, sample_data_vector_store)
                 views=views,
                 parallel=request.parallel
             )
-        return db_schema, db_schema_text
+        return db_schema
 
 def process_database(db_name, request, auth, vector_store, sample_data_vector_store):
     if vector_store:
@@ -103,8 +116,7 @@ def process_database(db_name, request, auth, vector_store, sample_data_vector_st
     
     if isinstance(result, dict):
         db_schema = result
-        logging.info(f"Database schema for {db_name} has {calculate_tokens(str(db_schema))} tokens.")
-        db_schema_text = [schema_summary(table) for table in db_schema['databaseTables']]
+        log_schema_tokens(f"Database schema for {db_name}", db_schema)
         
         if vector_store:
             views = flatten_list(prepare_schema(db_schema, request.embeddings_token_limit))
@@ -119,7 +131,7 @@ def process_database(db_name, request, auth, vector_store, sample_data_vector_st
                 views=views,
                 parallel=request.parallel
             )        
-        return db_schema, db_schema_text
+        return db_schema
 
 class getMetadataRequest(BaseModel):
     vdp_database_names: str = os.getenv('VDB_NAMES', '')
@@ -137,6 +149,7 @@ class getMetadataRequest(BaseModel):
     view_suffix_filter: str = ''
     insert: bool = True
     parallel: bool = True
+    response_mode: Literal["full", "summary", "ndjson"] = Field(default = "full")
 
 class TableSummary(BaseModel):
     summary: str
@@ -158,6 +171,9 @@ def getMetadata(endpoint_request: getMetadataRequest = Depends(), auth: str = De
 
     You can use the view_prefix_filter and view_suffix_filter parameters to filter the views that are inserted into the vector store.
     For example, if you set view_prefix_filter to "vdp_", only views that start with "vdp_" will be inserted into the vector store.
+
+    For large catalogs, set response_mode to "summary" to only return the number of views and their ids per database or tag,
+    or to "ndjson" to stream one JSON line per view (with its database or tag, definition and summary) as each database or tag is processed.
     """
     vdp_database_names = [db.strip() for db in endpoint_request.vdp_database_names.split(',') if db]
     vdp_tag_names = [tag.strip() for tag in endpoint_request.vdp_tag_names.split(',') if tag]
@@ -165,9 +181,6 @@ def getMetadata(endpoint_request: getMetadataRequest = Depends(), auth: str = De
     if not vdp_database_names and not vdp_tag_names:
         raise HTTPException(status_code=400, detail="At least one database or tag must be provided")
 
-    all_db_schemas = []
-    all_db_schema_texts = []
-
     vector_store = None
     sample_data_vector_store = None
 
@@ -188,45 +201,93 @@ def getMetadata(endpoint_request: getMetadataRequest = Depends(), auth: str = De
                 index_name="ai_sdk_sample_data"
             )
     
+    schemas = process_schemas(
+        vdp_tag_names=vdp_tag_names,
+        vdp_database_names=vdp_database_names,
+        request=endpoint_request,
+        auth=auth,
+        vector_store=vector_store,
+        sample_data_vector_store=sample_data_vector_store
+    )
+
+    if endpoint_request.response_mode == "ndjson":
+        # The first database or tag is processed before the response starts, so its errors
+        # and an empty catalog get the same status codes as in the other modes
+        first_schema = next(schemas, None)
+        if first_schema is None:
+            raise HTTPException(status_code=204, detail=f"Data Catalog returned empty response for: {vdp_database_names}")
+
+        # The rest are requested, inserted and streamed one at a time. Their errors can't change the status code
+        # anymore, so they end the stream with an error line
+        def stream_views():
+            try:
+                for source_type, source_name, db_schema in itertools.chain([first_schema], schemas):
+                    for table in db_schema['databaseTables']:
+                        yield json.dumps({source_type: source_name, "view": table, "summary": schema_summary(table)}, default = str) + "\n"
+            except Exception as e:
+                logging.error(f"Error in getMetadata stream: {str(e)}")
+                yield json.dumps({"error": str(e)}) + "\n"
+
+        return StreamingResponse(stream_views(), media_type = "application/x-ndjson")
+
+    all_db_schemas = []
+    all_db_schema_texts = []
+    all_summaries = []
+    for source_type, source_name, db_schema in schemas:
+        if endpoint_request.response_mode == "summary":
+            all_summaries.append({
+                source_type: source_name,
+                'view_count': len(db_schema['databaseTables']),
+                'view_ids': [str(table.get('id')) for table in db_schema['databaseTables']]
+            })
+        else:
+            all_db_schemas.append(db_schema)
+            all_db_schema_texts.extend(schema_summary(table) for table in db_schema['databaseTables'])
+
+    if len(all_db_schemas) == 0 and len(all_summaries) == 0:
+        raise HTTPException(status_code=204, detail=f"Data Catalog returned empty response for: {vdp_database_names}")
+
+    if endpoint_request.response_mode == "summary":
+        response = {
+            'schemas': all_summaries,
+            'view_count': sum(summary['view_count'] for summary in all_summaries),
+            'vdb_list': vdp_database_names
+        }
+    else:
+        response = {
+            'db_schema_json': all_db_schemas,
+            'db_schema_text': all_db_schema_texts,
+            'vdb_list': vdp_database_names
+        }
+
+    return JSONResponse(content = jsonable_encoder(response), media_type = "application/json")
+
+def process_schemas(vdp_tag_names, vdp_database_names, request, auth, vector_store, sample_data_vector_store):
+    """Yields the source type ('tag' or 'database'), name and schema of each tag and database, as they are processed."""
     for tag_name in vdp_tag_names:
         try:
-            db_schema, db_schema_text = process_tag(
+            db_schema = process_tag(
                 tag_name=tag_name,
-                request=endpoint_request,
+                request=request,
                 auth=auth,
                 vector_store=vector_store,
                 sample_data_vector_store=sample_data_vector_store,
             )
-            
-            all_db_schemas.append(db_schema)
-            all_db_schema_texts.extend(db_schema_text)
         except ValueError as ve:
             logging.error(f"Error processing tag: {ve}")
             continue
+        yield 'tag', tag_name, db_schema
 
     for db_name in vdp_database_names:
         try:
-            db_schema, db_schema_text = process_database(
+            db_schema = process_database(
                 db_name=db_name, 
-                request=endpoint_request, 
+                request=request, 
                 auth=auth,
                 vector_store=vector_store,
                 sample_data_vector_store=sample_data_vector_store
             )
-            
-            all_db_schemas.append(db_schema)
-            all_db_schema_texts.extend(db_schema_text)
         except ValueError as ve:
             logging.error(f"Error processing database: {ve}")
             continue
-
-    if len(all_db_schemas) == 0:
-        raise HTTPException(status_code=204, detail=f"Data Catalog returned empty response for: {vdp_database_names}")
-
-    response = {
-        'db_schema_json': all_db_schemas,
-        'db_schema_text': all_db_schema_texts,
-        'vdb_list': vdp_database_names
-    }
-
-    return JSONResponse(content = jsonable_encoder(response), media_type = "application/json")
\ No newline at end of file
+        yield 'database', db_name, db_schema
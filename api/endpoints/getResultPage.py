@@ -0,0 +1,115 @@
+"""
+ Copyright (c) 2024. DENODO Technologies.
+ http://www.denodo.com
+ All rights reserved.
+
+ This software is the confidential and proprietary information of DENODO
+ Technologies ("Confidential Information"). You shall not disclose such
+ Confidential Information and shall use it only in accordance with the terms
+ of the license agreement you entered into with DENODO.
+"""
+
+import io
+import os
+import csv
+import json
+import asyncio
+
+from pydantic import BaseModel, Field
+from typing import Annotated, Literal, Optional
+
+from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.security import HTTPBasic, HTTPBasicCredentials, HTTPAuthorizationCredentials, HTTPBearer
+
+from utils.data_catalog import execute_vql
+from utils.resultHandles import get_result_handles, page_vql
+from api.utils.sdk_utils import handle_endpoint_error
+
+RESULT_PAGE_MAX_SIZE = int(os.getenv('RESULT_PAGE_MAX_SIZE', 1000))
+
+router = APIRouter()
+security_basic = HTTPBasic(auto_error = False)
+security_bearer = HTTPBearer(auto_error = False)
+
+def authenticate(
+        basic_credentials: Annotated[HTTPBasicCredentials, Depends(security_basic)],
+        bearer_credentials: Annotated[HTTPAuthorizationCredentials, Depends(security_bearer)]
+        ):
+    if bearer_credentials is not None:
+        return bearer_credentials.credentials
+    elif basic_credentials is not None:
+        return (basic_credentials.username, basic_credentials.password)
+    else:
+        raise HTTPException(status_code=401, detail="Authentication required")
+
+class getResultPageRequest(BaseModel):
+    result_handle: str
+    offset: Optional[int] = None
+    page_size: int = 100
+    format: Literal["ndjson", "csv"] = Field(default = "ndjson")
+
+def format_rows(columns, rows, format):
+    if format == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        yield buffer.getvalue()
+        for row in rows:
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerow(row)
+            yield buffer.getvalue()
+    else:
+        for row in rows:
+            yield json.dumps(dict(zip(columns, row)), default = str) + "\n"
+
+@router.get(
+        '/getResultPage',
+        response_class = StreamingResponse,
+        tags = ['Ask a Question']
+)
+@handle_endpoint_error("getResultPage")
+async def getResultPage(endpoint_request: getResultPageRequest = Depends(), auth: str = Depends(authenticate)):
+    """
+    This endpoint returns the next rows of an answer's execution result, beyond the rows included in the answer.
+    It executes again the VQL of the answer, without calling the LLM, with the same credentials used to ask the question.
+
+    The answer endpoints return a result_handle when the execution result was cut at the row limit (only with RESULT_HANDLES = 1)
+    and the VQL has an ORDER BY, so every page is filtered in VDP and the row order is the same across executions.
+    Each call returns page_size rows, as NDJSON (one JSON object per row) or CSV, starting where the previous call ended
+    unless an offset is given. The X-Next-Offset and X-Has-More headers tell where the next page starts and if there is one.
+    """
+    result_handles = get_result_handles()
+    if result_handles is None:
+        raise HTTPException(status_code=404, detail="Result handles are not enabled")
+
+    handle = await asyncio.to_thread(result_handles.get, endpoint_request.result_handle, auth)
+    if handle is None:
+        raise HTTPException(status_code=404, detail="Result handle not found or expired")
+
+    offset = handle['next_offset'] if endpoint_request.offset is None else max(endpoint_request.offset, 0)
+    page_size = min(max(endpoint_request.page_size, 1), RESULT_PAGE_MAX_SIZE)
+
+    # One row more than the page, to know if there's another page
+    vql = page_vql(handle['vql'], offset, page_size + 1)
+    if vql is None:
+        raise HTTPException(status_code=422, detail="The result of this VQL can't be paged")
+    # A single row with a 0 or null is a row of the page, not an empty result
+    status_code, result = await execute_vql(vql = vql, auth = auth, limit = page_size + 1, result_format = 'columnar', zero_result_check = False)
+    if status_code == 200:
+        columns, rows = result['columns'], list(zip(*result['data']))
+    elif status_code == 499:
+        columns, rows = [], []
+    else:
+        raise HTTPException(status_code=status_code, detail=result)
+
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    await asyncio.to_thread(result_handles.advance, endpoint_request.result_handle, offset + len(rows))
+
+    return StreamingResponse(
+        format_rows(columns, rows, endpoint_request.format),
+        media_type = "text/csv" if endpoint_request.format == "csv" else "application/x-ndjson",
+        headers = {"X-Next-Offset": str(offset + len(rows)), "X-Has-More": str(has_more).lower()}
+    )
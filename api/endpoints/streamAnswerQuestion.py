@@ -20,7 +20,7 @@ from fastapi.security import HTTPBasic, HTTPBasicCredentials, HTTPAuthorizationC
 
 from api.utils import sdk_ai_tools
 from api.utils import sdk_answer_question
-from api.utils.sdk_utils import timing_context, handle_endpoint_error
+from api.utils.sdk_utils import timing_context, add_tokens, handle_endpoint_error
 
 router = APIRouter()
 security_basic = HTTPBasic(auto_error = False)
@@ -55,9 +55,12 @@ class streamAnswerQuestionRequest(BaseModel):
     custom_instructions: str = os.getenv('CUSTOM_INSTRUCTIONS', '')
     markdown_response: bool = True
     vector_search_k: int = 5
+    vector_search_sample_data_k: int = 3
     mode: Literal["default", "data", "metadata"] = Field(default = "default")
     disclaimer: bool = True
     verbose: bool = True
+    speculative_vql: bool = os.getenv('SPECULATIVE_VQL', '0') == '1'
+    stream_format: Literal["text", "events"] = Field(default = "text")
 
 @router.get(
         '/streamAnswerQuestion',
@@ -74,7 +77,18 @@ async def stream_answer_question_get(request: streamAnswerQuestionRequest = Depe
     - Executes the VQL query and gets the data
     - Streams back an answer to the question using the data and the VQL query
 
-    For now, this endpoint only streams back the answer and doesn't return the JSON response like answerQuestion does.
+    The answer is streamed as the LLM generates it. By default (stream_format = "text"), this endpoint only streams back the answer and doesn't return the JSON response like answerQuestion does.
+
+    With stream_format = "events", the response is a text/event-stream with one event per stage, sent as soon as the stage completes:
+
+    - tables: the views found by the vector search
+    - category: the category of the question
+    - vql: the generated VQL query and its explanation
+    - execution_result: the final VQL query, its status code and the data (or the error)
+    - answer: a chunk of the answer
+    - related_questions: the related questions
+    - done: the rest of the answerQuestion response (tokens, timings...)
+    - error: sent instead of done if the question can't be processed
 
     This endpoint will also automatically look for the the following values in the environment variables for convenience:
 
@@ -105,7 +119,18 @@ async def stream_answer_question_post(endpoint_request: streamAnswerQuestionRequ
     - Executes the VQL query and gets the data
     - Streams back an answer to the question using the data and the VQL query
 
-    For now, this endpoint only streams back the answer and doesn't return the JSON response like answerQuestion does.
+    The answer is streamed as the LLM generates it. By default (stream_format = "text"), this endpoint only streams back the answer and doesn't return the JSON response like answerQuestion does.
+
+    With stream_format = "events", the response is a text/event-stream with one event per stage, sent as soon as the stage completes:
+
+    - tables: the views found by the vector search
+    - category: the category of the question
+    - vql: the generated VQL query and its explanation
+    - execution_result: the final VQL query, its status code and the data (or the error)
+    - answer: a chunk of the answer
+    - related_questions: the related questions
+    - done: the rest of the answerQuestion response (tokens, timings...)
+    - error: sent instead of done if the question can't be processed
 
     This endpoint will also automatically look for the the following values in the environment variables for convenience:
 
@@ -124,7 +149,12 @@ async def stream_answer_question_post(endpoint_request: streamAnswerQuestionRequ
 
 async def process_stream_question(request_data: streamAnswerQuestionRequest, auth: str):
     """Main function to process the question and stream the answer"""
-    vector_search_tables, sample_data, timings = await sdk_ai_tools.get_relevant_tables(
+    if request_data.stream_format == "events":
+        async def pipeline(emit):
+            await process_stream_question_events(request_data, auth, emit)
+        return StreamingResponse(sdk_answer_question.sse_event_stream(pipeline), media_type = 'text/event-stream')
+
+    vector_search_tables, sample_data, timings, question_context = await sdk_ai_tools.get_relevant_tables(
         query=request_data.question,
         embeddings_provider=request_data.embeddings_provider,
         embeddings_model=request_data.embeddings_model,
@@ -138,16 +168,34 @@ async def process_stream_question(request_data: streamAnswerQuestionRequest, aut
         vector_search_sample_data_k=request_data.vector_search_sample_data_k
     )
 
-    with timing_context("llm_time", timings):
-        category, category_response, category_related_questions, _ = await sdk_ai_tools.sql_category(
-            query=request_data.question, 
-            vector_search_tables=vector_search_tables, 
-            llm_provider=request_data.chat_provider,
-            llm_model=request_data.chat_model,
-            mode=request_data.mode,
-            custom_instructions=request_data.custom_instructions
+    # Speculatively generate the VQL while the question is categorized
+    speculative_vql_task = None
+    if request_data.speculative_vql and request_data.mode != "metadata":
+        speculative_vql_task = sdk_answer_question.start_speculative_vql(
+            request=request_data,
+            vector_search_tables=vector_search_tables,
+            sample_data=sample_data,
+            auth=auth
         )
 
+    # The speculative generation is cancelled if the question can't be categorized
+    try:
+        with timing_context("llm_time", timings):
+            category, category_response, category_related_questions, category_tokens = await sdk_ai_tools.sql_category(
+                query=request_data.question, 
+                vector_search_tables=vector_search_tables, 
+                llm_provider=request_data.chat_provider,
+                llm_model=request_data.chat_model,
+                mode=request_data.mode,
+                custom_instructions=request_data.custom_instructions
+            )
+    except BaseException:
+        sdk_answer_question.discard_speculative_vql(speculative_vql_task)
+        raise
+
+    if category != "SQL":
+        sdk_answer_question.discard_speculative_vql(speculative_vql_task)
+
     if category == "SQL":
         response = await sdk_answer_question.process_sql_category(
             request=request_data, 
@@ -155,18 +203,127 @@ async def process_stream_question(request_data: streamAnswerQuestionRequest, aut
             category_response=category_response,
             auth=auth, 
             timings=timings,
-            sample_data=sample_data
+            sample_data=sample_data,
+            question_context=question_context,
+            speculative_vql_task=speculative_vql_task,
+            stream_answer=True
         )
     elif category == "METADATA":
-        response = await sdk_answer_question.process_metadata_category(
+        response = sdk_answer_question.process_metadata_category(
             category_response=category_response, 
             category_related_questions=category_related_questions, 
             vector_search_tables=vector_search_tables, 
+            disclaimer=request_data.disclaimer,
+            tokens=category_tokens,
             timings=timings,
         )
     else:
         response = sdk_answer_question.process_unknown_category(timings=timings)
 
-    def generator():
-        yield from response.get('answer', 'Error processing the question.')
-    return StreamingResponse(generator(), media_type = 'text/plain')
\ No newline at end of file
+    async def generator():
+        if category == "SQL" and request_data.verbose:
+            async for text in sdk_ai_tools.stream_view_answer(
+                query=request_data.question,
+                vql_query=response['sql_query'],
+                vql_execution_result=response['llm_execution_result'],
+                llm_provider=request_data.chat_provider,
+                llm_model=request_data.chat_model,
+                vector_search_tables=vector_search_tables,
+                markdown_response=request_data.markdown_response,
+                custom_instructions=request_data.custom_instructions
+            ):
+                yield text
+            if request_data.disclaimer:
+                yield sdk_answer_question.DISCLAIMER
+        else:
+            yield response.get('answer', 'Error processing the question.')
+    return StreamingResponse(generator(), media_type = 'text/plain')
+
+async def process_stream_question_events(request_data: streamAnswerQuestionRequest, auth: str, emit):
+    """Processes the question, emitting an event as each stage completes"""
+    vector_search_tables, sample_data, timings, question_context = await sdk_ai_tools.get_relevant_tables(
+        query=request_data.question,
+        embeddings_provider=request_data.embeddings_provider,
+        embeddings_model=request_data.embeddings_model,
+        vector_store_provider=request_data.vector_store_provider,
+        vdb_list=request_data.vdp_database_names,
+        tag_list=request_data.vdp_tag_names,
+        auth=auth,
+        k=request_data.vector_search_k,
+        use_views=request_data.use_views,
+        expand_set_views=request_data.expand_set_views,
+        vector_search_sample_data_k=request_data.vector_search_sample_data_k
+    )
+    await emit("tables", {"tables": [table['view_name'] for table in vector_search_tables]})
+
+    speculative_vql_task = None
+    if request_data.speculative_vql and request_data.mode != "metadata":
+        speculative_vql_task = sdk_answer_question.start_speculative_vql(
+            request=request_data,
+            vector_search_tables=vector_search_tables,
+            sample_data=sample_data,
+            auth=auth
+        )
+
+    # The speculative generation is cancelled if the question can't be categorized
+    try:
+        with timing_context("llm_time", timings):
+            category, category_response, category_related_questions, category_tokens = await sdk_ai_tools.sql_category(
+                query=request_data.question, 
+                vector_search_tables=vector_search_tables, 
+                llm_provider=request_data.chat_provider,
+                llm_model=request_data.chat_model,
+                mode=request_data.mode,
+                custom_instructions=request_data.custom_instructions
+            )
+        await emit("category", {"category": category})
+    except BaseException:
+        sdk_answer_question.discard_speculative_vql(speculative_vql_task)
+        raise
+
+    if category != "SQL":
+        sdk_answer_question.discard_speculative_vql(speculative_vql_task)
+
+    if category == "SQL":
+        response = await sdk_answer_question.process_sql_category(
+            request=request_data, 
+            vector_search_tables=vector_search_tables, 
+            category_response=category_response,
+            auth=auth, 
+            timings=timings,
+            sample_data=sample_data,
+            question_context=question_context,
+            speculative_vql_task=speculative_vql_task,
+            stream_answer=True,
+            on_event=emit
+        )
+        response['tokens'] = add_tokens(response['tokens'], category_tokens)
+        if request_data.verbose:
+            response = await sdk_answer_question.stream_answer_events(
+                request=request_data,
+                response=response,
+                vector_search_tables=vector_search_tables,
+                timings=timings,
+                emit=emit,
+                sample_data=sample_data
+            )
+        response.pop('llm_execution_result', None)
+        response.pop('execution_result', None)
+    else:
+        if category == "METADATA":
+            response = sdk_answer_question.process_metadata_category(
+                category_response=category_response, 
+                category_related_questions=category_related_questions, 
+                vector_search_tables=vector_search_tables, 
+                disclaimer=request_data.disclaimer,
+                tokens=category_tokens,
+                timings=timings,
+            )
+        else:
+            response = sdk_answer_question.process_unknown_category(timings=timings)
+        await emit("answer", {"text": response.get('answer', '')})
+        await emit("related_questions", {"related_questions": response.get('related_questions', [])})
+
+    response.pop('answer', None)
+    response.pop('related_questions', None)
+    await emit("done", response)
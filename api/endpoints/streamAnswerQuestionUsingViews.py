@@ -20,7 +20,7 @@ from fastapi.security import HTTPBasic, HTTPBasicCredentials, HTTPAuthorizationC
 
 from api.utils import sdk_ai_tools
 from api.utils import sdk_answer_question
-from api.utils.sdk_utils import timing_context, handle_endpoint_error
+from api.utils.sdk_utils import timing_context, add_tokens, handle_endpoint_error
 
 router = APIRouter()
 security_basic = HTTPBasic(auto_error = False)
@@ -55,6 +55,7 @@ class streamAnswerQuestionUsingViewsRequest(BaseModel):
     mode: Literal["default", "data", "metadata"] = Field(default = "default")
     disclaimer: bool = True
     verbose: bool = True
+    stream_format: Literal["text", "events"] = Field(default = "text")
 
 @router.post(
         '/streamAnswerQuestionUsingViews',
@@ -70,6 +71,9 @@ async def streamAnswerQuestionUsingViews(endpoint_request: streamAnswerQuestionU
 
     This is useful for implementations with custom vector stores.
 
+    Like in `streamAnswerQuestion`, stream_format = "events" returns a text/event-stream with one event per stage
+    (tables, category, vql, execution_result, answer, related_questions and done, or error).
+
     This endpoint will also automatically look for the the following values in the environment variables for convenience:
 
     - EMBEDDINGS_PROVIDER
@@ -83,6 +87,11 @@ async def streamAnswerQuestionUsingViews(endpoint_request: streamAnswerQuestionU
     As you can see, you can specify a different provider for SQL generation and chat generation. This is because generating a correct SQL query
     is a complex task that should be handled with a powerful LLM."""
 
+    if endpoint_request.stream_format == "events":
+        async def pipeline(emit):
+            await process_stream_question_events(endpoint_request, auth, emit)
+        return StreamingResponse(sdk_answer_question.sse_event_stream(pipeline), media_type = 'text/event-stream')
+
     timings = {}
     with timing_context("llm_time", timings):
         category, category_response, category_related_questions, sql_category_tokens = await sdk_ai_tools.sql_category(
@@ -101,17 +110,91 @@ async def streamAnswerQuestionUsingViews(endpoint_request: streamAnswerQuestionU
             category_response=category_response,
             auth=auth, 
             timings=timings,
+            stream_answer=True
         )
     elif category == "METADATA":
-        response = await sdk_answer_question.process_metadata_category(
+        response = sdk_answer_question.process_metadata_category(
             category_response=category_response, 
             category_related_questions=category_related_questions, 
             vector_search_tables=endpoint_request.vector_search_tables, 
+            disclaimer=endpoint_request.disclaimer,
+            tokens=sql_category_tokens,
             timings=timings,
         )
     else:
         response = sdk_answer_question.process_unknown_category(timings=timings)
 
-    def generator():
-        yield from response.get('answer', 'Error processing the question.')
-    return StreamingResponse(generator(), media_type = 'text/plain')
\ No newline at end of file
+    async def generator():
+        if category == "SQL" and endpoint_request.verbose:
+            async for text in sdk_ai_tools.stream_view_answer(
+                query=endpoint_request.question,
+                vql_query=response['sql_query'],
+                vql_execution_result=response['llm_execution_result'],
+                llm_provider=endpoint_request.chat_provider,
+                llm_model=endpoint_request.chat_model,
+                vector_search_tables=endpoint_request.vector_search_tables,
+                markdown_response=endpoint_request.markdown_response,
+                custom_instructions=endpoint_request.custom_instructions
+            ):
+                yield text
+            if endpoint_request.disclaimer:
+                yield sdk_answer_question.DISCLAIMER
+        else:
+            yield response.get('answer', 'Error processing the question.')
+    return StreamingResponse(generator(), media_type = 'text/plain')
+
+async def process_stream_question_events(endpoint_request: streamAnswerQuestionUsingViewsRequest, auth: str, emit):
+    """Processes the question, emitting an event as each stage completes"""
+    timings = {}
+    await emit("tables", {"tables": endpoint_request.vector_search_tables})
+
+    with timing_context("llm_time", timings):
+        category, category_response, category_related_questions, sql_category_tokens = await sdk_ai_tools.sql_category(
+            query=endpoint_request.question, 
+            vector_search_tables=endpoint_request.vector_search_tables, 
+            llm_provider=endpoint_request.chat_provider,
+            llm_model=endpoint_request.chat_model,
+            mode=endpoint_request.mode,
+            custom_instructions=endpoint_request.custom_instructions
+        )
+    await emit("category", {"category": category})
+
+    if category == "SQL":
+        response = await sdk_answer_question.process_sql_category(
+            request=endpoint_request, 
+            vector_search_tables=endpoint_request.vector_search_tables, 
+            category_response=category_response,
+            auth=auth, 
+            timings=timings,
+            stream_answer=True,
+            on_event=emit
+        )
+        response['tokens'] = add_tokens(response['tokens'], sql_category_tokens)
+        if endpoint_request.verbose:
+            response = await sdk_answer_question.stream_answer_events(
+                request=endpoint_request,
+                response=response,
+                vector_search_tables=endpoint_request.vector_search_tables,
+                timings=timings,
+                emit=emit
+            )
+        response.pop('llm_execution_result', None)
+        response.pop('execution_result', None)
+    else:
+        if category == "METADATA":
+            response = sdk_answer_question.process_metadata_category(
+                category_response=category_response, 
+                category_related_questions=category_related_questions, 
+                vector_search_tables=endpoint_request.vector_search_tables, 
+                disclaimer=endpoint_request.disclaimer,
+                tokens=sql_category_tokens,
+                timings=timings,
+            )
+        else:
+            response = sdk_answer_question.process_unknown_category(timings=timings)
+        await emit("answer", {"text": response.get('answer', '')})
+        await emit("related_questions", {"related_questions": response.get('related_questions', [])})
+
+    response.pop('answer', None)
+    response.pop('related_questions', None)
+    await emit("done", response)
@@ -12,6 +12,7 @@ from fastapi.middleware.cors import CORSMiddleware
 
 from api.utils import sdk_config_loader
 from api.utils.sdk_utils import check_env_variables, test_data_catalog_connection, configure_uvicorn_logging
+from utils.vqlRewriter import get_rewrite_counts
 from api.endpoints import (
     getMetadata,
     similaritySearch,
@@ -20,7 +21,8 @@ from api.endpoints import (
     answerQuestion,
     answerQuestionUsingViews,
     answerDataQuestion,
-    answerMetadataQuestion
+    answerMetadataQuestion,
+    getResultPage
 )
 
 required_vars = [
@@ -154,9 +156,10 @@ async def swagger_ui_html():
 async def health_check():
     """
     Health check endpoint for container orchestration.
-    Returns status 200 if the service is running.
+    Returns status 200 if the service is running, with the number of times each VQL rewrite
+    fixed a query without calling the LLM since this worker started.
     """
-    return {"status": "OK"}
+    return {"status": "OK", "vql_rewrites": get_rewrite_counts()}
 
 app.include_router(getMetadata.router)
 app.include_router(similaritySearch.router)
@@ -166,6 +169,7 @@ app.include_router(answerQuestion.router)
 app.include_router(answerDataQuestion.router)
 app.include_router(answerMetadataQuestion.router)
 app.include_router(answerQuestionUsingViews.router)
+app.include_router(getResultPage.router)
 
 log_ai_sdk_parameters()
 
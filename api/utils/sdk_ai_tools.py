@@ -7,14 +7,16 @@ import asyncio
 
 from datetime import datetime
 
-from langchain_core.prompts import PromptTemplate
 from langchain_experimental.utilities import PythonREPL
-from langchain_core.output_parsers import StrOutputParser
 
 from utils import utils
 from utils.uniformVectorStore import UniformVectorStore
-from utils.uniformLLM import UniformLLM
+from utils.uniformLLM import get_llm
+from utils.llmCache import use_response_cache
 from utils.data_catalog import get_allowed_view_ids
+from utils.vqlRewriter import rewrite_vql, record_rewrite
+from utils.viewContext import ViewContext
+from utils import schemaPacker
 from api.utils import sdk_utils
 
 # LLM PROMPTS
@@ -44,47 +46,74 @@ TODAYS_DATE = datetime.now().strftime("%Y-%m-%d")
 @utils.log_params
 @utils.timed
 async def generate_view_answer(query, vql_query, vql_execution_result, llm_provider, llm_model, vector_search_tables, markdown_response = False, custom_instructions = '', session_id = None):
-    llm = UniformLLM(llm_provider, llm_model)
-    prompt = PromptTemplate.from_template(ANSWER_VIEW_PROMPT)
-    chain = prompt | llm.llm | StrOutputParser()
+    llm = get_llm(llm_provider, llm_model)
+    chain = llm.get_chain(ANSWER_VIEW_PROMPT, response_cache = use_response_cache(inspect.currentframe().f_code.co_name))
+    token_counter = utils.TokenCounter()
 
+    chain_params = _get_view_answer_parameters(query, vql_query, vql_execution_result, vector_search_tables, markdown_response, custom_instructions)
+    chain_config = llm.get_run_config(inspect.currentframe().f_code.co_name, token_counter, session_id)
+        
+    response = await chain.ainvoke(chain_params, config=chain_config)
+    response = utils.custom_tag_parser(response, 'final_answer', default = 'There was an error while generating the answer. Please try again later.')[0].strip()
+
+    return response, token_counter.tokens
+
+async def stream_view_answer(query, vql_query, vql_execution_result, llm_provider, llm_model, vector_search_tables, markdown_response = False, custom_instructions = '', session_id = None, token_counter = None):
+    """
+    Streaming version of generate_view_answer. Yields the text inside <final_answer> as soon as the LLM writes it.
+    Pass a TokenCounter to get the token usage once the generator is exhausted.
+    """
+    llm = get_llm(llm_provider, llm_model)
+    chain = llm.get_chain(ANSWER_VIEW_PROMPT)
+    token_counter = token_counter or utils.TokenCounter()
+    parser = utils.StreamingTagParser('final_answer')
+
+    chain_params = _get_view_answer_parameters(query, vql_query, vql_execution_result, vector_search_tables, markdown_response, custom_instructions)
+    chain_config = llm.get_run_config("generate_view_answer", token_counter, session_id)
+
+    answer_started = False
+    async for chunk in chain.astream(chain_params, config=chain_config):
+        new_text = parser.feed(chunk)
+        if not answer_started:
+            new_text = new_text.lstrip()
+        if new_text:
+            answer_started = True
+            yield new_text
+
+    if not answer_started:
+        yield 'There was an error while generating the answer. Please try again later.'
+
+    logging.info(f"stream_view_answer streamed {len(parser.content or '')} characters using {token_counter.tokens}")
+
+def _get_view_answer_parameters(query, vql_query, vql_execution_result, vector_search_tables, markdown_response, custom_instructions):
     response_format, response_example = sdk_utils.get_response_format(markdown_response)
-    chain_params = {
+    return {
         "question": query,
         "sql_query": vql_query,
         "sql_response": vql_execution_result,
         "response_format": response_format,
         "response_example": response_example,
-        "tables_needed": sdk_utils.readable_tables([table for table in vector_search_tables if table['view_name'] in vql_query.replace('"', '').replace("'", '')]),
+        "tables_needed": sdk_utils.readable_tables(ViewContext.of(vector_search_tables).referenced(vql_query.replace("'", ''))),
         "custom_instructions": custom_instructions
     }
-    chain_config = {
-        "callbacks": utils.add_langfuse_callback(llm.callback, f"{llm.provider_name}.{llm.model_name}", session_id),
-        "run_name": inspect.currentframe().f_code.co_name,
-    }
-        
-    response = await chain.ainvoke(chain_params, config=chain_config)
-    response = utils.custom_tag_parser(response, 'final_answer', default = 'There was an error while generating the answer. Please try again later.')[0].strip()
-
-    return response, llm.tokens
     
 @utils.log_params
 @utils.timed
-async def query_to_vql(query, vector_search_tables, llm_provider, llm_model, filter_params = '', custom_instructions = '', session_id = None, sample_data = None):
-    llm = UniformLLM(llm_provider, llm_model)
-    prompt = PromptTemplate.from_template(QUERY_TO_VQL_PROMPT)
+async def query_to_vql(query, vector_search_tables, llm_provider, llm_model, filter_params = '', custom_instructions = '', session_id = None, sample_data = None, on_vql = None, temperature = 0):
+    llm = get_llm(llm_provider, llm_model, temperature)
+    token_counter = utils.TokenCounter()
     query = re.sub(r'(?i)sql', 'VQL', query)
-    chain = prompt | llm.llm | StrOutputParser()
 
     filtered_tables = utils.custom_tag_parser(filter_params, 'table', default = [])
-    relevant_tables = format_schema_text(vector_search_tables, filtered_tables, sample_data)
+    relevant_tables = format_schema_text(
+        vector_search_tables,
+        filtered_tables,
+        sample_data,
+        question = query,
+        token_budget = schemaPacker.schema_token_budget(inspect.currentframe().f_code.co_name)
+    )
 
-    prompt_parts = {
-        "having": int("<having>" in filter_params),
-        "groupby": int("<orderby>" in filter_params or "<groupby>" in filter_params),
-        "dates": int("<dates>" in filter_params),
-        "arithmetic": int("<arithmetic>" in filter_params)
-    }
+    prompt_parts = sdk_utils.get_prompt_parts(filter_params)
 
     vql_restrictions = sdk_utils.generate_vql_restrictions(
         prompt_parts,
@@ -95,20 +124,34 @@ async def query_to_vql(query, vector_search_tables, llm_provider, llm_model, fil
         ARITHMETIC_VQL_PROMPT,
     )
 
-    response = await chain.ainvoke(
-        {
-            "query": query,
-            "schema": relevant_tables,
-            "date": TODAYS_DATE,
-            "vql_restrictions": vql_restrictions,
-            "custom_instructions": custom_instructions
-        },
-        config={
-            "callbacks": utils.add_langfuse_callback(llm.callback, f"{llm.provider_name}.{llm.model_name}", session_id),
-            "run_name": inspect.currentframe().f_code.co_name,
-        }
+    # The VQL rules form the static, cacheable prefix of the prompt
+    _, chain = llm.get_prefix_cached_chain(
+        QUERY_TO_VQL_PROMPT,
+        response_cache = use_response_cache(inspect.currentframe().f_code.co_name),
+        vql_restrictions = vql_restrictions
     )
 
+    chain_params = {
+        "query": query,
+        "schema": relevant_tables,
+        "date": TODAYS_DATE,
+        "custom_instructions": custom_instructions
+    }
+    chain_config = llm.get_run_config(inspect.currentframe().f_code.co_name, token_counter, session_id)
+
+    if on_vql:
+        # Stream the response to hand over the VQL as soon as </vql> arrives, while the explanation is still being generated
+        parser = utils.StreamingTagParser('vql')
+        response = ''
+        async for chunk in chain.astream(chain_params, config=chain_config):
+            response += chunk
+            if not parser.closed:
+                parser.feed(chunk)
+                if parser.closed:
+                    on_vql(parser.content.strip())
+    else:
+        response = await chain.ainvoke(chain_params, config=chain_config)
+
     if '```' in response:
         response = response.replace('```vql', '<vql>').replace('```', '</vql>').strip()
 
@@ -119,17 +162,23 @@ async def query_to_vql(query, vector_search_tables, llm_provider, llm_model, fil
     if conditions != "None":
         query_explanation = f"{query_explanation}\n\nConditions: {conditions}"
 
-    return vql_query, query_explanation, llm.tokens
+    return vql_query, query_explanation, token_counter.tokens
 
 @utils.log_params
 @utils.timed
 async def related_questions(question, sql_query, execution_result, vector_search_tables, llm_provider, llm_model, custom_instructions = '', session_id = None, sample_data = None):
-    llm = UniformLLM(llm_provider, llm_model)
-    prompt = PromptTemplate.from_template(RELATED_QUESTIONS_PROMPT)
-    chain = prompt | llm.llm | StrOutputParser()
-
-    schema = [table for table in vector_search_tables if table['view_name'] in sql_query.replace('"', '')]
-    relevant_tables = format_schema_text(schema, [], sample_data)
+    llm = get_llm(llm_provider, llm_model)
+    chain = llm.get_chain(RELATED_QUESTIONS_PROMPT, response_cache = use_response_cache(inspect.currentframe().f_code.co_name))
+    token_counter = utils.TokenCounter()
+
+    schema = ViewContext.of(vector_search_tables).referenced(sql_query)
+    relevant_tables = format_schema_text(
+        schema,
+        [],
+        sample_data,
+        question = question,
+        token_budget = schemaPacker.schema_token_budget(inspect.currentframe().f_code.co_name)
+    )
 
     response = await chain.ainvoke(
         {
@@ -138,95 +187,135 @@ async def related_questions(question, sql_query, execution_result, vector_search
             "question": question,
             "sql_response": execution_result,
         },
-        config={
-            "callbacks": utils.add_langfuse_callback(llm.callback, f"{llm.provider_name}.{llm.model_name}", session_id),
-            "run_name": inspect.currentframe().f_code.co_name,
-        }
+        config=llm.get_run_config(inspect.currentframe().f_code.co_name, token_counter, session_id)
     )
 
     related_questions = utils.custom_tag_parser(response, 'related_question', default='')
 
-    return related_questions, llm.tokens
+    return related_questions, token_counter.tokens
 
-def format_schema_text(vector_search_tables, filtered_tables, sample_data, examples_per_table = 3):
+def format_schema_text(vector_search_tables, filtered_tables, sample_data, examples_per_table = 3, question = '', token_budget = 0):
     """
     Formats and optimizes schema data into a readable text format with reduced token usage for LLMs.
+    The text of each view is precomputed, so only the sample values and the joins between the present tables are added here.
+
+    With a token_budget, the columns least related to the question are left out (primary keys and join keys are always kept)
+    and listed by name only if there's room. What's left out is recorded in the ViewContext's pruned_columns.
     """
-    def format_column(col):
-        name = col.get('columnName', 'unnamed')
-        col_type = col.get('type', 'unknown')
-        desc = col.get('description')
-        primary_key = col.get('primaryKey', False)
-        nullable = col.get('nullable', True)
-        examples = col.get('sample_data', [])
-
-        flags = []
-        if primary_key:
-            flags.append("PK")
-        if not nullable:
-            flags.append("NOT NULL")
-
-        parts = [f"→ {name} ({col_type})"]
-        if flags:
-            parts.append(f"[{' '.join(flags)}]")
-        if desc:
-            parts.append(f"- {desc if desc.endswith('.') else desc + '.'}")
-        if examples:
-            filtered_examples = [example for example in examples if example]
-            if filtered_examples:
-                parts.append(f"sample values: {', '.join(filtered_examples[:examples_per_table])}")
-
-        return " ".join(parts)
-
-    def format_table(table, sample_data, present_tables = []):
-        lines = []
-        table_name = table.get('tableName', 'unnamed_database.unnamed_table')
-        table_description = table.get('description', '')
-        table_id = str(table.get('id'))
-        database_name, view_name = table_name.split('.')
-        table_name = f'"{database_name}"."{view_name}"'
-        lines.append(f"# Table: {table_name}")
-        if table_description:
-            lines.append(f"## Description:\n{table_description}")
-        lines.append("## Columns:")
-        # Format columns
-        schema = table.get('schema', [])
-        for col in schema:
-            if sample_data and table_id in sample_data:
-                col_sample_data = sample_data[table_id].get(col.get('columnName'), [])
-                col['sample_data'] = col_sample_data
-            lines.append(format_column(col))
-
-        # Format associations
-        associations = table.get('associations', [])
-        if associations:
+    def column_lines(record):
+        table_sample_data = sample_data.get(record.view_id) if sample_data else None
+        schema = record.view_json.get('schema', [])
+
+        columns = []
+        for index, (column_name, line, tokens) in enumerate(record.fragment['columns']):
+            if table_sample_data is not None:
+                examples = table_sample_data.get(column_name, [])
+            else:
+                examples = schema[index].get('sample_data', []) if index < len(schema) else []
+            examples = [example for example in examples if example][:examples_per_table]
+            if examples:
+                suffix = f" sample values: {', '.join(examples)}"
+                line, tokens = line + suffix, tokens + schemaPacker.estimate_tokens(suffix)
+            columns.append((column_name, line, tokens, examples))
+        return columns
+
+    def table_joins(record, present_tables):
+        return [
+            f"→ {where_clause}" for where_clause in record.fragment['joins']
+            if sum(table in where_clause for table in present_tables) == 2
+        ]
+
+    def format_table(record, columns, joins, omitted = ()):
+        lines = [record.fragment['header']] + [line for _, line, _, _ in columns]
+        if omitted:
+            lines.append(omitted)
+        if record.fragment['has_associations']:
             lines.append("## Joins:")
-            for assoc in associations:
-                where_clause = assoc.get('where')
-                if where_clause and sum(table in where_clause for table in present_tables) == 2:
-                        lines.append(f"→ {where_clause}")
-
+            lines.extend(joins)
         return "\n".join(lines)
 
+    view_context = ViewContext.of(vector_search_tables)
+    records = [view_context.by_name[filtered_table] for filtered_table in filtered_tables if filtered_table in view_context.by_name]
+    present_tables = filtered_tables if records else [record.name for record in view_context.records]
+    records = records or view_context.records
+
+    columns = [column_lines(record) for record in records]
+    joins = [table_joins(record, present_tables) for record in records]
+
+    if not token_budget:
+        return "\n\n".join(format_table(record, *table) for record, *table in zip(records, columns, joins))
+
+    question_terms = schemaPacker.text_terms(question)
+    kept = schemaPacker.pack_columns([
+        (
+            record.fragment['header_tokens'] + schemaPacker.estimate_tokens("\n".join(["## Joins:"] + table_joins)),
+            [
+                (tokens, schemaPacker.score_column(question_terms, column_name, column, examples))
+                for (column_name, _, tokens, examples), column in zip(table_columns, record.view_json.get('schema', []))
+            ],
+            schemaPacker.required_columns(record.fragment, record.view_json)
+        )
+        for record, table_columns, table_joins in zip(records, columns, joins)
+    ], token_budget)
+
+    # What's left of the budget goes to listing the names of the columns left out
+    remaining = token_budget - sum(
+        record.fragment['header_tokens'] + schemaPacker.estimate_tokens("\n".join(["## Joins:"] + table_joins))
+        + sum(table_columns[index][2] for index in indexes)
+        for record, table_columns, table_joins, indexes in zip(records, columns, joins, kept)
+    )
+
     formatted_tables = []
-    # Create a lookup dictionary for faster access
-    table_lookup = {t['view_name']: t['view_json'] for t in vector_search_tables}
-    present_tables = [table['view_name'] for table in vector_search_tables]
-    if not filtered_tables:
-        return "\n\n".join([format_table(table_lookup[table['view_name']], sample_data, present_tables) for table in vector_search_tables])
+    for record, table_columns, table_joins, indexes in zip(records, columns, joins, kept):
+        pruned = [column[0] for index, column in enumerate(table_columns) if index not in indexes]
+        omitted = ''
+        if pruned:
+            view_context.pruned_columns[record.name] = pruned
+            omitted = f"## Other columns: {', '.join(pruned)}"
+            if schemaPacker.estimate_tokens(omitted) > remaining:
+                omitted = f"({len(pruned)} more column{'s' if len(pruned) > 1 else ''} not shown)"
+            remaining -= schemaPacker.estimate_tokens(omitted)
+        else:
+            view_context.pruned_columns.pop(record.name, None)
+        table_columns = [column for index, column in enumerate(table_columns) if index in indexes]
+        formatted_tables.append(format_table(record, table_columns, table_joins, omitted))
+
+    return "\n\n".join(formatted_tables)
 
-    for filtered_table in filtered_tables:
-        if filtered_table not in table_lookup:
-            continue
+def format_metadata_schema(vector_search_tables, token_budget = 0):
+    """
+    Compact schema of the views for the metadata prompts: names, descriptions, column types, associations and tags.
+    Sample values, ids and the rest of the view definition are left out.
+    The views come in order of relevance. With a token_budget, the views that don't fit list only the names of their columns,
+    and the views after those only their name.
+    """
+    def format_metadata(record):
+        lines = [record.fragment['header']] + [line for _, line, _ in record.fragment['columns']]
+        if record.fragment['joins']:
+            lines.append("## Associations:")
+            lines.extend(f"→ {where_clause}" for where_clause in record.fragment['joins'])
+        return lines
+
+    formatted_tables, omitted_tables, spent = [], [], 0
+    for record in ViewContext.of(vector_search_tables).records:
+        tags = [tag['name'] for tag in record.view_json.get('tagDetails', []) if tag.get('name')]
+        tags = f"## Tags: {', '.join(tags)}" if tags else ''
+
+        lines, tokens = format_metadata(record), record.fragment['tokens'] + schemaPacker.estimate_tokens(tags)
+        if token_budget and spent + tokens > token_budget:
+            column_names = ', '.join(str(column_name) for column_name, _, _ in record.fragment['columns'])
+            lines = [record.fragment['header'], column_names]
+            tokens = record.fragment['header_tokens'] + schemaPacker.estimate_tokens(column_names + tags)
+            if omitted_tables or spent + tokens > token_budget:
+                omitted_tables.append(record.name)
+                continue
 
-        table_json = table_lookup[filtered_table].copy()
-        formatted_table = format_table(table_json, sample_data, filtered_tables)
-        formatted_tables.append(formatted_table)
+        formatted_tables.append("\n".join(lines + ([tags] if tags else [])))
+        spent += tokens
 
-    if formatted_tables:
-        return "\n\n".join(formatted_tables)
-    else:
-        return "\n\n".join([format_table(table_lookup[table['view_name']], sample_data, present_tables) for table in vector_search_tables])
+    if omitted_tables:
+        formatted_tables.append(f"Other views, not shown: {', '.join(omitted_tables)}")
+    return "\n\n".join(formatted_tables)
 
 @utils.log_params
 def get_relevant_tables_json(vector_search_tables, filtered_tables):
@@ -270,82 +359,77 @@ def get_relevant_tables_json(vector_search_tables, filtered_tables):
 @utils.log_params
 @utils.timed
 async def metadata_category(query, vector_search_tables, llm_provider, llm_model, custom_instructions = '', session_id = None):
-    llm = UniformLLM(llm_provider, llm_model)
-
-    prompt = PromptTemplate.from_template(METADATA_CATEGORY_PROMPT)
-    chain = prompt | llm.llm | StrOutputParser()
+    llm = get_llm(llm_provider, llm_model)
+    chain = llm.get_chain(METADATA_CATEGORY_PROMPT, response_cache = use_response_cache(inspect.currentframe().f_code.co_name))
+    token_counter = utils.TokenCounter()
 
     response = await chain.ainvoke(
         {
             "instruction": query,
-            "schema": [table['view_json'] for table in vector_search_tables],
+            "schema": format_metadata_schema(
+                vector_search_tables,
+                token_budget = schemaPacker.schema_token_budget(inspect.currentframe().f_code.co_name)
+            ),
             "custom_instructions": custom_instructions
         },
-        config={
-            "callbacks": utils.add_langfuse_callback(llm.callback, f"{llm.provider_name}.{llm.model_name}", session_id),
-            "run_name": inspect.currentframe().f_code.co_name,
-        }
+        config=llm.get_run_config(inspect.currentframe().f_code.co_name, token_counter, session_id)
     )
     category = utils.custom_tag_parser(response, 'cat', default="OTHER")[0].strip()
     metadata_response = utils.custom_tag_parser(response, 'response', default='')[0].strip()
     related_questions = utils.custom_tag_parser(response, 'related_question', default=[])
 
-    return category, metadata_response, related_questions, llm.tokens
+    return category, metadata_response, related_questions, token_counter.tokens
 
 @utils.log_params
 @utils.timed
 async def direct_metadata_category(query, vector_search_tables, llm_provider, llm_model, custom_instructions = '', session_id = None):
-    llm = UniformLLM(llm_provider, llm_model)
-
-    prompt = PromptTemplate.from_template(DIRECT_METADATA_CATEGORY_PROMPT)
-    chain = prompt | llm.llm | StrOutputParser()
+    llm = get_llm(llm_provider, llm_model)
+    chain = llm.get_chain(DIRECT_METADATA_CATEGORY_PROMPT, response_cache = use_response_cache(inspect.currentframe().f_code.co_name))
+    token_counter = utils.TokenCounter()
 
     response = await chain.ainvoke(
         {
             "instruction": query,
-            "schema": [table['view_json'] for table in vector_search_tables],
+            "schema": format_metadata_schema(
+                vector_search_tables,
+                token_budget = schemaPacker.schema_token_budget(inspect.currentframe().f_code.co_name)
+            ),
             "custom_instructions": custom_instructions
         },
-        config={
-            "callbacks": utils.add_langfuse_callback(llm.callback, f"{llm.provider_name}.{llm.model_name}", session_id),
-            "run_name": inspect.currentframe().f_code.co_name,
-        }
+        config=llm.get_run_config(inspect.currentframe().f_code.co_name, token_counter, session_id)
     )
 
     category = "METADATA"
     metadata_response = utils.custom_tag_parser(response, 'response', default='')[0].strip()
     related_questions = utils.custom_tag_parser(response, 'related_question', default=[])
 
-    return category, metadata_response, related_questions, llm.tokens
+    return category, metadata_response, related_questions, token_counter.tokens
 
 @utils.log_params
 @utils.timed
 async def direct_sql_category(query, vector_search_tables, llm_provider, llm_model, custom_instructions = '', session_id = None):
-    llm = UniformLLM(llm_provider, llm_model)
-    prompt = PromptTemplate.from_template(DIRECT_SQL_CATEGORY_PROMPT)
-    chain = prompt | llm.llm | StrOutputParser()
+    llm = get_llm(llm_provider, llm_model)
+    chain = llm.get_chain(DIRECT_SQL_CATEGORY_PROMPT, response_cache = use_response_cache(inspect.currentframe().f_code.co_name))
+    token_counter = utils.TokenCounter()
 
     response = await chain.ainvoke({
         "instruction": query,
         "schema": sdk_utils.readable_tables(vector_search_tables),
         "custom_instructions": custom_instructions
-    }, config={
-        "callbacks": utils.add_langfuse_callback(llm.callback, f"{llm.provider_name}.{llm.model_name}", session_id),
-        "run_name": inspect.currentframe().f_code.co_name,
-    })
+    }, config=llm.get_run_config(inspect.currentframe().f_code.co_name, token_counter, session_id))
 
     category = "SQL"
     filter_params = utils.custom_tag_parser(response, 'query', default=[])
     sql_related_questions = []
 
-    return category, filter_params[0] if len(filter_params) > 0 else '', sql_related_questions, llm.tokens
+    return category, filter_params[0] if len(filter_params) > 0 else '', sql_related_questions, token_counter.tokens
 
 @utils.log_params
 @utils.timed
 async def sql_category(query, vector_search_tables, llm_provider, llm_model, mode = 'default', custom_instructions = '', session_id = None):
-    llm = UniformLLM(llm_provider, llm_model)
-    prompt = PromptTemplate.from_template(SQL_CATEGORY_PROMPT)
-    chain = prompt | llm.llm | StrOutputParser()
+    llm = get_llm(llm_provider, llm_model)
+    chain = llm.get_chain(SQL_CATEGORY_PROMPT, response_cache = use_response_cache(inspect.currentframe().f_code.co_name))
+    token_counter = utils.TokenCounter()
 
     if mode == 'metadata':
         return await direct_metadata_category(
@@ -383,10 +467,7 @@ async def sql_category(query, vector_search_tables, llm_provider, llm_model, mod
                 "instruction": query,
                 "schema": sdk_utils.readable_tables(vector_search_tables),
                 "custom_instructions": custom_instructions
-            }, config={
-                "callbacks": utils.add_langfuse_callback(llm.callback, f"{llm.provider_name}.{llm.model_name}", session_id),
-                "run_name": inspect.currentframe().f_code.co_name,
-            })
+            }, config=llm.get_run_config(inspect.currentframe().f_code.co_name, token_counter, session_id))
         )
         
         # Wait for either task to complete
@@ -425,29 +506,26 @@ async def sql_category(query, vector_search_tables, llm_provider, llm_model, mod
         filter_params = utils.custom_tag_parser(response, 'query', default=[])
         sql_related_questions = []
         
-        return category, filter_params[0] if len(filter_params) > 0 else '', sql_related_questions, llm.tokens
+        return category, filter_params[0] if len(filter_params) > 0 else '', sql_related_questions, token_counter.tokens
 
 @utils.log_params
 @utils.timed
 async def graph_generator(query, data_file, execution_result, llm_provider, llm_model, details = 'No special requirements', session_id = None):
-    llm = UniformLLM(llm_provider, llm_model)
-    final_prompt = PromptTemplate.from_template(GENERATE_VISUALIZATION_PROMPT)
-    final_chain = final_prompt | llm.llm | StrOutputParser()
+    llm = get_llm(llm_provider, llm_model)
+    chain = llm.get_chain(GENERATE_VISUALIZATION_PROMPT, response_cache = use_response_cache(inspect.currentframe().f_code.co_name))
+    token_counter = utils.TokenCounter()
 
     # Get the first 3 available rows in execution_result, if they exist
     sample_data = {f"Row {i+1}": execution_result[f"Row {i+1}"] for i in range(3) if f"Row {i+1}" in execution_result}
 
-    response = await final_chain.ainvoke({
+    response = await chain.ainvoke({
         "data": data_file, 
         "details": details,
         "instruction": query,
         "plot_details": details,
         "sample_data": json.dumps(sample_data)
     }, 
-        config = {
-            "callbacks": utils.add_langfuse_callback(llm.callback, f"{llm.provider_name}.{llm.model_name}", session_id),
-            "run_name": inspect.currentframe().f_code.co_name,
-        }
+        config = llm.get_run_config(inspect.currentframe().f_code.co_name, token_counter, session_id)
     )
     
     python_code = utils.custom_tag_parser(response, 'python', default = '')[0].strip()
@@ -459,33 +537,54 @@ async def graph_generator(query, data_file, execution_result, llm_provider, llm_
     if output.endswith("\n"):
         output = output[:-1]
 
-    return output, llm.tokens
+    return output, token_counter.tokens
+
+def prepare_and_rewrite_vql(query, vector_search_tables):
+    """Runs prepare_vql and, for the error categories that can be fixed without the LLM, the VQL rewrites."""
+    query, error_log, error_categories = sdk_utils.prepare_vql(query, vector_search_tables)
+
+    rewritten_query, fixed_categories = rewrite_vql(query, error_categories)
+    if fixed_categories:
+        query, error_log, error_categories = sdk_utils.prepare_vql(rewritten_query, vector_search_tables)
+        if not error_log:
+            for category in fixed_categories:
+                record_rewrite(category)
+
+    return query, error_log, error_categories
 
 @utils.log_params
 @utils.timed
 async def query_fixer(question, query, llm_provider, llm_model, vector_search_tables, error_log=False, error_categories=[], fixer_history=[], session_id = None, query_explanation = '', sample_data = None):
-    llm = UniformLLM(llm_provider, llm_model)
+    llm = get_llm(llm_provider, llm_model)
+    token_counter = utils.TokenCounter()
     
     if not error_log:
-        query, error_log, error_categories = sdk_utils.prepare_vql(query)
-
-    schema = [table for table in vector_search_tables if table['view_name'] in query.replace('"', '')]
-    relevant_tables = format_schema_text(schema, [], sample_data)
+        query, error_log, error_categories = prepare_and_rewrite_vql(query, vector_search_tables)
+
+    view_context = ViewContext.of(vector_search_tables)
+    schema = view_context.referenced(query)
+    token_budget = schemaPacker.schema_token_budget(inspect.currentframe().f_code.co_name)
+    if schemaPacker.is_pruned_column_error(error_log, view_context.pruned_columns):
+        # The VQL was generated without some of the columns, show the fixer all of them
+        logging.info("Column error with a pruned schema, fixing with the full schema.")
+        token_budget = 0
+    relevant_tables = format_schema_text(schema, [], sample_data, question = question, token_budget = token_budget)
     prompt, parameters = _get_prompt_and_parameters(question, query, error_log, error_categories, relevant_tables, query_explanation)
     
     if not prompt:
         logging.info("VQL query is valid, continuing execution.")
-        return query, fixer_history, llm.tokens
+        return query, fixer_history, token_counter.tokens
 
-    final_prompt = PromptTemplate.from_template(prompt)
-    final_chain = final_prompt | llm.llm | StrOutputParser()
+    static_params = {key: parameters.pop(key) for key in ["vql_restrictions"] if key in parameters}
+    final_prompt, chain = llm.get_prefix_cached_chain(
+        prompt,
+        response_cache = use_response_cache(inspect.currentframe().f_code.co_name),
+        **static_params
+    )
 
-    response = await final_chain.ainvoke(
+    response = await chain.ainvoke(
         parameters, 
-        config = {
-            "callbacks": utils.add_langfuse_callback(llm.callback, f"{llm.provider_name}.{llm.model_name}", session_id),
-            "run_name": inspect.currentframe().f_code.co_name,
-        }
+        config = llm.get_run_config(inspect.currentframe().f_code.co_name, token_counter, session_id)
     )
     
     if '```' in response:
@@ -493,20 +592,30 @@ async def query_fixer(question, query, llm_provider, llm_model, vector_search_ta
 
     vql_query = utils.custom_tag_parser(response, 'vql', default='')[0].strip()
 
-    fixed_vql_query, error_log, error_categories = sdk_utils.prepare_vql(vql_query)
+    fixed_vql_query, error_log, error_categories = sdk_utils.prepare_vql(vql_query, vector_search_tables)
     input_prompt = final_prompt.format(**parameters)
     fixer_history.extend([('human', input_prompt), ('ai', response)])
-    return fixed_vql_query, fixer_history, llm.tokens
+    return fixed_vql_query, fixer_history, token_counter.tokens
 
 @utils.log_params
 @utils.timed
 async def query_reviewer(question, vql_query, llm_provider, llm_model, vector_search_tables, session_id = None, fixer_history=[], sample_data = None):
-    llm = UniformLLM(llm_provider, llm_model)
-    final_prompt = PromptTemplate.from_template(QUERY_REVIEWER_PROMPT)
-    final_chain = final_prompt | llm.llm | StrOutputParser()
-
-    schema = [table for table in vector_search_tables if table['view_name'] in vql_query.replace('"', '')]
-    relevant_tables = format_schema_text(schema, [], sample_data)
+    llm = get_llm(llm_provider, llm_model)
+    _, chain = llm.get_prefix_cached_chain(
+        QUERY_REVIEWER_PROMPT,
+        response_cache = use_response_cache(inspect.currentframe().f_code.co_name),
+        vql_restrictions = ''
+    )
+    token_counter = utils.TokenCounter()
+
+    schema = ViewContext.of(vector_search_tables).referenced(vql_query)
+    relevant_tables = format_schema_text(
+        schema,
+        [],
+        sample_data,
+        question = question,
+        token_budget = schemaPacker.schema_token_budget(inspect.currentframe().f_code.co_name)
+    )
 
     vql_restrictions = sdk_utils.generate_vql_restrictions(
         prompt_parts={"dates": 1, "arithmetic": 1, "groupby": 1, "having": 1},
@@ -519,17 +628,13 @@ async def query_reviewer(question, vql_query, llm_provider, llm_model, vector_se
 
     vql_rules = f"Here are the VQL generation rules:\n<vql_rules>\n{vql_restrictions}\n</vql_rules>"
 
-    response = await final_chain.ainvoke(
+    response = await chain.ainvoke(
         {
             "question": question,
-            "vql_restrictions": '',
             "query": vql_query,
             "schema": relevant_tables
         }, 
-        config = {
-            "callbacks": utils.add_langfuse_callback(llm.callback, f"{llm.provider_name}.{llm.model_name}", session_id),
-            "run_name": inspect.currentframe().f_code.co_name,
-        }
+        config = llm.get_run_config(inspect.currentframe().f_code.co_name, token_counter, session_id)
     )
 
     if '```' in response:
@@ -537,14 +642,14 @@ async def query_reviewer(question, vql_query, llm_provider, llm_model, vector_se
 
     vql_query = utils.custom_tag_parser(response, 'vql', default='')[0].strip()
     new_vql_query, _, _ = sdk_utils.prepare_vql(vql_query)
-    input_prompt = final_prompt.format(**{
+    history_prompt, _ = llm.get_prefix_cached_chain(QUERY_REVIEWER_PROMPT, vql_restrictions = vql_rules)
+    input_prompt = history_prompt.format(**{
         "question": question,
-        "vql_restrictions": vql_rules,
         "query": vql_query,
         "schema": relevant_tables
     })
     fixer_history.extend([('human', input_prompt), ('ai', response)])
-    return new_vql_query, fixer_history, llm.tokens
+    return new_vql_query, fixer_history, token_counter.tokens
 
 def _get_prompt_and_parameters(question, vql_query, error_log, error_categories, schema, query_explanation):
     error_handlers = {
@@ -600,7 +705,7 @@ async def get_relevant_tables(query, embeddings_provider, embeddings_model, vect
     )
     
     # Create tasks for both async operations to run in parallel
-    embedding_task = asyncio.create_task(vector_store.embeddings.aembed_query(query))
+    embedding_task = asyncio.create_task(vector_store.full_embeddings.aembed_query(query))
     view_ids_task = asyncio.create_task(get_allowed_view_ids(auth=auth))
     
     # Wait for both tasks to complete
@@ -632,6 +737,7 @@ async def get_relevant_tables(query, embeddings_provider, embeddings_model, vect
                 "view_text": table.page_content,
                 "view_name": table.metadata['view_name'],
                 "view_json": json.loads(table.metadata['view_json']),
+                "view_fragment": json.loads(table.metadata['view_fragment']) if 'view_fragment' in table.metadata else None,
                 "view_id": table.metadata['view_id']
             })
 
@@ -653,6 +759,7 @@ async def get_relevant_tables(query, embeddings_provider, embeddings_model, vect
                     "view_text": table.page_content,
                     "view_name": table.metadata['view_name'],
                     "view_json": json.loads(table.metadata['view_json']),
+                    "view_fragment": json.loads(table.metadata['view_fragment']) if 'view_fragment' in table.metadata else None,
                     "view_id": table.metadata['view_id']
                 })
         
@@ -725,4 +832,11 @@ async def get_relevant_tables(query, embeddings_provider, embeddings_model, vect
                     column_samples[col].append(val)
             
             sample_data[view_id] = column_samples
-    return relevant_tables, sample_data, timings
\ No newline at end of file
+
+    # Reused by the question cache to look up and store VQL for this question
+    question_context = {
+        "embedding": embedded_query,
+        "valid_view_ids": valid_view_ids,
+        "embeddings_model": f"{embeddings_provider}.{embeddings_model}"
+    }
+    return ViewContext(relevant_tables), sample_data, timings, question_context
\ No newline at end of file
@@ -3,38 +3,158 @@ import json
 import random
 import string
 import asyncio
+import logging
+import traceback
 
 from api.utils import sdk_ai_tools
-from utils.data_catalog import execute_vql
-from utils.uniformLLM import UniformLLM
-from utils.utils import custom_tag_parser, add_langfuse_callback
+from utils.data_catalog import execute_vql, to_result_format, columns_to_arrow_ipc, result_row_count, default_execution_limit
+from utils.uniformLLM import get_llm
+from utils.questionCache import get_question_cache, scope_hash
+from utils.resultHandles import get_result_handles, is_pageable
+from utils.resultEncoder import encode_execution_result
+from utils.viewContext import ViewContext
+from utils.utils import custom_tag_parser, TokenCounter
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
-from api.utils.sdk_utils import timing_context, is_data_complex, add_tokens
+from api.utils.sdk_utils import timing_context, is_data_complex, add_tokens, get_prompt_parts, format_sse_event, prepare_vql
 
-async def process_sql_category(request, vector_search_tables, category_response, auth, timings, session_id = None, sample_data = None):
-    with timing_context("llm_time", timings):
-        vql_query, query_explanation, query_to_vql_tokens = await sdk_ai_tools.query_to_vql(
-            query=request.question, 
-            vector_search_tables=vector_search_tables, 
-            llm_provider=request.sql_gen_provider, 
-            llm_model=request.sql_gen_model, 
-            filter_params=category_response,
-            custom_instructions=request.custom_instructions,
+SPECULATIVE_VQL_RERUN = os.getenv('SPECULATIVE_VQL_RERUN', '0') == '1'
+EARLY_VQL_EXECUTION = os.getenv('EARLY_VQL_EXECUTION', '0') == '1'
+VQL_CANDIDATES = int(os.getenv('VQL_CANDIDATES', 1))
+VQL_CANDIDATES_TEMPERATURE = float(os.getenv('VQL_CANDIDATES_TEMPERATURE', 0.7))
+VQL_CANDIDATES_MAX_TOKENS = int(os.getenv('VQL_CANDIDATES_MAX_TOKENS', 0))
+LLM_RESULT_MAX_ROWS = int(os.getenv('LLM_RESULT_MAX_ROWS', 15))
+LLM_RESULT_TOKEN_BUDGET = int(os.getenv('LLM_RESULT_TOKEN_BUDGET', 0))
+# Average tokens of a VQL candidate in this process, to decide how many fit in VQL_CANDIDATES_MAX_TOKENS
+candidate_token_estimate = {'input_tokens': 0, 'total_tokens': 0}
+DISCLAIMER = "\n\nDISCLAIMER: This response has been generated based on an LLM's interpretation of the data and may not be accurate."
+
+def start_speculative_vql(request, vector_search_tables, session_id = None, sample_data = None, auth = None):
+    """
+    Starts generating the VQL with an empty filter_params, to run concurrently with sql_category.
+    The task must be passed on to process_sql_category, or cancelled if the question is not answered with SQL.
+    """
+    return asyncio.create_task(generate_vql(
+        request=request,
+        vector_search_tables=vector_search_tables,
+        category_response='',
+        timings={},
+        session_id=session_id,
+        sample_data=sample_data,
+        auth=auth
+    ))
+
+def discard_speculative_vql(speculative_vql_task):
+    """
+    Cancels a speculative VQL generation that won't be used, retrieving its exception if it already failed.
+    If it already finished, the execution of its VQL that generate_vql may have started early is cancelled instead.
+    """
+    if speculative_vql_task is None:
+        return
+    if not speculative_vql_task.done():
+        speculative_vql_task.cancel()
+    elif not speculative_vql_task.cancelled() and speculative_vql_task.exception() is None:
+        early_execution_task = speculative_vql_task.result()[4]
+        if early_execution_task:
+            early_execution_task.cancel()
+
+def speculative_vql_is_valid(category_response):
+    """The speculative VQL was generated without filter hints. It's discarded if the hints ask for extra VQL rules and SPECULATIVE_VQL_RERUN is set."""
+    if not SPECULATIVE_VQL_RERUN:
+        return True
+    return not any(get_prompt_parts(category_response).values())
+
+async def process_sql_category(request, vector_search_tables, category_response, auth, timings, session_id = None, sample_data = None, question_context = None, speculative_vql_task = None, stream_answer = False, on_event = None, result_format = 'rows'):
+    """
+    Generates, fixes and executes the VQL of a SQL question and answers it with the execution result.
+    The execution result of the response is in result_format: 'rows' (parse_execution_json), 'columnar' (parse_execution_columns)
+    or 'arrow', a base64 Arrow IPC stream under the 'arrow_ipc' key. Arrow results are handled as columnar until the response is built.
+    """
+    execution_format = 'rows' if result_format == 'rows' else 'columnar'
+    # Endpoints that receive the tables directly pass a plain list. Every step of the request must share the same
+    # context, so the columns pruned from the VQL generation schema are known to the fixer
+    vector_search_tables = ViewContext.of(vector_search_tables)
+    question_cache = get_question_cache() if question_context else None
+    cached_question = None
+    if question_cache:
+        question_scope = scope_hash(
+            question_context['valid_view_ids'],
+            question_context['embeddings_model'],
+            request.sql_gen_provider,
+            request.sql_gen_model,
+            request.custom_instructions
+        )
+        with timing_context("question_cache_time", timings):
+            cached_question = await asyncio.to_thread(
+                question_cache.lookup,
+                question_context['embedding'],
+                question_scope,
+                vector_search_tables
+            )
+
+    if speculative_vql_task and (cached_question or not speculative_vql_is_valid(category_response)):
+        discard_speculative_vql(speculative_vql_task)
+        speculative_vql_task = None
+
+    vql_candidate, invalid_vql_candidate = None, None
+    vql_candidates_tokens = {'input_tokens': 0, 'output_tokens': 0, 'cached_tokens': 0, 'total_tokens': 0}
+    if VQL_CANDIDATES > 1 and auth and not cached_question and not speculative_vql_task:
+        vql_candidate, invalid_vql_candidate, vql_candidates_tokens = await generate_vql_candidates(
+            request=request,
+            vector_search_tables=vector_search_tables,
+            category_response=category_response,
+            auth=auth,
+            timings=timings,
             session_id=session_id,
             sample_data=sample_data
         )
 
-        vql_query, _, query_fixer_tokens = await sdk_ai_tools.query_fixer(
-            question=request.question,
-            query=vql_query, 
-            query_explanation=query_explanation,
-            llm_provider=request.sql_gen_provider, 
-            llm_model=request.sql_gen_model,
-            session_id=session_id,
+    if cached_question:
+        logging.info(f"Question cache hit with similarity {cached_question['similarity']:.3f}, reusing VQL")
+        vql_query = cached_question['vql']
+        query_explanation = cached_question['query_explanation']
+        query_to_vql_tokens = {'input_tokens': 0, 'output_tokens': 0, 'cached_tokens': 0, 'total_tokens': 0}
+        query_fixer_tokens = {'input_tokens': 0, 'output_tokens': 0, 'cached_tokens': 0, 'total_tokens': 0}
+        early_execution_task = None
+    elif vql_candidate:
+        vql_query, query_explanation, early_execution_task = vql_candidate
+        query_to_vql_tokens = vql_candidates_tokens
+        query_fixer_tokens = {'input_tokens': 0, 'output_tokens': 0, 'cached_tokens': 0, 'total_tokens': 0}
+    elif invalid_vql_candidate:
+        # No candidate passed the local validation, so the best one is fixed instead of generating the VQL again
+        vql_query, query_explanation = invalid_vql_candidate
+        with timing_context("llm_time", timings):
+            vql_query, _, query_fixer_tokens = await sdk_ai_tools.query_fixer(
+                question=request.question,
+                query=vql_query,
+                query_explanation=query_explanation,
+                llm_provider=request.sql_gen_provider,
+                llm_model=request.sql_gen_model,
+                session_id=session_id,
+                vector_search_tables=vector_search_tables,
+                sample_data=sample_data
+            )
+        query_to_vql_tokens = vql_candidates_tokens
+        early_execution_task = None
+    elif speculative_vql_task:
+        # Only the time still spent waiting for the speculative generation is added to the LLM time
+        with timing_context("llm_time", timings):
+            vql_query, query_explanation, query_to_vql_tokens, query_fixer_tokens, early_execution_task = await speculative_vql_task
+    else:
+        vql_query, query_explanation, query_to_vql_tokens, query_fixer_tokens, early_execution_task = await generate_vql(
+            request=request,
             vector_search_tables=vector_search_tables,
-            sample_data=sample_data
+            category_response=category_response,
+            timings=timings,
+            session_id=session_id,
+            sample_data=sample_data,
+            auth=auth
         )
+        # Candidates that were generated but were not valid still cost tokens
+        query_to_vql_tokens = add_tokens(query_to_vql_tokens, vql_candidates_tokens)
+
+    if on_event:
+        await on_event("vql", {"sql_query": vql_query, "query_explanation": query_explanation})
 
     max_attempts = 2
     attempt = 0
@@ -52,8 +172,11 @@ async def process_sql_category(request, vector_search_tables, category_response,
             query_explanation=query_explanation,
             query_fixer_tokens=query_fixer_tokens,
             fixer_history=fixer_history,
-            sample_data=sample_data
+            sample_data=sample_data,
+            early_execution_task=early_execution_task,
+            result_format=execution_format
         )
+        early_execution_task = None
         
         if vql_query == 'OK':
             vql_query = original_vql_query
@@ -68,17 +191,63 @@ async def process_sql_category(request, vector_search_tables, category_response,
             execution_result, vql_status_code, timings = await execute_query(
                 vql_query=vql_query, 
                 auth=auth, 
-                timings=timings
+                timings=timings,
+                result_format=execution_format
             )
         else:
             vql_status_code = 500
             execution_result = "No VQL query was generated."
 
+    if question_cache:
+        # A cached VQL that failed, or had to be fixed, is removed so the next similar question doesn't reuse it
+        if cached_question and (vql_status_code == 500 or vql_query != cached_question['vql']):
+            await asyncio.to_thread(question_cache.invalidate, question_scope, cached_question['vql'])
+        if vql_status_code == 200 and (not cached_question or vql_query != cached_question['vql']):
+            await asyncio.to_thread(
+                question_cache.store,
+                request.question,
+                question_context['embedding'],
+                question_scope,
+                vql_query,
+                query_explanation,
+                vector_search_tables
+            )
+
+    # Results cut at the execution limit get a handle to fetch the rest of the rows with getResultPage, if VDP can page them
+    result_handle = ''
+    result_handles = get_result_handles() if auth else None
+    if result_handles and vql_status_code == 200 and result_row_count(execution_result) >= default_execution_limit() and is_pageable(vql_query):
+        result_handle = await asyncio.to_thread(result_handles.create, vql_query, auth, result_row_count(execution_result))
+
     llm_execution_result = prepare_execution_result(
         execution_result=execution_result, 
         vql_status_code=vql_status_code
     )
 
+    if on_event:
+        await on_event("execution_result", {
+            "sql_query": vql_query,
+            "status_code": vql_status_code,
+            "execution_result": execution_result if vql_status_code == 200 else {},
+            "result_handle": result_handle,
+            "error": execution_result if vql_status_code not in [200, 499] else ''
+        })
+
+    if stream_answer:
+        # The streaming endpoints generate the answer themselves with sdk_ai_tools.stream_view_answer
+        response = prepare_response(
+            vql_query=vql_query, 
+            query_explanation=query_explanation, 
+            tokens=add_tokens(query_to_vql_tokens, query_fixer_tokens), 
+            execution_result=execution_result if vql_status_code == 200 else {}, 
+            vector_search_tables=vector_search_tables, 
+            raw_graph='', 
+            timings=timings
+        )
+        response['llm_execution_result'] = llm_execution_result
+        response['result_handle'] = result_handle
+        return response
+
     raw_graph, data_file, request = handle_plotting(request=request, execution_result=execution_result)
 
     response = prepare_response(
@@ -90,6 +259,7 @@ async def process_sql_category(request, vector_search_tables, category_response,
         raw_graph=raw_graph, 
         timings=timings
     )
+    response['result_handle'] = result_handle
 
     if request.verbose or request.plot:
         response = await enhance_verbose_response(
@@ -105,16 +275,259 @@ async def process_sql_category(request, vector_search_tables, category_response,
         )
 
     if request.disclaimer:
-        response['answer'] += "\n\nDISCLAIMER: This response has been generated based on an LLM's interpretation of the data and may not be accurate."
+        response['answer'] += DISCLAIMER
+
+    if result_format == 'arrow' and response['execution_result']:
+        response['execution_result'] = {'arrow_ipc': columns_to_arrow_ipc(response['execution_result'])}
 
     if os.path.exists(data_file):
         os.remove(data_file)
 
     return response
 
+async def generate_vql(request, vector_search_tables, category_response, timings, session_id = None, sample_data = None, auth = None):
+    """
+    Generates the VQL for the question and reviews it with query_fixer.
+    With EARLY_VQL_EXECUTION and auth, the VQL is executed as soon as query_to_vql streams the closing </vql> tag,
+    while the LLM is still writing the explanation. The execution task is returned if query_fixer kept the VQL as is, otherwise it's cancelled.
+    """
+    early_execution = {}
+
+    def execute_early(vql_query):
+        early_vql_query, error_log, _ = prepare_vql(vql_query, vector_search_tables)
+        if early_vql_query and not error_log:
+            early_execution['vql_query'] = early_vql_query
+            early_execution['task'] = asyncio.create_task(execute_vql(vql=early_vql_query, auth=auth))
+
+    try:
+        with timing_context("llm_time", timings):
+            vql_query, query_explanation, query_to_vql_tokens = await sdk_ai_tools.query_to_vql(
+                query=request.question, 
+                vector_search_tables=vector_search_tables, 
+                llm_provider=request.sql_gen_provider, 
+                llm_model=request.sql_gen_model, 
+                filter_params=category_response,
+                custom_instructions=request.custom_instructions,
+                session_id=session_id,
+                sample_data=sample_data,
+                on_vql=execute_early if EARLY_VQL_EXECUTION and auth else None
+            )
+
+            vql_query, _, query_fixer_tokens = await sdk_ai_tools.query_fixer(
+                question=request.question,
+                query=vql_query, 
+                query_explanation=query_explanation,
+                llm_provider=request.sql_gen_provider, 
+                llm_model=request.sql_gen_model,
+                session_id=session_id,
+                vector_search_tables=vector_search_tables,
+                sample_data=sample_data
+            )
+    except BaseException:
+        if 'task' in early_execution:
+            early_execution['task'].cancel()
+        raise
+
+    early_execution_task = early_execution.get('task')
+    if early_execution_task and early_execution['vql_query'] != vql_query:
+        early_execution_task.cancel()
+        early_execution_task = None
+
+    return vql_query, query_explanation, query_to_vql_tokens, query_fixer_tokens, early_execution_task
+
+async def generate_vql_candidate(request, vector_search_tables, category_response, auth, temperature, session_id = None, sample_data = None):
+    """
+    Generates a VQL candidate, validates it locally and, if it's valid, executes it.
+    Returns the VQL, its explanation, the tokens, the (status code, result) of the execution, or None if it's not valid,
+    and the local validation errors.
+    """
+    try:
+        vql_query, query_explanation, tokens = await sdk_ai_tools.query_to_vql(
+            query=request.question,
+            vector_search_tables=vector_search_tables,
+            llm_provider=request.sql_gen_provider,
+            llm_model=request.sql_gen_model,
+            filter_params=category_response,
+            custom_instructions=request.custom_instructions,
+            session_id=session_id,
+            sample_data=sample_data,
+            temperature=temperature
+        )
+    except Exception as e:
+        logging.warning(f"VQL candidate generation failed: {e}")
+        return '', '', {'input_tokens': 0, 'output_tokens': 0, 'cached_tokens': 0, 'total_tokens': 0}, None, ''
+
+    vql_query, error_log, _ = sdk_ai_tools.prepare_and_rewrite_vql(vql_query, vector_search_tables)
+    if error_log or not vql_query:
+        logging.info(f"VQL candidate discarded: {error_log or 'no VQL was generated'}")
+        return vql_query, query_explanation, tokens, None, error_log
+
+    return vql_query, query_explanation, tokens, await execute_vql(vql=vql_query, auth=auth), 
+
+def update_candidate_token_estimate(candidate_tokens, weight = 0.2):
+    """Moving average of the tokens of the candidates. Failed generations, which report no tokens, are left out."""
+    if not candidate_tokens.get('total_tokens'):
+        return
+    for key in candidate_token_estimate:
+        previous = candidate_token_estimate[key]
+        candidate_token_estimate[key] = round(candidate_tokens.get(key, 0) if not previous else (1 - weight) * previous + weight * candidate_tokens.get(key, 0))
+
+async def generate_vql_candidates(request, vector_search_tables, category_response, auth, timings, session_id = None, sample_data = None):
+    """
+    Generates VQL_CANDIDATES queries concurrently (the first one with temperature 0 and the rest with VQL_CANDIDATES_TEMPERATURE),
+    and executes the ones that pass local validation as soon as they are generated. The first candidate that returns rows wins,
+    and the rest are cancelled. If none returns rows, the best one (an empty result over an error) is chosen.
+
+    With VQL_CANDIDATES_MAX_TOKENS, only as many candidates as fit in it by the average tokens of the previous candidates
+    are launched (a single one until a candidate has finished in this process), and the ones still running are cancelled
+    once the finished ones reach it. Cancelled candidates are counted with the input tokens of their prompt.
+
+    Returns the chosen candidate (VQL, explanation, and a finished task with its execution, to be used by attempt_query_execution)
+    or None if there's no valid candidate, the invalid candidate (VQL, explanation) with the fewest local validation errors
+    to fix with query_fixer when there's no valid one, and the tokens used by all the candidates.
+    """
+    candidates = VQL_CANDIDATES
+    if VQL_CANDIDATES_MAX_TOKENS:
+        estimate = candidate_token_estimate['total_tokens']
+        candidates = min(VQL_CANDIDATES, max(1, VQL_CANDIDATES_MAX_TOKENS // estimate)) if estimate else 1
+    temperatures = [0] + [VQL_CANDIDATES_TEMPERATURE] * (candidates - 1)
+    tasks = [
+        asyncio.create_task(generate_vql_candidate(
+            request=request,
+            vector_search_tables=vector_search_tables,
+            category_response=category_response,
+            auth=auth,
+            temperature=temperature,
+            session_id=session_id,
+            sample_data=sample_data
+        ))
+        for temperature in temperatures
+    ]
+
+    tokens = {'input_tokens': 0, 'output_tokens': 0, 'cached_tokens': 0, 'total_tokens': 0}
+    best_candidate, best_invalid_candidate, fewest_errors = None, None, None
+    try:
+        with timing_context("vql_candidates_time", timings):
+            for next_candidate in asyncio.as_completed(tasks):
+                vql_query, query_explanation, candidate_tokens, execution, error_log = await next_candidate
+                tokens = add_tokens(tokens, candidate_tokens)
+                update_candidate_token_estimate(candidate_tokens)
+
+                if execution is None and vql_query:
+                    errors = len(error_log.strip().splitlines())
+                    if fewest_errors is None or errors < fewest_errors:
+                        best_invalid_candidate, fewest_errors = (vql_query, query_explanation), errors
+
+                if execution is not None:
+                    status_code = execution[0]
+                    if best_candidate is None or status_code == 200 or (status_code == 499 and best_candidate[2][0] != 499):
+                        best_candidate = (vql_query, query_explanation, execution)
+                    if status_code == 200:
+                        break
+
+                if VQL_CANDIDATES_MAX_TOKENS and tokens['total_tokens'] >= VQL_CANDIDATES_MAX_TOKENS:
+                    logging.info(f"VQL candidates reached the limit of {VQL_CANDIDATES_MAX_TOKENS} tokens, cancelling the rest")
+                    break
+    finally:
+        cancelled = sum(1 for task in tasks if not task.done())
+        for task in tasks:
+            task.cancel()
+
+    # The prompt of a cancelled candidate was already sent, so its input tokens are spent
+    if cancelled and candidate_token_estimate['input_tokens']:
+        cancelled_tokens = cancelled * candidate_token_estimate['input_tokens']
+        tokens = add_tokens(tokens, {'input_tokens': cancelled_tokens, 'total_tokens': cancelled_tokens})
+
+    if best_candidate is None:
+        return None, best_invalid_candidate, tokens
+
+    vql_query, query_explanation, execution = best_candidate
+    execution_task = asyncio.get_running_loop().create_future()
+    execution_task.set_result(execution)
+    return (vql_query, query_explanation, execution_task), None, tokens
+
+async def stream_answer_events(request, response, vector_search_tables, timings, emit, session_id = None, sample_data = None):
+    """
+    Streams the answer of a question processed with process_sql_category(stream_answer = True) as answer events,
+    generating the related questions at the same time. Returns the response completed with the answer and related questions.
+    """
+    with timing_context("llm_time", timings):
+        related_questions_task = asyncio.create_task(sdk_ai_tools.related_questions(
+            question=request.question,
+            sql_query=response['sql_query'],
+            execution_result=response['llm_execution_result'],
+            vector_search_tables=vector_search_tables,
+            llm_provider=request.chat_provider,
+            llm_model=request.chat_model,
+            custom_instructions=request.custom_instructions,
+            session_id=session_id,
+            sample_data=sample_data
+        ))
+
+        answer_tokens = TokenCounter()
+        answer = ''
+        async for text in sdk_ai_tools.stream_view_answer(
+            query=request.question,
+            vql_query=response['sql_query'],
+            vql_execution_result=response['llm_execution_result'],
+            llm_provider=request.chat_provider,
+            llm_model=request.chat_model,
+            vector_search_tables=vector_search_tables,
+            markdown_response=request.markdown_response,
+            custom_instructions=request.custom_instructions,
+            session_id=session_id,
+            token_counter=answer_tokens
+        ):
+            answer += text
+            await emit("answer", {"text": text})
+
+        if request.disclaimer:
+            answer += DISCLAIMER
+            await emit("answer", {"text": DISCLAIMER})
+
+        related_questions, related_questions_tokens = await related_questions_task
+        await emit("related_questions", {"related_questions": related_questions})
+
+    response['answer'] = answer
+    response['related_questions'] = related_questions
+    response['tokens'] = add_tokens(add_tokens(response['tokens'], answer_tokens.tokens), related_questions_tokens)
+    response['llm_time'] = timings.get('llm_time', 0)
+    response['total_execution_time'] = round(sum(timings.values()), 2)
+    return response
+
+async def sse_event_stream(pipeline):
+    """
+    Runs pipeline(emit) in the background and yields every event it emits as a server-sent event, as soon as it is emitted.
+    Errors are sent as an error event, since the response has already started when they happen.
+    """
+    queue = asyncio.Queue()
+
+    async def emit(event, data):
+        await queue.put(format_sse_event(event, data))
+
+    async def run():
+        try:
+            await pipeline(emit)
+        except Exception as e:
+            logging.error(f"Error in event stream: {traceback.format_exc()}")
+            await emit("error", {"error": str(e)})
+        finally:
+            await queue.put(None)
+
+    task = asyncio.create_task(run())
+    try:
+        while True:
+            event = await queue.get()
+            if event is None:
+                break
+            yield event
+    finally:
+        if not task.done():
+            task.cancel()
+
 def process_metadata_category(category_response, category_related_questions, disclaimer, vector_search_tables, timings, tokens):
     if disclaimer:
-        category_response += "\n\nDISCLAIMER: This response has been generated based on an LLM's interpretation of the data and may not be accurate."
+        category_response += DISCLAIMER
     return {
         'answer': category_response,
         'sql_query': '',
@@ -137,7 +550,7 @@ def process_unknown_category(timings):
         'answer': ERROR_MESSAGE,
         'sql_query': '',
         'query_explanation': '',
-        'tokens': {'input_tokens': 0, 'output_tokens': 0, 'total_tokens': 0},
+        'tokens': {'input_tokens': 0, 'output_tokens': 0, 'cached_tokens': 0, 'total_tokens': 0},
         'related_questions': [],
         'execution_result': {},
         'tables_used': '',
@@ -148,12 +561,14 @@ def process_unknown_category(timings):
         'total_execution_time': round(sum(timings.values()), 2) if timings else 0
     }
 
-async def attempt_query_execution(vql_query, request, auth, timings, vector_search_tables, session_id, query_explanation, query_fixer_tokens=None, fixer_history=[], sample_data=None):
+async def attempt_query_execution(vql_query, request, auth, timings, vector_search_tables, session_id, query_explanation, query_fixer_tokens=None, fixer_history=[], sample_data=None, early_execution_task=None, result_format='rows'):
     if vql_query:
         execution_result, vql_status_code, timings = await execute_query(
             vql_query=vql_query, 
             auth=auth, 
-            timings=timings
+            timings=timings,
+            early_execution_task=early_execution_task,
+            result_format=result_format
         )
     else:
         vql_status_code = 500
@@ -166,18 +581,15 @@ async def attempt_query_execution(vql_query, request, auth, timings, vector_sear
         with timing_context("llm_time", timings):
             escape_execution_result = execution_result.replace("{", "{{").replace("}", "}}")
             fixer_history.append(('human', f'Your response resulted in the following error {vql_status_code}: {escape_execution_result}'))
-            llm = UniformLLM(request.sql_gen_provider, request.sql_gen_model)
+            llm = get_llm(request.sql_gen_provider, request.sql_gen_model)
+            token_counter = TokenCounter()
             prompt = ChatPromptTemplate.from_messages(fixer_history)
             chain = prompt | llm.llm | StrOutputParser()
-            response = await chain.ainvoke({}, config = {
-            "callbacks": add_langfuse_callback(llm.callback, f"{llm.provider_name}.{llm.model_name}", session_id),
-            "run_name": "fixer_dialogue",
-        }
-)
+            response = await chain.ainvoke({}, config = llm.get_run_config("fixer_dialogue", token_counter, session_id))
         vql_query = custom_tag_parser(response, 'vql', default='')[0].strip()
         fixer_history.append(('ai', response))
-        query_fixer_tokens = add_tokens(query_fixer_tokens or {'input_tokens': 0, 'output_tokens': 0, 'total_tokens': 0}, 
-                                    llm.tokens)
+        query_fixer_tokens = add_tokens(query_fixer_tokens or {'input_tokens': 0, 'output_tokens': 0, 'cached_tokens': 0, 'total_tokens': 0}, 
+                                    token_counter.tokens)
     else:
         if vql_status_code == 500:
             with timing_context("llm_time", timings):
@@ -206,24 +618,34 @@ async def attempt_query_execution(vql_query, request, auth, timings, vector_sear
                     sample_data=sample_data
                 )
             
-            query_fixer_tokens = add_tokens(query_fixer_tokens or {'input_tokens': 0, 'output_tokens': 0, 'total_tokens': 0}, 
+            query_fixer_tokens = add_tokens(query_fixer_tokens or {'input_tokens': 0, 'output_tokens': 0, 'cached_tokens': 0, 'total_tokens': 0}, 
                                         query_reviewer_tokens)
             
     return vql_query, execution_result, vql_status_code, timings, fixer_history, query_fixer_tokens
 
-async def execute_query(vql_query, auth, timings):
-    with timing_context("vql_execution_time", timings):
-        if vql_query:
-            vql_status_code, execution_result = await execute_vql(vql=vql_query, auth=auth)
-        else:
-            vql_status_code = 499
-            execution_result = "No VQL query was generated."
+async def execute_query(vql_query, auth, timings, early_execution_task=None, result_format='rows'):
+    # execute_vql records vql_execution_time, or vql_cache_hit_time when the result comes from the VQL result cache
+    if vql_query and early_execution_task:
+        # Only the time still spent waiting for the early execution is added to the execution time
+        with timing_context("vql_execution_time", timings):
+            vql_status_code, execution_result = await early_execution_task
+        if vql_status_code == 200:
+            execution_result = to_result_format(execution_result, result_format)
+    elif vql_query:
+        vql_status_code, execution_result = await execute_vql(vql=vql_query, auth=auth, timings=timings, result_format=result_format)
+    else:
+        vql_status_code = 499
+        execution_result = "No VQL query was generated."
     return execution_result, vql_status_code, timings
 
 def prepare_execution_result(execution_result, vql_status_code):
-    if vql_status_code == 200 and isinstance(execution_result, dict) and len(execution_result) > 15:
-        llm_execution_result = dict(list(execution_result.items())[:15])
-        llm_execution_result = str(llm_execution_result) + "... Showing only the first 15 rows of the execution result."
+    """Execution result as given to the answer and related questions prompts: a compact table, or the error as is."""
+    if vql_status_code == 200 and isinstance(execution_result, dict):
+        llm_execution_result = encode_execution_result(
+            execution_result,
+            token_budget = LLM_RESULT_TOKEN_BUDGET,
+            max_rows = LLM_RESULT_MAX_ROWS
+        )
     else:
         llm_execution_result = str(execution_result)
     return llm_execution_result
@@ -235,8 +657,9 @@ def handle_plotting(request, execution_result):
     if is_data_complex(execution_result):
         random_id = ''.join(random.choices(string.ascii_letters + string.digits, k=4))
         data_file = f'data_{random_id}.json'
+        # The visualization prompt describes the data file in the rows format
         with open(data_file, 'w') as f:
-            json.dump(execution_result, f)
+            json.dump(to_result_format(execution_result, 'rows'), f)
     else:
         data_file = ''
         request.plot = False
@@ -256,7 +679,7 @@ def prepare_response(vql_query, query_explanation, tokens, execution_result, vec
         "execution_result": execution_result,
         "tables_used": [table['view_name'] for table in vector_search_tables],
         "raw_graph": raw_graph,
-        "sql_execution_time": timings.get("vql_execution_time", 0),
+        "sql_execution_time": round(timings.get("vql_execution_time", 0) + timings.get("vql_cache_hit_time", 0), 2),
         "vector_store_search_time": timings.get("vector_store_search_time", 0),
         "llm_time": timings.get("llm_time", 0),
         "total_execution_time": round(sum(timings.values()), 2)
@@ -270,7 +693,7 @@ async def enhance_verbose_response(request, response, vql_query, llm_execution_r
             graph_task = sdk_ai_tools.graph_generator(
                 query=request.question,
                 data_file=data_file,
-                execution_result=response['execution_result'],
+                execution_result=to_result_format(response['execution_result'], 'rows'),
                 llm_provider=request.sql_gen_provider,
                 llm_model=request.sql_gen_model,
                 details=request.plot_details,
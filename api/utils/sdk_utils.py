@@ -1,6 +1,6 @@
 import os
-import re
 import sys
+import json
 import random
 import inspect
 import uvicorn
@@ -12,9 +12,14 @@ import traceback
 from time import time
 from fastapi import HTTPException
 from contextlib import contextmanager
+from utils.vqlParser import validate_vql
+from utils.vqlRewriter import rename_protected_aliases
+from utils.utils import get_view_fragment
+
+VQL_SCHEMA_VALIDATION = os.getenv('VQL_SCHEMA_VALIDATION', '1') == '1'
 
 def add_tokens(token_set1, token_set2):
-    return {key: token_set1[key] + token_set2[key] for key in token_set1}
+    return {key: token_set1.get(key, 0) + token_set2.get(key, 0) for key in {**token_set1, **token_set2}}
 
 def generate_session_id(question):
     question_prefix = ''.join(c for c in question[:20] if c.isalpha() or c.isspace())
@@ -38,52 +43,27 @@ def readable_tables(relevant_tables):
     readable_output = ""
 
     for table in relevant_tables:
-        table_schema = table['view_json']['schema']
-        table_columns = [column['columnName'] for column in table_schema]
-        readable_output += f'<table>Table {table["view_name"]} with columns {", ".join(table_columns)}\n</table>\n'
+        readable_output += get_view_fragment(table)['readable']
     
     return readable_output
 
 def is_data_complex(data):
+    if isinstance(data, dict) and 'columns' in data and 'data' in data:
+        return data['row_count'] > 3 and len(data['columns']) > 1
     if isinstance(data, dict) and len(data) > 3:
         if len(data['Row 1']) > 1:
             return True 
     return False
 
-def match_nested_parentheses(text):
-    def find_closing_paren(s, start):
-        count = 0
-        for i, c in enumerate(s[start:], start):
-            if c == '(':
-                count += 1
-            elif c == ')':
-                count -= 1
-                if count == 0:
-                    return i
-        return -1
-
-    matches = []
-    start = 0
-    while True:
-        start = text.find('(', start)
-        if start == -1:
-            break
-        end = find_closing_paren(text, start)
-        if end == -1:
-            break
-        matches.append(text[start:end+1])
-        start = end + 1
-
-    return matches
-
 # Prepare VQL
-def prepare_vql(vql):    
+def prepare_vql(vql, vector_search_tables = None):
+    """
+    Fixes the LLM's formatting of the VQL and validates it locally. Returns the VQL, the error log (or False) and the error categories.
+    With vector_search_tables, the tables and columns of the query are also checked against their schemas.
+    """
     error_log = ''
     error_categories = []
 
-    # Convert VQL to single line for regex processing
-    vql_single_line = vql.replace('\n', ' ')
-
     # Look for LLM code styling
     if '```' in vql:
         logging.info("Backward ticks detected in VQL, fixing...")
@@ -93,85 +73,15 @@ def prepare_vql(vql):
         logging.info("Markdown underscore detected in VQL, fixing...")
         vql = vql.replace('\\_', '_')
     
-    # Protected words for aliases
-    protected_words = (
-        'ADD|ALL|ALTER|AND|ANY|AS|ASC|BASE|BOTH|CASE|CONNECT|CONTEXT|CREATE|CROSS|'
-        'CURRENT_DATE|CURRENT_TIMESTAMP|CUSTOM|DATABASE|DEFAULT|DESC|DF|DISTINCT|DROP|'
-        'EXISTS|FALSE|FETCH|FLATTEN|FROM|FULL|GRANT|GROUP BY|HASH|HAVING|HTML|IF|INNER|'
-        'INTERSECT|INTO|IS|JDBC|JOIN|LDAP|LEADING|LEFT|LIMIT|LOCALTIME|LOCALTIMESTAMP|'
-        'MERGE|MINUS|MY|NATURAL|NESTED|NOS|NOT|NULL|OBL|ODBC|OF|OFF|OFFSET|ON|ONE|OPT|'
-        'OR|ORDER BY|ORDERED|PRIVILEGES|READ|REVERSEORDER|REVOKE|RIGHT|ROW|SELECT|SWAP|'
-        'TABLE|TO|TRACE|TRAILING|TRUE|UNION|USER|USING|VIEW|WHEN|WHERE|WITH|WRITE|WS|ZERO'
-    )
-    
-    # Pattern to match protected words used as aliases
-    pattern = fr'\s+AS\s+({protected_words})\s+'
-    matches = re.finditer(pattern, vql_single_line, re.IGNORECASE)
-    
-    # Track all replacements
-    replacements = {}
-    for match in matches:
-        protected_word = match.group(1)
-        new_alias = f"{protected_word}_"
-        replacements[protected_word] = new_alias
-        logging.info(f"Protected word '{protected_word}' used as alias, appending underscore")
-        
-    # Apply replacements
-    modified_vql = vql
-    for old_word, new_word in replacements.items():
-        # Pattern to match the exact alias after AS
-        replace_pattern = fr'(\s+AS\s+){old_word}(\s+)'
-        modified_vql = re.sub(replace_pattern, fr'\1{new_word}\2', modified_vql, flags=re.IGNORECASE)
-    
-    vql = modified_vql
-    
-    # Look for forbidden functions
-    forbidden_functions = [
-        'LENGTH',
-        'CHAR_LENGTH',
-        'CHARACTER_LENGTH',
-        'CURRENT_TIME',
-        'DIVIDE',
-        'MULTIPLY',
-        'DATE',
-        'STRFTIME',
-        'SUBSTRING',
-        'DATE_SUB',
-        'DATE_ADD',
-        'DATE_TRUNC',
-        'INTERVAL',
-        'ADDDATE',
-        'TO_CHAR',
-        'LPAD',
-        'STRING_AGG',
-        'ARRAY_AGG',
-    ]
-
-    for forbidden_function in forbidden_functions:
-        if f" {forbidden_function} " in vql.upper() or f" {forbidden_function} ( " in vql.upper() or f" {forbidden_function}(" in vql.upper() or f"({forbidden_function}(" in vql.upper():
-            error_log += f"{forbidden_function} is not permitted in VQL.\n"
-            if "FORBIDDEN_FUNCTION" not in error_categories:
-                #error_categories.append('FORBIDDEN_FUNCTION')
-                continue
+    # Protected words used as aliases
+    vql, _ = rename_protected_aliases(vql)
 
-    # Look for LIMIT in subquery
-    matches = match_nested_parentheses(vql_single_line)
-    
-    for match in matches:
-        if ' LIMIT ' in match:
-            error_log += "There is a LIMIT in subquery, which is not permitted in VQL. Use ROW_NUMBER () instead.\n"
-            if "LIMIT_SUBQUERY" not in error_categories:
-                error_categories.append('LIMIT_SUBQUERY')
-        
-        if ' FETCH ' in match:
-            error_log += "There is a FETCH in subquery, which is not permitted in VQL. Use ROW_NUMBER () instead.\n"
-            if "LIMIT_SUBQUERY" not in error_categories:
-                error_categories.append('LIMIT_SUBQUERY')
-
-    if " OFFSET " in vql_single_line:
-        error_log += "There is a LIMIT OFFSET in the main query, which is not permitted in VQL. Use ROW_NUMBER () instead.\n"
-        if "LIMIT_OFFSET" not in error_categories:
-            error_categories.append('LIMIT_OFFSET')
+    # Parse the query locally to catch errors before sending it to the Data Catalog
+    diagnostics = validate_vql(vql, vector_search_tables if VQL_SCHEMA_VALIDATION else None)
+    for diagnostic in diagnostics:
+        error_log += f"{diagnostic.message}\n"
+        if diagnostic.category in ('LIMIT_SUBQUERY', 'LIMIT_OFFSET') and diagnostic.category not in error_categories:
+            error_categories.append(diagnostic.category)
 
     if error_log == "":
         error_log = False
@@ -179,6 +89,15 @@ def prepare_vql(vql):
     logging.info(f"prepare_vql vql: {vql} error log: {error_log} and categories: {error_categories}")
     return vql.strip(), error_log, error_categories
 
+def get_prompt_parts(filter_params):
+    """Returns which optional VQL rule sets the category's filter hints ask for."""
+    return {
+        "having": int("<having>" in filter_params),
+        "groupby": int("<orderby>" in filter_params or "<groupby>" in filter_params),
+        "dates": int("<dates>" in filter_params),
+        "arithmetic": int("<arithmetic>" in filter_params)
+    }
+
 def generate_vql_restrictions(prompt_parts, vql_rules_prompt, groupby_vql_prompt, having_vql_prompt, dates_vql_prompt, arithmetic_vql_prompt):
     if prompt_parts is None:
         return vql_rules_prompt.replace("{EXTRA_RESTRICTIONS}", "")
@@ -193,6 +112,10 @@ def generate_vql_restrictions(prompt_parts, vql_rules_prompt, groupby_vql_prompt
     extra_restrictions = '\n'.join(vql_prompt_parts[key] for key in vql_prompt_parts if prompt_parts.get(key))
     return vql_rules_prompt.replace("{EXTRA_RESTRICTIONS}", extra_restrictions)
 
+def format_sse_event(event, data):
+    """Formats a server-sent event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data, default = str)}\n\n"
+
 def get_response_format(markdown_response):
     if markdown_response:
         response_format = """
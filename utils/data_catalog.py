@@ -10,12 +10,19 @@
 """
 
 import os
+import re
 import json
 import base64
+import hashlib
 import logging
 import requests
 import aiohttp
 import asyncio
+import threading
+
+from time import time
+from collections import OrderedDict
+from utils import vdpFlightSql
 from utils.utils import timed, log_params
 
 DATA_CATALOG_URL = os.getenv('DATA_CATALOG_URL', 'http://localhost:9090/denodo-data-catalog').rstrip('/') + '/'    
@@ -26,6 +33,71 @@ DATA_CATALOG_EXECUTION_URL = f"{DATA_CATALOG_URL}public/api/askaquestion/execute
 DATA_CATALOG_PERMISSIONS_URL = f"{DATA_CATALOG_URL}public/api/views/allowed-identifiers"
 
 EXECUTE_VQL_LIMIT = 100
+VQL_EXECUTION_BACKEND = os.getenv('VQL_EXECUTION_BACKEND', 'data_catalog')
+VDP_FLIGHT_SQL_LIMIT = int(os.getenv('VDP_FLIGHT_SQL_LIMIT', EXECUTE_VQL_LIMIT))
+
+VQL_RESULT_CACHE = os.getenv('VQL_RESULT_CACHE', '0') == '1'
+VQL_RESULT_CACHE_TTL = int(os.getenv('VQL_RESULT_CACHE_TTL', 60))
+VQL_RESULT_CACHE_MAX_BYTES = int(os.getenv('VQL_RESULT_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+class VQLResultCache:
+    """
+    In-process LRU cache of VQL execution results, bounded by the approximate size of the cached results in bytes.
+    Keys combine the normalized VQL with a hash of the caller's credentials, so results are never shared
+    between principals. Cached results are shared between callers and must be treated as read-only.
+    """
+    def __init__(self, max_bytes = VQL_RESULT_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def normalize_vql(vql):
+        # Collapse whitespace outside of quoted literals and identifiers, and drop the trailing semicolon
+        parts = re.split(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""", vql.strip().rstrip(';').strip())
+        return ''.join(part if i % 2 else re.sub(r'\s+', ' ', part) for i, part in enumerate(parts))
+
+    @staticmethod
+    def make_key(vql, authorization, limit, server_id, result_format = 'rows'):
+        principal_hash = hashlib.sha256(authorization.encode('utf-8')).hexdigest()
+        return hashlib.sha256(
+            f"{server_id}\x00{limit}\x00{result_format}\x00{principal_hash}\x00{VQLResultCache.normalize_vql(vql)}".encode('utf-8')
+        ).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, size, value = entry
+            if expires_at <= time():
+                del self.entries[key]
+                self.current_bytes -= size
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl = VQL_RESULT_CACHE_TTL):
+        size = len(json.dumps(value, default = str))
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.current_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (time() + ttl, size, value)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self.entries.popitem(last = False)
+                self.current_bytes -= evicted_size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+
+vql_result_cache = VQLResultCache()
 
 @timed
 def get_views_metadata_documents(
@@ -196,23 +268,36 @@ def get_views_metadata_documents(
         raise
 
 @timed
-async def execute_vql(vql, auth, limit=EXECUTE_VQL_LIMIT, execution_url=DATA_CATALOG_EXECUTION_URL, 
-                server_id=DATA_CATALOG_SERVER_ID, verify_ssl=DATA_CATALOG_VERIFY_SSL):
+async def execute_vql(vql, auth, limit=None, execution_url=DATA_CATALOG_EXECUTION_URL, 
+                server_id=DATA_CATALOG_SERVER_ID, verify_ssl=DATA_CATALOG_VERIFY_SSL,
+                use_cache=True, cache_ttl=VQL_RESULT_CACHE_TTL, timings=None, result_format='rows',
+                backend=VQL_EXECUTION_BACKEND, zero_result_check=True):
     """
     Execute VQL against Data Catalog with support for OAuth token or Basic auth.
+    With the flight_sql backend, the VQL is executed directly in VDP over Arrow Flight SQL instead.
     
     Args:
         vql: VQL query to execute
         auth: Either (username, password) tuple for basic auth or OAuth token string
-        limit: Maximum number of rows to return
+        limit: Maximum number of rows to return. Defaults to EXECUTE_VQL_LIMIT, or VDP_FLIGHT_SQL_LIMIT with the flight_sql backend
         execution_url: Data Catalog execution endpoint
         server_id: Server identifier
         verify_ssl: Whether to verify SSL certificates
+        use_cache: Whether to use the VQL result cache (only if enabled with VQL_RESULT_CACHE)
+        cache_ttl: Seconds the result of this query stays in the cache
+        timings: Optional timings dict. Records vql_cache_hit_time on cache hits and vql_execution_time otherwise
+        result_format: 'rows' for the {'Row N': [{'columnName', 'value'}]} result of parse_execution_json,
+            'columnar' for the result of parse_execution_columns
+        backend: 'data_catalog' (the askaquestion/execute endpoint) or 'flight_sql'
+        zero_result_check: Whether a single row with a single value of 0 or null is returned as an empty result (499),
+            like the answers treat it. Results with no rows are always returned as 499
         
     Returns:
         Status code and parsed response or error message
     """
-    logging.info("Preparing execution request")
+    start_time = time()
+    if limit is None:
+        limit = default_execution_limit(backend)
         
     # Prepare headers based on auth type
     headers = {'Content-Type': 'application/json'}
@@ -221,6 +306,52 @@ async def execute_vql(vql, auth, limit=EXECUTE_VQL_LIMIT, execution_url=DATA_CAT
     else:
         headers['Authorization'] = f'Bearer {auth}'
 
+    cache_key = None
+    if VQL_RESULT_CACHE and use_cache:
+        # The same result can be 200 or 499 depending on zero_result_check, so it's part of the key
+        cache_key = VQLResultCache.make_key(vql, headers['Authorization'], limit, f"{backend}:{server_id}", result_format if zero_result_check else f"{result_format}:all_rows")
+        cached_result = vql_result_cache.get(cache_key)
+        if cached_result is not None:
+            logging.info("VQL result served from cache")
+            _add_timing(timings, "vql_cache_hit_time", time() - start_time)
+            return cached_result
+
+    if backend == 'flight_sql':
+        status_code, result = await _execute_vql_flight_sql(vql, auth, limit, result_format, zero_result_check)
+    else:
+        status_code, result = await _execute_vql_request(vql, headers, limit, execution_url, server_id, verify_ssl, result_format, zero_result_check)
+
+    # Only successful executions (including empty results) are cached, never errors
+    if cache_key is not None and status_code in [200, 499]:
+        vql_result_cache.set(cache_key, (status_code, result), ttl = cache_ttl)
+
+    _add_timing(timings, "vql_execution_time", time() - start_time)
+    return status_code, result
+
+def _add_timing(timings, name, elapsed_time):
+    if timings is not None:
+        timings[name] = timings.get(name, 0) + elapsed_time
+
+async def _execute_vql_flight_sql(vql, auth, limit, result_format = 'rows', zero_result_check = True):
+    logging.info("Executing VQL over Flight SQL")
+
+    status_code, result = await asyncio.to_thread(vdpFlightSql.execute, vql, auth, limit)
+    if status_code != 200:
+        return status_code, result
+
+    # Same empty result checks as the Data Catalog execution
+    if not result['row_count']:
+        logging.info("Query returned no results.")
+        return 499, "Query executed succesfully but returned an empty result (no rows)."
+    elif zero_result_check and result['row_count'] == 1 and len(result['columns']) == 1 and (str(result['data'][0][0]) == '0' or result['data'][0][0] is None):
+        logging.info("Query returned only one row, one column with a value of 0 or null")
+        return 499, f"Query executed succesfully but returned a single row with a value of 0 or null: {columns_to_rows(result)}"
+    logging.info("Query executed successfully")
+    return 200, result if result_format == 'columnar' else columns_to_rows(result)
+
+async def _execute_vql_request(vql, headers, limit, execution_url, server_id, verify_ssl, result_format = 'rows', zero_result_check = True):
+    logging.info("Preparing execution request")
+
     data = {
         "vql": vql,
         "limit": limit
@@ -241,13 +372,16 @@ async def execute_vql(vql, auth, limit=EXECUTE_VQL_LIMIT, execution_url=DATA_CAT
                 if not json_response.get('rows'):
                     logging.info("Query returned no results.")
                     return 499, "Query executed succesfully but returned an empty result (no rows)."
-                elif (len(json_response['rows']) == 1 and  # Single row
+                elif (zero_result_check and
+                    len(json_response['rows']) == 1 and  # Single row
                     len(json_response['rows'][0]['values']) == 1 and  # Single column
                     (str(json_response['rows'][0]['values'][0]['value']) == '0' or  # Value is 0
                      json_response['rows'][0]['values'][0]['value'] is None)):  # Value is null/None
                     logging.info("Query returned only one row, one column with a value of 0 or null")
                     return 499, f"Query executed succesfully but returned a single row with a value of 0 or null: {parse_execution_json(json_response)}"
                 logging.info("Query executed successfully")
+                if result_format == 'columnar':
+                    return response.status, parse_execution_columns(json_response)
                 return response.status, parse_execution_json(json_response)
     except aiohttp.ClientResponseError as e:
         try:
@@ -460,4 +594,82 @@ def parse_execution_json(json_response):
                 'value': value['value']
             })
 
-    return parsed_data
\ No newline at end of file
+    return parsed_data
+
+# Columnar version of parse_execution_json: the column names once and an array of values per column
+def parse_execution_columns(json_response):
+    columns = [value['column'] for value in json_response['rows'][0]['values']] if json_response['rows'] else []
+    data = [[] for _ in columns]
+
+    for row in json_response['rows']:
+        for position, value in enumerate(row['values'][:len(columns)]):
+            data[position].append(value['value'])
+
+    return {
+        'columns': columns,
+        'types': [column_type(values) for values in data],
+        'data': data,
+        'row_count': len(json_response['rows'])
+    }
+
+def column_type(values):
+    """JSON type of the non-null values of a column: number, boolean, string or null if they are all null."""
+    present = [value for value in values if value is not None]
+    if not present:
+        return 'null'
+    if all(isinstance(value, bool) for value in present):
+        return 'boolean'
+    if all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in present):
+        return 'number'
+    return 'string'
+
+def result_row_count(execution_result):
+    if is_columnar(execution_result):
+        return execution_result['row_count']
+    return len(execution_result) if isinstance(execution_result, dict) else 0
+
+def default_execution_limit(backend = VQL_EXECUTION_BACKEND):
+    """Rows returned by execute_vql when no limit is given."""
+    return VDP_FLIGHT_SQL_LIMIT if backend == 'flight_sql' else EXECUTE_VQL_LIMIT
+
+def is_columnar(execution_result):
+    return isinstance(execution_result, dict) and 'columns' in execution_result and 'data' in execution_result
+
+def rows_to_columns(execution_result):
+    """Converts a parse_execution_json result to the format of parse_execution_columns."""
+    rows = list(execution_result.values())
+    return parse_execution_columns({
+        'rows': [{'values': [{'column': cell['columnName'], 'value': cell['value']} for cell in row]} for row in rows]
+    })
+
+def columns_to_rows(execution_result):
+    """Converts a parse_execution_columns result to the format of parse_execution_json."""
+    columns = execution_result['columns']
+    return {
+        f'Row {i + 1}': [{'columnName': column, 'value': value} for column, value in zip(columns, values)]
+        for i, values in enumerate(zip(*execution_result['data']))
+    }
+
+def to_result_format(execution_result, result_format):
+    """Returns a successful execution result in the given format ('rows' or 'columnar'), converting it if needed."""
+    if not isinstance(execution_result, dict):
+        return execution_result
+    if result_format == 'columnar' and not is_columnar(execution_result):
+        return rows_to_columns(execution_result)
+    if result_format == 'rows' and is_columnar(execution_result):
+        return columns_to_rows(execution_result)
+    return execution_result
+
+def columns_to_arrow_ipc(execution_result):
+    """Arrow IPC stream of a parse_execution_columns result, base64 encoded so it can travel in a JSON response."""
+    import pyarrow as pa
+
+    arrays = [
+        pa.array([None if value is None else str(value) for value in values]) if column_type == 'string' else pa.array(values)
+        for values, column_type in zip(execution_result['data'], execution_result['types'])
+    ]
+    table = pa.Table.from_arrays(arrays, names = execution_result['columns'])
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return base64.b64encode(sink.getvalue().to_pybytes()).decode('ascii')
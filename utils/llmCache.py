@@ -0,0 +1,115 @@
+import os
+import sqlite3
+import hashlib
+import logging
+import threading
+
+from time import time
+from functools import lru_cache
+from langchain_core.caches import BaseCache
+from langchain_core.load import dumps, loads
+
+DEFAULT_CACHED_STAGES = "sql_category,query_to_vql,generate_view_answer"
+
+class SQLiteResponseCache(BaseCache):
+    """
+    Exact-match LLM response cache stored in a local SQLite database.
+    Entries are keyed by a hash of the serialized chat model (provider, model and parameters) and the rendered messages.
+    The database runs in WAL mode, so all the API workers on the same host can share it.
+    """
+    def __init__(self, database_path, ttl = 86400, max_entries = 10000):
+        self.database_path = database_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.local = threading.local()
+
+        directory = os.path.dirname(database_path)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+
+        connection = self._connection()
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS llm_response_cache ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, created_at REAL NOT NULL, expires_at REAL NOT NULL)"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS llm_response_cache_created_at ON llm_response_cache (created_at)")
+        connection.commit()
+
+    def _connection(self):
+        # sqlite3 connections can't be shared between threads, and async lookups run in the default executor
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.database_path, timeout = 30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    @staticmethod
+    def _key(prompt, llm_string):
+        return hashlib.sha256(f"{llm_string}\x00{prompt}".encode("utf-8")).hexdigest()
+
+    def lookup(self, prompt, llm_string):
+        try:
+            row = self._connection().execute(
+                "SELECT response FROM llm_response_cache WHERE key = ? AND expires_at > ?",
+                (self._key(prompt, llm_string), time())
+            ).fetchone()
+            if row is None:
+                return None
+            generations = loads(row[0])
+        except Exception as e:
+            logging.warning(f"LLM response cache lookup failed: {e}")
+            return None
+
+        # A cached response costs no tokens
+        for generation in generations:
+            message = getattr(generation, "message", None)
+            if message is not None and hasattr(message, "usage_metadata"):
+                message.usage_metadata = {"input_tokens": 0, "output_tokens": 0, "total_tokens": 0}
+
+        logging.info("LLM response served from cache")
+        return generations
+
+    def update(self, prompt, llm_string, return_val):
+        now = time()
+        try:
+            connection = self._connection()
+            connection.execute(
+                "INSERT OR REPLACE INTO llm_response_cache (key, response, created_at, expires_at) VALUES (?, ?, ?, ?)",
+                (self._key(prompt, llm_string), dumps(return_val), now, now + self.ttl)
+            )
+            connection.execute("DELETE FROM llm_response_cache WHERE expires_at <= ?", (now,))
+            connection.execute(
+                "DELETE FROM llm_response_cache WHERE key IN "
+                "(SELECT key FROM llm_response_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            connection.commit()
+        except Exception as e:
+            logging.warning(f"LLM response cache update failed: {e}")
+
+    def clear(self, **kwargs):
+        connection = self._connection()
+        connection.execute("DELETE FROM llm_response_cache")
+        connection.commit()
+
+@lru_cache(maxsize=None)
+def get_response_cache():
+    """Returns the process-wide response cache, or None if LLM_RESPONSE_CACHE is not enabled."""
+    if os.getenv("LLM_RESPONSE_CACHE", "0") != "1":
+        return None
+
+    return SQLiteResponseCache(
+        database_path = os.getenv("LLM_RESPONSE_CACHE_PATH", "./cache/llm_responses.db"),
+        ttl = int(os.getenv("LLM_RESPONSE_CACHE_TTL", 86400)),
+        max_entries = int(os.getenv("LLM_RESPONSE_CACHE_MAX_ENTRIES", 10000))
+    )
+
+def use_response_cache(stage):
+    """Checks if the given stage (the name of the LLM tool) has opted in to the response cache."""
+    if get_response_cache() is None:
+        return False
+
+    stages = os.getenv("LLM_RESPONSE_CACHE_STAGES", DEFAULT_CACHED_STAGES)
+    return stage in [cached_stage.strip() for cached_stage in stages.split(',')]
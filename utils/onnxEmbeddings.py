@@ -0,0 +1,104 @@
+import os
+import logging
+import numpy as np
+
+from functools import lru_cache
+from langchain_core.embeddings import Embeddings
+
+@lru_cache(maxsize=None)
+def load_onnx_model(model_path, num_threads, max_length):
+    """
+    Loads the ONNX session and tokenizer for a local sentence embedding model once per process.
+    The model directory must contain a model.onnx file and the tokenizer.json file of the model.
+    """
+    import onnxruntime
+    from tokenizers import Tokenizer
+
+    model_file = os.path.join(model_path, "model.onnx")
+    tokenizer_file = os.path.join(model_path, "tokenizer.json")
+
+    if not os.path.isfile(model_file):
+        raise ValueError(f"ONNX model not found: {model_file}")
+    if not os.path.isfile(tokenizer_file):
+        raise ValueError(f"Tokenizer not found: {tokenizer_file}")
+
+    session_options = onnxruntime.SessionOptions()
+    session_options.intra_op_num_threads = num_threads
+    session_options.inter_op_num_threads = 1
+    session_options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+    session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+    session = onnxruntime.InferenceSession(
+        model_file,
+        sess_options = session_options,
+        providers = ["CPUExecutionProvider"]
+    )
+
+    tokenizer = Tokenizer.from_file(tokenizer_file)
+    tokenizer.enable_truncation(max_length = max_length)
+    padding = tokenizer.padding or {}
+    tokenizer.enable_padding(pad_id = padding.get("pad_id", 0), pad_token = padding.get("pad_token", "[PAD]"))
+
+    logging.info(f"Loaded ONNX embeddings model {model_path} with {num_threads} threads")
+    return session, tokenizer
+
+class ONNXEmbeddings(Embeddings):
+    """
+    In-process sentence embeddings running on CPU through ONNX Runtime.
+    Texts are embedded in batches, sorted by length to minimize padding, and the output is L2-normalized.
+    """
+    def __init__(self, model_path, num_threads = None, batch_size = 64, max_length = 512, pooling = "mean"):
+        self.model_path = model_path
+        self.num_threads = num_threads or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.pooling = pooling.lower()
+
+        if self.pooling not in ["mean", "cls"]:
+            raise ValueError(f"Unsupported pooling '{pooling}'. Use 'mean' or 'cls'.")
+
+        self.session, self.tokenizer = load_onnx_model(self.model_path, self.num_threads, self.max_length)
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+
+    def _embed_batch(self, texts):
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([encoding.ids for encoding in encodings], dtype = np.int64)
+        attention_mask = np.array([encoding.attention_mask for encoding in encodings], dtype = np.int64)
+
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            inputs["token_type_ids"] = np.array([encoding.type_ids for encoding in encodings], dtype = np.int64)
+        inputs = {name: value for name, value in inputs.items() if name in self.input_names}
+
+        output = self.session.run(None, inputs)[0]
+
+        # Some exports already return the pooled sentence embedding
+        if output.ndim == 2:
+            embeddings = output
+        elif self.pooling == "cls":
+            embeddings = output[:, 0]
+        else:
+            mask = attention_mask[..., np.newaxis].astype(output.dtype)
+            embeddings = (output * mask).sum(axis = 1) / np.clip(mask.sum(axis = 1), 1e-9, None)
+
+        norms = np.linalg.norm(embeddings, axis = 1, keepdims = True)
+        return embeddings / np.clip(norms, 1e-12, None)
+
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+
+        # Sort by length so each batch pads to a similar size
+        order = sorted(range(len(texts)), key = lambda i: len(texts[i]))
+        embeddings = [None] * len(texts)
+
+        for start in range(0, len(order), self.batch_size):
+            batch_indexes = order[start:start + self.batch_size]
+            batch_embeddings = self._embed_batch([texts[i] for i in batch_indexes])
+            for i, embedding in zip(batch_indexes, batch_embeddings):
+                embeddings[i] = embedding.tolist()
+
+        return embeddings
+
+    def embed_query(self, text):
+        return self._embed_batch([text])[0].tolist()
@@ -0,0 +1,161 @@
+import os
+import json
+import sqlite3
+import hashlib
+import logging
+import threading
+import numpy as np
+
+from time import time
+from uuid import uuid4
+from functools import lru_cache
+from utils.viewContext import ViewContext
+
+def view_fingerprint(view_json):
+    """Hash of the view definition. Associations are left out, as they are filtered by the user's permissions."""
+    definition = {key: value for key, value in view_json.items() if key != 'associations'}
+    return hashlib.sha256(json.dumps(definition, sort_keys = True, default = str).encode("utf-8")).hexdigest()
+
+def scope_hash(valid_view_ids, *params):
+    """Hash of the user's permission scope (the views they can access) plus any parameter that changes the generated VQL."""
+    scope = {"view_ids": sorted(str(view_id) for view_id in valid_view_ids), "params": [str(param) for param in params]}
+    return hashlib.sha256(json.dumps(scope, sort_keys = True).encode("utf-8")).hexdigest()
+
+class QuestionCache:
+    """
+    Semantic cache of validated VQL queries, stored in a local SQLite database shared by the workers on the same host.
+    Each entry holds the question embedding, the VQL that executed successfully and the fingerprints of the views it reads.
+    A new question reuses the VQL of the most similar cached question in the same permission scope, as long as the
+    similarity is above the threshold and none of the views have changed since the VQL was validated.
+    """
+    def __init__(self, database_path, threshold = 0.95, ttl = 604800, max_entries = 2000):
+        self.database_path = database_path
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.local = threading.local()
+
+        directory = os.path.dirname(database_path)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+
+        connection = self._connection()
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS question_cache ("
+            "id TEXT PRIMARY KEY, scope TEXT NOT NULL, question TEXT NOT NULL, embedding BLOB NOT NULL, "
+            "vql TEXT NOT NULL, query_explanation TEXT NOT NULL, views TEXT NOT NULL, "
+            "created_at REAL NOT NULL, expires_at REAL NOT NULL)"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS question_cache_scope ON question_cache (scope)")
+        connection.commit()
+
+    def _connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.database_path, timeout = 30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype = np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def lookup(self, embedding, scope, vector_search_tables):
+        """
+        Returns the cached entry (vql, query_explanation, views, similarity) for the closest question, or None.
+        Entries whose views have changed are deleted. Entries reading views that are not among the
+        vector_search_tables of the current question are skipped, as their definition can't be checked.
+        """
+        connection = self._connection()
+        rows = connection.execute(
+            "SELECT id, embedding, vql, query_explanation, views FROM question_cache WHERE scope = ? AND expires_at > ?",
+            (scope, time())
+        ).fetchall()
+        if not rows:
+            return None
+
+        query_vector = self._normalize(embedding)
+        embeddings = np.stack([np.frombuffer(row[1], dtype = np.float32) for row in rows])
+        if embeddings.shape[1] != query_vector.shape[0]:
+            return None
+        similarities = embeddings @ query_vector
+
+        current_views = {table['view_name']: view_fingerprint(table['view_json']) for table in vector_search_tables}
+        stale_ids = []
+        entry = None
+
+        for index in np.argsort(-similarities):
+            if similarities[index] < self.threshold:
+                break
+
+            entry_id, _, vql, query_explanation, views = rows[index]
+            views = json.loads(views)
+            if any(view_name in current_views and current_views[view_name] != fingerprint for view_name, fingerprint in views.items()):
+                stale_ids.append(entry_id)
+                continue
+            if any(view_name not in current_views for view_name in views):
+                continue
+
+            entry = {
+                "vql": vql,
+                "query_explanation": query_explanation,
+                "views": list(views),
+                "similarity": float(similarities[index])
+            }
+            break
+
+        if stale_ids:
+            logging.info(f"Question cache: removing {len(stale_ids)} entries for views that have changed")
+            connection.executemany("DELETE FROM question_cache WHERE id = ?", [(entry_id,) for entry_id in stale_ids])
+            connection.commit()
+
+        return entry
+
+    def store(self, question, embedding, scope, vql, query_explanation, vector_search_tables):
+        """Stores a validated VQL query along with the fingerprints of the views (from vector_search_tables) that it reads."""
+        views = {
+            table['view_name']: view_fingerprint(table['view_json'])
+            for table in ViewContext.of(vector_search_tables).referenced(vql)
+        }
+        if not views:
+            return
+
+        now = time()
+        connection = self._connection()
+        connection.execute(
+            "INSERT INTO question_cache (id, scope, question, embedding, vql, query_explanation, views, created_at, expires_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                str(uuid4()), scope, question, self._normalize(embedding).tobytes(),
+                vql, query_explanation, json.dumps(views), now, now + self.ttl
+            )
+        )
+        connection.execute("DELETE FROM question_cache WHERE expires_at <= ?", (now,))
+        connection.execute(
+            "DELETE FROM question_cache WHERE id IN "
+            "(SELECT id FROM question_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+        connection.commit()
+
+    def invalidate(self, scope, vql):
+        connection = self._connection()
+        connection.execute("DELETE FROM question_cache WHERE scope = ? AND vql = ?", (scope, vql))
+        connection.commit()
+
+@lru_cache(maxsize=None)
+def get_question_cache():
+    """Returns the process-wide question cache, or None if QUESTION_CACHE is not enabled."""
+    if os.getenv("QUESTION_CACHE", "0") != "1":
+        return None
+
+    return QuestionCache(
+        database_path = os.getenv("QUESTION_CACHE_PATH", "./cache/question_cache.db"),
+        threshold = float(os.getenv("QUESTION_CACHE_THRESHOLD", 0.95)),
+        ttl = int(os.getenv("QUESTION_CACHE_TTL", 604800)),
+        max_entries = int(os.getenv("QUESTION_CACHE_MAX_ENTRIES", 2000))
+    )
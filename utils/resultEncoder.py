@@ -0,0 +1,90 @@
+import numpy as np
+
+from utils.utils import calculate_tokens
+
+def result_table(execution_result):
+    """
+    Column names and rows (lists of values) of an execution result,
+    either {'Row N': [{'columnName', 'value'}, ...]} or the columnar {'columns', 'data'} format.
+    """
+    if 'columns' in execution_result and 'data' in execution_result:
+        return list(execution_result['columns']), [list(row) for row in zip(*execution_result['data'])]
+
+    column_names, rows = [], []
+    for row in execution_result.values():
+        values = {}
+        for cell in row:
+            if cell['columnName'] not in values and cell['columnName'] not in column_names:
+                column_names.append(cell['columnName'])
+            values[cell['columnName']] = cell['value']
+        rows.append(values)
+    return column_names, [[values.get(column_name) for column_name in column_names] for values in rows]
+
+def format_value(value):
+    if value is None:
+        return 'null'
+    return str(value).replace('|', '/').replace('\r', ' ').replace('\n', ' ')
+
+def numeric_column(values):
+    """The values as a float array, or None if some non-null value isn't a number."""
+    present = [value for value in values if value is not None and value != '']
+    if not present:
+        return None
+    try:
+        return np.asarray(present, dtype = float)
+    except (TypeError, ValueError):
+        return None
+
+def summarize_column(column_name, values, top_values = 3):
+    present = [value for value in values if value is not None and value != '']
+    summary = f"{column_name}: {len(present)} non-null"
+
+    numbers = numeric_column(values)
+    if numbers is not None:
+        summary += f", min {numbers.min():g}, max {numbers.max():g}, avg {numbers.mean():g}, sum {numbers.sum():g}"
+    if present:
+        distinct, counts = np.unique(np.asarray([str(value) for value in present]), return_counts = True)
+        summary += f", {len(distinct)} distinct"
+        if numbers is None or len(distinct) <= top_values:
+            order = np.argsort(-counts, kind = 'stable')[:top_values]
+            summary += ", top: " + ", ".join(f"{format_value(distinct[index])} ({counts[index]})" for index in order)
+    return summary
+
+def encode_execution_result(execution_result, token_budget = 0, max_rows = 15):
+    """
+    Renders an execution result for the LLM prompts as a header with the column names and a line per row,
+    with the values separated by |, instead of repeating the column name in every value.
+
+    Rows are added up to max_rows and, with a token_budget, while they fit in it.
+    If some rows are left out, a summary of every column over all the rows (count, min/max/avg/sum for numbers,
+    distinct and most common values) is added so the answer can still account for them.
+    """
+    column_names, rows = result_table(execution_result)
+    if not column_names:
+        return str(execution_result)
+
+    header = " | ".join(format_value(column_name) for column_name in column_names)
+    lines = [" | ".join(format_value(value) for value in row) for row in rows[:max_rows]]
+    tokens = [calculate_tokens(line) for line in [header] + lines] if token_budget else []
+
+    if len(rows) <= max_rows and (not token_budget or sum(tokens) <= token_budget):
+        return "\n".join([header] + lines)
+
+    columns = list(zip(*rows))
+    summary = [f"Summary of the {len(rows)} rows:"] + [
+        summarize_column(column_name, column) for column_name, column in zip(column_names, columns)
+    ]
+
+    if token_budget:
+        spent = tokens[0] + calculate_tokens("\n".join(summary))
+        for shown, line_tokens in enumerate(tokens[1:]):
+            if spent + line_tokens > token_budget:
+                lines = lines[:shown]
+                break
+            spent += line_tokens
+
+    return "\n".join(
+        [header] + lines
+        + [f"... Showing only the first {len(lines)} of {len(rows)} rows of the execution result."]
+        + summary
+    )
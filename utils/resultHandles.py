@@ -0,0 +1,145 @@
+import os
+import hmac
+import sqlite3
+import secrets
+import hashlib
+import threading
+
+from time import time
+from functools import lru_cache
+
+from utils.vqlParser import parse_vql
+from utils.vqlRewriter import rewrite_vql
+
+def load_secret(key_path):
+    """
+    Key of the principal HMACs: RESULT_HANDLES_SECRET or, if it's not set, a random key generated once
+    in key_path (readable only by its owner) and shared by the workers on the same host.
+    """
+    secret = os.getenv("RESULT_HANDLES_SECRET")
+    if secret:
+        return secret.encode("utf-8")
+
+    if not os.path.exists(key_path):
+        # Written to a temporary file and linked, so other workers never read a partially written key
+        temporary_path = f"{key_path}.{os.getpid()}.{secrets.token_hex(4)}"
+        descriptor = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(descriptor, "wb") as key_file:
+            key_file.write(secrets.token_bytes(32))
+        try:
+            os.link(temporary_path, key_path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(temporary_path)
+
+    with open(key_path, "rb") as key_file:
+        return key_file.read()
+
+def principal_hash(auth, secret):
+    """
+    Keyed hash of the caller's credentials. A handle can only be used with the credentials that created it,
+    and the stored hashes can't be brute-forced offline without the key.
+    """
+    return hmac.new(secret, repr(auth).encode("utf-8"), hashlib.sha256).hexdigest()
+
+class ResultHandles:
+    """
+    Continuation handles of VQL results, stored in a local SQLite database shared by the workers on the same host.
+    A handle keeps the final VQL of an answer, the hash of the credentials it was executed with, how many rows
+    have been returned so far and when it expires, so the next rows can be fetched without asking the question again.
+    """
+    def __init__(self, database_path, ttl = 900, max_entries = 10000):
+        self.database_path = database_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.local = threading.local()
+
+        directory = os.path.dirname(database_path)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        self.secret = load_secret(f"{database_path}.key")
+
+        connection = self._connection()
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS result_handles ("
+            "id TEXT PRIMARY KEY, principal TEXT NOT NULL, vql TEXT NOT NULL, next_offset INTEGER NOT NULL, "
+            "created_at REAL NOT NULL, expires_at REAL NOT NULL)"
+        )
+        connection.commit()
+
+    def _connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.database_path, timeout = 30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def create(self, vql, auth, next_offset):
+        """Stores a handle to continue the result of the VQL from next_offset and returns its id."""
+        handle_id = secrets.token_urlsafe(24)
+        now = time()
+        connection = self._connection()
+        connection.execute(
+            "INSERT INTO result_handles (id, principal, vql, next_offset, created_at, expires_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (handle_id, principal_hash(auth, self.secret), vql, next_offset, now, now + self.ttl)
+        )
+        connection.execute("DELETE FROM result_handles WHERE expires_at <= ?", (now,))
+        connection.execute(
+            "DELETE FROM result_handles WHERE id IN "
+            "(SELECT id FROM result_handles ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+        connection.commit()
+        return handle_id
+
+    def get(self, handle_id, auth):
+        """Returns the VQL and next offset of the handle, or None if it doesn't exist, expired or belongs to someone else."""
+        row = self._connection().execute(
+            "SELECT vql, next_offset FROM result_handles WHERE id = ? AND principal = ? AND expires_at > ?",
+            (handle_id, principal_hash(auth, self.secret), time())
+        ).fetchone()
+        if row is None:
+            return None
+        return {"vql": row[0], "next_offset": row[1]}
+
+    def advance(self, handle_id, next_offset):
+        """Moves the handle past the rows just returned. Every page extends the expiry."""
+        connection = self._connection()
+        connection.execute(
+            "UPDATE result_handles SET next_offset = ?, expires_at = ? WHERE id = ?",
+            (next_offset, time() + self.ttl, handle_id)
+        )
+        connection.commit()
+
+@lru_cache(maxsize=None)
+def get_result_handles():
+    """Returns the process-wide result handles store, or None if RESULT_HANDLES is not enabled."""
+    if os.getenv("RESULT_HANDLES", "0") != "1":
+        return None
+
+    return ResultHandles(
+        database_path = os.getenv("RESULT_HANDLES_PATH", "./cache/result_handles.db"),
+        ttl = int(os.getenv("RESULT_HANDLES_TTL", 900)),
+        max_entries = int(os.getenv("RESULT_HANDLES_MAX_ENTRIES", 10000))
+    )
+
+def page_vql(vql, offset, page_size):
+    """
+    VQL to fetch page_size rows from offset, filtered in VDP with ROW_NUMBER() the same way as the LIMIT/OFFSET rewrite,
+    or None if the query can't be paged that way. Only ordered queries without paging of their own can: without an
+    ORDER BY, VDP doesn't guarantee the same row order across executions, so pages could repeat or miss rows.
+    """
+    vql = vql.strip().rstrip(';').strip()
+    parsed = parse_vql(vql)
+    main_query = next((scope for scope in parsed.scopes() if scope.parent is None), None) if not parsed.errors else None
+    if main_query is None or any(keyword in main_query.clauses for keyword in ('LIMIT', 'OFFSET', 'FETCH')):
+        return None
+    paged_vql, fixed_categories = rewrite_vql(f"{vql} LIMIT {page_size} OFFSET {offset}", ['LIMIT_OFFSET'])
+    return paged_vql if fixed_categories else None
+
+def is_pageable(vql):
+    """Whether getResultPage can page the result of the VQL. Result handles are only created for these queries."""
+    return page_vql(vql, 0, 1) is not None
@@ -0,0 +1,90 @@
+import os
+import re
+
+STOP_WORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'do', 'does', 'for', 'from', 'has', 'have', 'how', 'in',
+    'is', 'it', 'its', 'me', 'of', 'on', 'or', 'show', 'that', 'the', 'their', 'them', 'there', 'this', 'to',
+    'was', 'were', 'what', 'when', 'where', 'which', 'who', 'with', 'give', 'list', 'get', 'all', 'each', 'per'
+}
+
+def schema_token_budget(stage):
+    """
+    Token budget of the schema in the prompt of an LLM step, 0 if unlimited.
+    SCHEMA_TOKEN_BUDGET_<STAGE> overrides SCHEMA_TOKEN_BUDGET for a single step.
+    """
+    return int(os.getenv(f"SCHEMA_TOKEN_BUDGET_{stage.upper()}", os.getenv("SCHEMA_TOKEN_BUDGET", 0)))
+
+def estimate_tokens(text):
+    """Cheap estimate for the text added to the precomputed lines (sample values, abbreviations)."""
+    return len(text) // 4 + 1 if text else 0
+
+def normalize_term(term):
+    term = term.lower()
+    if len(term) > 3 and term.endswith('s') and not term.endswith('ss'):
+        term = term[:-1]
+    return term
+
+def text_terms(text):
+    """Terms of a question, description or sample value. Splits snake_case and camelCase."""
+    if not text:
+        return set()
+    text = re.sub(r'([a-z0-9])([A-Z])', r'\1 \2', str(text))
+    return {normalize_term(term) for term in re.findall(r'[A-Za-z0-9]+', text) if len(term) > 1} - STOP_WORDS
+
+def score_column(question_terms, column_name, column, examples):
+    """Lexical similarity of a column to the question. Matches in the column name weigh the most."""
+    if not question_terms:
+        return 0
+    score = 3 * len(question_terms & text_terms(column_name))
+    score += len(question_terms & text_terms(column.get('description')))
+    score += 2 * sum(1 for example in examples if text_terms(example) & question_terms)
+    return score
+
+def required_columns(fragment, view_json):
+    """Indexes of the columns that are always kept: the primary keys and the columns used to join the view."""
+    joins = " ".join(fragment['joins'])
+    schema = view_json.get('schema', [])
+    required = set()
+    for index, (column_name, _, _) in enumerate(fragment['columns']):
+        if index < len(schema) and schema[index].get('primaryKey', False):
+            required.add(index)
+        elif column_name and re.search(rf'(?<![\w]){re.escape(column_name)}(?![\w])', joins):
+            required.add(index)
+    return required
+
+def pack_columns(tables, token_budget):
+    """
+    Chooses the columns of each view that fit in token_budget.
+
+    tables is a list of (fixed_tokens, columns, required) tuples, one per view, where fixed_tokens is the cost
+    of the view without any of its columns and columns is a list of (tokens, score) tuples.
+    The required columns are always kept, the rest are added by descending score until the budget is spent,
+    so a view can end up with only its keys.
+
+    Returns the set of kept column indexes of each view.
+    """
+    kept = [set(required) for _, _, required in tables]
+    spent = sum(fixed_tokens for fixed_tokens, _, _ in tables)
+    spent += sum(columns[index][0] for (_, columns, _), indexes in zip(tables, kept) for index in indexes)
+
+    candidates = [
+        (-score, table_index, index, tokens)
+        for table_index, (_, columns, required) in enumerate(tables)
+        for index, (tokens, score) in enumerate(columns) if index not in required
+    ]
+    for _, table_index, index, tokens in sorted(candidates):
+        if spent + tokens <= token_budget:
+            kept[table_index].add(index)
+            spent += tokens
+
+    return kept
+
+def is_pruned_column_error(error_log, pruned_columns):
+    """Whether the error can come from a column that was left out of the schema shown to the LLM."""
+    if not error_log or not pruned_columns:
+        return False
+    error_log = str(error_log).lower()
+    return 'column' in error_log or 'field' in error_log or any(
+        column_name.lower() in error_log
+        for column_names in pruned_columns.values() for column_name in column_names if column_name
+    )
@@ -1,9 +1,11 @@
 import os
 import httpx
+import hashlib
 import logging
 
 from langchain.storage import LocalFileStore
-from utils.utils import RefreshableBotoSession
+from utils.utils import get_boto_client
+from langchain_core.embeddings import Embeddings
 from langchain.embeddings import CacheBackedEmbeddings
 
 class UniformEmbeddings:
@@ -15,7 +17,8 @@ class UniformEmbeddings:
         "Ollama",
         "Mistral",
         "NVIDIA",
-        "GoogleAIStudio"
+        "GoogleAIStudio",
+        "ONNX"
     ]
 
     def __init__(self, provider_name, model_name):
@@ -24,6 +27,7 @@ class UniformEmbeddings:
         self.model = None
         self.store = LocalFileStore("./cache/embeddings/")
         self.base_embeddings = None
+        self.cache_namespace = self.model_name
 
         if self.provider_name.lower() not in list(map(str.lower, self.VALID_PROVIDERS)):
             logging.warning(f"Provider '{self.provider_name}' not in standard list. Creating custom OpenAI-compatible provider.")
@@ -49,17 +53,45 @@ class UniformEmbeddings:
             self.setup_nvidia()
         elif self.provider_name.lower() == "googleaistudio":
             self.setup_google_ai_studio()
+        elif self.provider_name.lower() == "onnx":
+            self.setup_onnx()
 
-        if ":" in self.model_name:
+        if ":" in self.cache_namespace:
             self.model = self.base_embeddings
         else:
             self.model = CacheBackedEmbeddings.from_bytes_store(
                 self.base_embeddings,
                 self.store,
-                namespace=self.model_name,
+                namespace=self.cache_namespace,
                 query_embedding_cache=True,
             )
 
+    def setup_onnx(self):
+        from utils.onnxEmbeddings import ONNXEmbeddings
+
+        # For local models, the model name is the path to the exported model directory
+        model_path = os.path.normpath(self.model_name)
+        if not os.path.isdir(model_path):
+            raise ValueError(f"ONNX model directory '{model_path}' not found.")
+
+        threads = os.getenv('ONNX_EMBEDDINGS_THREADS')
+        batch_size = os.getenv('ONNX_EMBEDDINGS_BATCH_SIZE', '64')
+        max_length = os.getenv('ONNX_EMBEDDINGS_MAX_LENGTH', '512')
+        pooling = os.getenv('ONNX_EMBEDDINGS_POOLING', 'mean')
+
+        self.base_embeddings = ONNXEmbeddings(
+            model_path = model_path,
+            num_threads = int(threads) if threads else None,
+            batch_size = int(batch_size),
+            max_length = int(max_length),
+            pooling = pooling
+        )
+
+        # The cache namespace must be a relative key. A hash of the full path keeps apart
+        # different models whose directories share the same name (e.g. .../bge-small/onnx and .../bge-base/onnx)
+        path_hash = hashlib.sha256(os.path.abspath(model_path).encode('utf-8')).hexdigest()[:12]
+        self.cache_namespace = f"{os.path.basename(model_path)}-{path_hash}"
+
     def setup_google_ai_studio(self):
         from langchain_google_genai import GoogleGenerativeAIEmbeddings
 
@@ -199,7 +231,8 @@ class UniformEmbeddings:
         if AWS_REGION is None:
             raise ValueError("AWS_REGION environment variable must be set (even when using IAM credentials).")
 
-        refreshable_session_instance = RefreshableBotoSession(
+        client = get_boto_client(
+            'bedrock-runtime',
             region_name = AWS_REGION,
             profile_name = AWS_PROFILE_NAME,
             sts_arn = AWS_ROLE_ARN,
@@ -207,10 +240,6 @@ class UniformEmbeddings:
             secret_key = AWS_SECRET_ACCESS_KEY
         )
 
-        session = refreshable_session_instance.refreshable_session()
-
-        client = session.client('bedrock-runtime')
-
         self.base_embeddings = BedrockEmbeddings(
             client = client,
             model_id = self.model_name
@@ -248,4 +277,66 @@ class UniformEmbeddings:
         if proxy is not None:
             kwargs["openai_proxy"] = proxy
 
-        self.base_embeddings = OpenAIEmbeddings(**kwargs)
\ No newline at end of file
+        self.base_embeddings = OpenAIEmbeddings(**kwargs)
+
+class CompressedEmbeddings(Embeddings):
+    """
+    Wraps an embeddings model so the vectors stored in an index are smaller than the model output.
+
+    - dimensions: keeps only the first N dimensions and re-normalizes them (Matryoshka-style truncation).
+    - quantization: 'int8' scales each normalized component to a signed byte, 'binary' keeps only the sign
+      of each component, packed 8 per byte. Quantized vectors require an index that stores them natively.
+    """
+    VALID_QUANTIZATIONS = ["int8", "binary"]
+
+    def __init__(self, embeddings, dimensions = None, quantization = None):
+        self.embeddings = embeddings
+        self.dimensions = int(dimensions) if dimensions else None
+        self.quantization = quantization.lower() if quantization else None
+
+        if self.quantization and self.quantization not in self.VALID_QUANTIZATIONS:
+            raise ValueError(f"Unsupported quantization '{quantization}'. Use one of: {', '.join(self.VALID_QUANTIZATIONS)}.")
+
+        if self.quantization == "binary" and self.dimensions and self.dimensions % 8 != 0:
+            raise ValueError("Binary quantization requires the number of dimensions to be a multiple of 8.")
+
+        # Full precision vectors already computed for texts about to be stored, so they aren't embedded twice
+        self.precomputed = {}
+
+    def remember(self, texts, vectors):
+        """Keeps the full precision vectors of texts that are about to be embedded with embed_documents."""
+        self.precomputed.update(zip(texts, vectors))
+
+    def compress(self, vector):
+        import numpy as np
+
+        vector = np.asarray(vector, dtype = np.float32)
+        if self.dimensions:
+            vector = vector[:self.dimensions]
+
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector = vector / norm
+
+        if self.quantization == "int8":
+            return np.clip(np.rint(vector * 127), -128, 127).astype(np.int8).tolist()
+        elif self.quantization == "binary":
+            return np.packbits(vector > 0).astype(np.int8).tolist()
+        return vector.tolist()
+
+    def embed_documents(self, texts):
+        vectors = [self.precomputed.pop(text, None) for text in texts]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            for i, vector in zip(missing, self.embeddings.embed_documents([texts[i] for i in missing])):
+                vectors[i] = vector
+        return [self.compress(vector) for vector in vectors]
+
+    def embed_query(self, text):
+        return self.compress(self.embeddings.embed_query(text))
+
+    async def aembed_documents(self, texts):
+        return [self.compress(vector) for vector in await self.embeddings.aembed_documents(texts)]
+
+    async def aembed_query(self, text):
+        return self.compress(await self.embeddings.aembed_query(text))
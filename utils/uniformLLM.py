@@ -1,8 +1,55 @@
 import os
+import re
 import httpx
 import logging
 
-from utils.utils import TokenCounter, RefreshableBotoSession
+from functools import lru_cache
+from langchain_core.messages import HumanMessage
+from langchain_core.runnables import RunnableLambda, RunnableBinding
+from langchain_core.prompts import PromptTemplate
+from langchain_core.output_parsers import StrOutputParser
+from utils.llmCache import get_response_cache
+from utils.utils import TokenCounter, get_boto_client, add_langfuse_callback
+
+@lru_cache(maxsize=None)
+def get_llm(provider_name, model_name, temperature = 0, max_tokens = 2048):
+    """
+    Returns the process-wide UniformLLM for these parameters, creating it on first use.
+    Chat model clients are safe to share between concurrent requests, so their connection pools are reused.
+    Token usage must be tracked per call with a TokenCounter passed through the run config (see get_run_config).
+    """
+    return UniformLLM(provider_name, model_name, temperature = temperature, max_tokens = max_tokens)
+
+class PrefixCachedPrompt:
+    """
+    Prompt split into a static prefix and a dynamic remainder, so providers with prompt caching can reuse the prefix.
+    The template is split right before the first placeholder that is not one of the static parameters.
+    The prefix is formatted once. When cache_markers is set, it is sent as its own content block flagged with cache_control.
+    """
+    PLACEHOLDER_PATTERN = re.compile(r'(?<!\{)\{([A-Za-z_][A-Za-z0-9_]*)\}(?!\})')
+
+    def __init__(self, prompt_template, static_params, cache_markers = False):
+        split_index = len(prompt_template)
+        for match in self.PLACEHOLDER_PATTERN.finditer(prompt_template):
+            if match.group(1) not in static_params:
+                split_index = match.start()
+                break
+
+        self.prefix = prompt_template[:split_index].format(**static_params)
+        self.template = PromptTemplate.from_template(prompt_template[split_index:])
+        self.cache_markers = cache_markers
+
+    def format(self, **kwargs):
+        return self.prefix + self.template.format(**kwargs)
+
+    def format_messages(self, params):
+        if not self.cache_markers:
+            return [HumanMessage(content = self.format(**params))]
+
+        return [HumanMessage(content = [
+            {"type": "text", "text": self.prefix, "cache_control": {"type": "ephemeral"}},
+            {"type": "text", "text": self.template.format(**params)}
+        ])]
 
 class UniformLLM:
     VALID_PROVIDERS = [
@@ -26,12 +73,8 @@ class UniformLLM:
         self.llm = None
         self.temperature = temperature # Temperature in OpenAI goes from 0 to 2, in AWS/Vertex from 0 to 1
         self.max_tokens = max_tokens
-        self.callback = None
-        self.tokens = {
-            'input_tokens': 0,
-            'output_tokens': 0,
-            'total_tokens': 0
-        }
+        self.chains = {}
+        self.cached_llm = None
 
         if "deepseek-r1" in self.model_name.lower() or (self.model_name.startswith("o") and self.provider_name.lower() == "openai"):
             self.max_tokens = self.max_tokens * 5
@@ -69,6 +112,65 @@ class UniformLLM:
         elif self.provider_name.lower() == "openrouter":
             self.setup_openrouter()
 
+        # Shared token counter, kept for callers that use a dedicated UniformLLM instance
+        self.callback = TokenCounter()
+        self.tokens = self.callback.tokens
+
+    def get_cached_llm(self):
+        """
+        Returns a copy of the chat model that shares its client but answers repeated prompts from the response cache.
+        Falls back to the plain chat model if the cache is disabled or the temperature is not 0.
+        """
+        response_cache = get_response_cache()
+        if response_cache is None or self.temperature != 0:
+            return self.llm
+
+        if self.cached_llm is None:
+            if isinstance(self.llm, RunnableBinding):
+                # Models with bound arguments (Google's safety settings) need the cache on the bound chat model
+                cached_model = self.llm.bound.model_copy(update = {"cache": response_cache})
+                self.cached_llm = self.llm.model_copy(update = {"bound": cached_model})
+            else:
+                self.cached_llm = self.llm.model_copy(update = {"cache": response_cache})
+        return self.cached_llm
+
+    def get_chain(self, prompt_template, response_cache = False):
+        """Returns the prompt | llm | output parser chain for a prompt template. Each template is only parsed once."""
+        key = (prompt_template, response_cache)
+        chain = self.chains.get(key)
+        if chain is None:
+            llm = self.get_cached_llm() if response_cache else self.llm
+            chain = PromptTemplate.from_template(prompt_template) | llm | StrOutputParser()
+            self.chains[key] = chain
+        return chain
+
+    def supports_cache_markers(self):
+        """OpenAI and Azure cache stable prefixes automatically, Anthropic models need explicit cache_control markers."""
+        if os.getenv("LLM_PROMPT_CACHING", "1") != "1":
+            return False
+        provider = self.provider_name.lower()
+        return provider == "anthropic" or (provider == "bedrock" and "anthropic" in self.model_name.lower())
+
+    def get_prefix_cached_chain(self, prompt_template, response_cache = False, **static_params):
+        """
+        Returns the prompt and chain for a template whose leading part only depends on static_params.
+        The static prefix is kept byte-identical between calls so it can be served from the provider's prompt cache.
+        """
+        key = (prompt_template, response_cache, tuple(sorted(static_params.items())))
+        if key not in self.chains:
+            llm = self.get_cached_llm() if response_cache else self.llm
+            prompt = PrefixCachedPrompt(prompt_template, static_params, cache_markers = self.supports_cache_markers())
+            chain = RunnableLambda(prompt.format_messages) | llm | StrOutputParser()
+            self.chains[key] = (prompt, chain)
+        return self.chains[key]
+
+    def get_run_config(self, run_name, token_counter, session_id = None):
+        """Returns the run config for a single invocation, counting its tokens in the given TokenCounter."""
+        return {
+            "callbacks": add_langfuse_callback(token_counter, f"{self.provider_name}.{self.model_name}", session_id),
+            "run_name": run_name,
+        }
+
     def setup_openrouter(self):
         from langchain_openai import ChatOpenAI
 
@@ -85,6 +187,7 @@ class UniformLLM:
             "base_url": base_url,
             "temperature": self.temperature,
             "max_tokens": self.max_tokens,
+            "stream_usage": True,
         }
 
         if preferred_providers:
@@ -97,7 +200,6 @@ class UniformLLM:
             }
 
         self.llm = ChatOpenAI(**kwargs)
-        self.callback = TokenCounter(llm = self)
 
     def setup_sambanova(self):
         from langchain_sambanova import ChatSambaNovaCloud
@@ -111,7 +213,6 @@ class UniformLLM:
             sambanova_api_key = api_key,
             temperature = self.temperature,
             max_tokens = self.max_tokens)
-        self.callback = TokenCounter(llm = self)
 
     def setup_google_ai_studio(self):
         from langchain_google_genai import ChatGoogleGenerativeAI
@@ -125,7 +226,6 @@ class UniformLLM:
             api_key = google_ai_studio_api_key,
             temperature = self.temperature,
             max_tokens = self.max_tokens)
-        self.callback = TokenCounter(llm = self)
     
     def setup_ollama(self):
         from langchain_ollama.chat_models import ChatOllama
@@ -140,7 +240,6 @@ class UniformLLM:
             kwargs["base_url"] = base_url
             
         self.llm = ChatOllama(**kwargs)
-        self.callback = TokenCounter(llm = self)
 
     def setup_nvidia(self):
         from langchain_nvidia_ai_endpoints import ChatNVIDIA
@@ -162,7 +261,6 @@ class UniformLLM:
             kwargs["base_url"] = base_url
             
         self.llm = ChatNVIDIA(**kwargs)
-        self.callback = TokenCounter(llm = self)
 
     def setup_anthropic(self):
         from langchain_anthropic import ChatAnthropic
@@ -177,7 +275,6 @@ class UniformLLM:
             temperature = self.temperature,
             max_tokens = self.max_tokens,
         )
-        self.callback = TokenCounter(llm = self)
 
     def setup_groq(self):
         from langchain_groq import ChatGroq
@@ -193,7 +290,6 @@ class UniformLLM:
             max_tokens = self.max_tokens,
             streaming = True,
         )
-        self.callback = TokenCounter(llm = self)
     
     def setup_google(self):
         from langchain_google_vertexai import ChatVertexAI
@@ -217,7 +313,6 @@ class UniformLLM:
             safety_settings=safety_settings,
         )
         self.llm = self.llm.bind(safety_settings=safety_settings)
-        self.callback = TokenCounter(llm = self)
 
     def setup_openai(self):
         from langchain_openai import ChatOpenAI
@@ -233,6 +328,7 @@ class UniformLLM:
         kwargs = {
             "model": self.model_name,
             "api_key": api_key,
+            "stream_usage": True,
         }
 
         # For reasoning models (starting with 'o')
@@ -260,7 +356,6 @@ class UniformLLM:
             kwargs["organization"] = organization_id
 
         self.llm = ChatOpenAI(**kwargs)
-        self.callback = TokenCounter(llm = self)
 
     def setup_azure_openai(self):
         from langchain_openai import AzureChatOpenAI
@@ -281,6 +376,7 @@ class UniformLLM:
             "openai_api_version": api_version,
             "azure_deployment": self.model_name,
             "temperature": self.temperature * 2,
+            "stream_usage": True,
         }
 
         if api_key is not None:
@@ -298,7 +394,6 @@ class UniformLLM:
             logging.warning("AzureOpenAI proxy not set. Using direct connection.")
 
         self.llm = AzureChatOpenAI(**kwargs)
-        self.callback = TokenCounter(llm = self)
 
     def setup_bedrock(self):
         from langchain_aws import ChatBedrock
@@ -312,7 +407,8 @@ class UniformLLM:
         if AWS_REGION is None:
             raise ValueError("AWS_REGION environment variable must be set (even when using IAM credentials).")
 
-        refreshable_session_instance = RefreshableBotoSession(
+        client = get_boto_client(
+            'bedrock-runtime',
             region_name = AWS_REGION,
             profile_name = AWS_PROFILE_NAME,
             sts_arn = AWS_ROLE_ARN,
@@ -320,9 +416,6 @@ class UniformLLM:
             secret_key = AWS_SECRET_ACCESS_KEY
         )
 
-        session = refreshable_session_instance.refreshable_session()
-        client = session.client('bedrock-runtime')
-
         self.llm = ChatBedrock(
             client = client,
             model = self.model_name,
@@ -331,7 +424,6 @@ class UniformLLM:
                 "max_tokens": self.max_tokens
             },
         )
-        self.callback = TokenCounter(llm = self)
 
     def setup_mistral(self):
         from langchain_mistralai import ChatMistralAI
@@ -346,7 +438,6 @@ class UniformLLM:
             temperature = self.temperature,
             max_tokens = self.max_tokens,
         )
-        self.callback = TokenCounter(llm = self)
 
     def setup_custom(self):
         from langchain_openai import ChatOpenAI
@@ -372,7 +463,6 @@ class UniformLLM:
             kwargs["openai_proxy"] = proxy
 
         self.llm = ChatOpenAI(**kwargs)
-        self.callback = TokenCounter(llm = self)
 
     @staticmethod
     def get_providers():
@@ -1,20 +1,71 @@
 import os
 import time
+import base64
 import logging
 import concurrent.futures
 
-from utils.uniformEmbeddings import UniformEmbeddings
+from utils.uniformEmbeddings import UniformEmbeddings, CompressedEmbeddings
 from utils.utils import log_params, prepare_last_update_vector, timed
 
+# Environment variable prefix holding the compression settings of each of the SDK's indexes.
+# Ingestion and search read the same settings, so the stored and the query vectors always match.
+INDEX_SETTINGS_PREFIX = {
+    "ai_sdk_vector_store": "VECTOR_STORE",
+    "ai_sdk_sample_data": "SAMPLE_DATA_VECTOR_STORE",
+}
+
+# Metadata key of the full precision embedding stored with each document of a compressed index, used to re-score the candidates
+RESCORE_VECTOR_KEY = "rescore_vector"
+
+def encode_rescore_vector(vector):
+    """Full precision embedding as a base64 string of float16 values, so it fits in the metadata of every provider."""
+    import numpy as np
+
+    return base64.b64encode(np.asarray(vector, dtype = '<f2').tobytes()).decode('ascii')
+
+def decode_rescore_vector(encoded):
+    import numpy as np
+
+    return np.frombuffer(base64.b64decode(encoded), dtype = '<f2').astype(np.float32)
+
 class UniformVectorStore:
-    def __init__(self, provider, embeddings_provider, embeddings_model, index_name = "ai_sdk_vector_store", rate_limit_rpm = None, chunk_factor = 5):
+    QUANTIZATION_PROVIDERS = ["opensearch"]
+
+    def __init__(self, provider, embeddings_provider, embeddings_model, index_name = "ai_sdk_vector_store", rate_limit_rpm = None, chunk_factor = 5, dimensions = None, quantization = None, rescore_factor = None):
         self.provider = provider.lower()
-        self.embeddings = UniformEmbeddings(embeddings_provider, embeddings_model).model
+        self.full_embeddings = UniformEmbeddings(embeddings_provider, embeddings_model).model
         self.index_name = index_name
         self.rate_limit_rpm = rate_limit_rpm
         self.client = None
         self.dimensions = self.get_dimensions()
         self.chunk_factor = chunk_factor
+
+        settings_prefix = INDEX_SETTINGS_PREFIX.get(index_name)
+        if settings_prefix:
+            dimensions = dimensions or os.getenv(f"{settings_prefix}_DIMENSIONS")
+            quantization = quantization or os.getenv(f"{settings_prefix}_QUANTIZATION")
+            rescore_factor = rescore_factor or os.getenv(f"{settings_prefix}_RESCORE_FACTOR")
+
+        if quantization and self.provider not in self.QUANTIZATION_PROVIDERS:
+            logging.warning(f"Quantized storage is not supported by {self.provider}. Storing full precision vectors in '{index_name}'.")
+            quantization = None
+
+        if dimensions and int(dimensions) >= self.dimensions:
+            dimensions = None
+
+        if dimensions or quantization:
+            self.embeddings = CompressedEmbeddings(self.full_embeddings, dimensions = dimensions, quantization = quantization)
+            self.compressed = True
+            self.stored_dimensions = int(dimensions) if dimensions else self.dimensions
+            self.quantization = self.embeddings.quantization
+            self.rescore_factor = int(rescore_factor) if rescore_factor else 4
+        else:
+            self.embeddings = self.full_embeddings
+            self.compressed = False
+            self.stored_dimensions = self.dimensions
+            self.quantization = None
+            self.rescore_factor = 1
+
         self._connect()
         
     def _connect(self):
@@ -69,12 +120,61 @@ class UniformVectorStore:
                 ssl_assert_hostname = False,
                 ssl_show_warn = False,
             )
+
+            if self.quantization:
+                self._create_quantized_opensearch_index()
         else:
             raise ValueError(f"Unsupported provider: {self.provider}")
 
+    def _create_quantized_opensearch_index(self):
+        """
+        OpenSearch only stores byte or binary vectors if the index mapping says so,
+        so the index is created before LangChain creates it with its default float mapping.
+        """
+        if self.client.client.indices.exists(index = self.index_name):
+            return
+
+        if self.quantization == "int8":
+            vector_mapping = {
+                "type": "knn_vector",
+                "dimension": self.stored_dimensions,
+                "data_type": "byte",
+                "method": {
+                    "name": "hnsw",
+                    "engine": "lucene",
+                    "space_type": "l2",
+                    "parameters": {"ef_construction": 128, "m": 16}
+                }
+            }
+        else:
+            vector_mapping = {
+                "type": "knn_vector",
+                "dimension": self.stored_dimensions,
+                "data_type": "binary",
+                "method": {
+                    "name": "hnsw",
+                    "engine": "faiss",
+                    "space_type": "hamming",
+                    "parameters": {"ef_construction": 128, "m": 16}
+                }
+            }
+
+        # The full precision vectors kept for re-scoring are stored, but not indexed
+        self.client.client.indices.create(
+            index = self.index_name,
+            body = {
+                "settings": {"index": {"knn": True, "knn.algo_param.ef_search": 128}},
+                "mappings": {"properties": {
+                    "vector_field": vector_mapping,
+                    "metadata": {"properties": {RESCORE_VECTOR_KEY: {"type": "binary"}}}
+                }}
+            }
+        )
+        logging.info(f"Created OpenSearch index '{self.index_name}' with {self.quantization} vectors of {self.stored_dimensions} dimensions")
+
     @timed          
     def get_dimensions(self):
-        test_vector = self.embeddings.embed_query("test")
+        test_vector = self.full_embeddings.embed_query("test")
         return len(test_vector)
     
     @timed
@@ -97,6 +197,11 @@ class UniformVectorStore:
         # Otherwise, no filter on view_ids
         else:
             search_filter = None
+
+        # Compressed indexes are searched with the full query vector so the candidates can be re-scored
+        if self.compressed:
+            vector = self.full_embeddings.embed_query(query)
+            return self._compressed_search(vector, k, search_filter, scores)
                     
         if scores:
             if self.provider == "opensearch":
@@ -121,12 +226,59 @@ class UniformVectorStore:
         # Otherwise, no filter on view_ids
         else:
             search_filter = self._build_get_view_ids_search_filter(view_names)
+
+        if self.compressed:
+            return self._compressed_search(vector, k, search_filter)
         
         if self.provider == "opensearch":
             return self.client.similarity_search_by_vector(vector, k=k, search_type="script_scoring", pre_filter=search_filter)
         elif self.provider in ["chroma", "pgvector"]:
             return self.client.similarity_search_by_vector(vector, k=k, filter=search_filter)
 
+    def _compressed_search(self, vector, k, search_filter, scores=False):
+        """
+        Searches a compressed index with a full precision query vector.
+        Lookups by id use a zero vector and are returned as is. Real queries fetch rescore_factor * k
+        candidates from the compressed index and re-rank them by their exact cosine similarity to the query,
+        using the full precision document embeddings stored with them at ingestion. Nothing is embedded at query time:
+        if some candidate was stored without its full precision embedding, the compressed ranking is kept.
+        """
+        import numpy as np
+
+        is_lookup = not any(vector)
+        compressed_vector = self.embeddings.compress(vector)
+        fetch_k = k if is_lookup else k * max(1, self.rescore_factor)
+
+        if self.provider == "opensearch" and self.quantization:
+            filter_kwargs = {"efficient_filter": search_filter} if search_filter else {}
+            candidates = self.client.similarity_search_with_score_by_vector(compressed_vector, k=fetch_k, search_type="approximate_search", **filter_kwargs)
+        elif self.provider == "opensearch":
+            candidates = self.client.similarity_search_with_score_by_vector(compressed_vector, k=fetch_k, search_type="script_scoring", pre_filter=search_filter)
+        elif self.provider == "chroma":
+            candidates = self.client.similarity_search_by_vector_with_relevance_scores(compressed_vector, k=fetch_k, filter=search_filter)
+        else:
+            candidates = self.client.similarity_search_with_score_by_vector(compressed_vector, k=fetch_k, filter=search_filter)
+
+        documents = [doc for doc, _ in candidates]
+        encoded_vectors = [doc.metadata.pop(RESCORE_VECTOR_KEY, None) for doc in documents]
+
+        if is_lookup or self.rescore_factor <= 1 or not candidates or None in encoded_vectors:
+            if not is_lookup and None in encoded_vectors:
+                logging.debug(f"Some candidates in '{self.index_name}' have no full precision embedding, skipping re-scoring")
+            candidates = candidates[:k]
+            return candidates if scores else [doc for doc, _ in candidates]
+
+        document_vectors = np.stack([decode_rescore_vector(encoded) for encoded in encoded_vectors])
+        query_vector = np.asarray(vector, dtype = np.float32)
+
+        similarities = document_vectors @ query_vector
+        similarities /= np.clip(np.linalg.norm(document_vectors, axis = 1) * np.linalg.norm(query_vector), 1e-12, None)
+
+        ranking = np.argsort(-similarities)[:k]
+        if scores:
+            return [(documents[i], float(similarities[i])) for i in ranking]
+        return [documents[i] for i in ranking]
+
     @log_params
     def _build_get_view_ids_search_filter(self, view_names):
         if self.provider == "opensearch":
@@ -250,6 +402,17 @@ class UniformVectorStore:
         else:
             return None
 
+    def _attach_rescore_vectors(self, views):
+        """
+        Embeds the views once with the full precision model and stores the vector in their metadata for re-scoring.
+        The compressed embeddings reuse the same vectors when the views are added, so nothing is embedded twice.
+        """
+        texts = [view.page_content for view in views]
+        vectors = self.full_embeddings.embed_documents(texts)
+        for view, vector in zip(views, vectors):
+            view.metadata[RESCORE_VECTOR_KEY] = encode_rescore_vector(vector)
+        self.embeddings.remember(texts, vectors)
+
     def add_views(self, views, parallel = True):
         views = list({view.id: view for view in views}.values())
         view_ids = [view.id for view in views]
@@ -268,6 +431,9 @@ class UniformVectorStore:
                 batch_ids = view_ids[i:batch_end]
                 
                 logging.info(f"Processing batch {i//self.rate_limit_rpm + 1}: {len(batch_views)} views")
+
+                if self.compressed and self.rescore_factor > 1:
+                    self._attach_rescore_vectors(batch_views)
                 
                 # Process this batch using existing methods
                 if parallel:
@@ -286,6 +452,9 @@ class UniformVectorStore:
                     time.sleep(wait_time)
         else:
             # Process all views at once (original behavior)
+            if self.compressed and self.rescore_factor > 1 and views:
+                self._attach_rescore_vectors(views)
+
             if parallel:
                 try:
                     self._add_views_parallel(views, view_ids)
@@ -16,15 +16,18 @@ import json
 import asyncio
 import logging
 import tiktoken
+import threading
 import functools
 
-from time import time
+from time import time, sleep
 from uuid import uuid4
 from boto3 import Session
 from functools import wraps, lru_cache
 from datetime import datetime
+from botocore.config import Config
 from botocore.session import get_session
 from langchain_core.documents.base import Document
+from langchain_core.messages import get_buffer_string
 from botocore.credentials import RefreshableCredentials
 from langchain.callbacks.base import BaseCallbackHandler
 
@@ -204,10 +207,74 @@ def schema_summary(schema):
     summary += "\n"
     return summary
             
+# Prompt text of a view, precomputed at ingestion
+VIEW_FRAGMENT_VERSION = 2
+
+def format_column_line(column):
+    """Line of a column in the schema of the prompts, without the sample values (they depend on the question)."""
+    name = column.get('columnName', 'unnamed')
+    col_type = column.get('type', 'unknown')
+    desc = column.get('description')
+
+    flags = []
+    if column.get('primaryKey', False):
+        flags.append("PK")
+    if not column.get('nullable', True):
+        flags.append("NOT NULL")
+
+    parts = [f"→ {name} ({col_type})"]
+    if flags:
+        parts.append(f"[{' '.join(flags)}]")
+    if desc:
+        parts.append(f"- {desc if desc.endswith('.') else desc + '.'}")
+    return " ".join(parts)
+
+def view_fragment(table):
+    """
+    Precomputes the parts of the prompts that describe a view: the header, a line per column (with its token count),
+    the joins, the one-line summary used by the answer prompts and the token count of the full description.
+    Sample values and the joins shown depend on the question, so they are added when the prompt is assembled.
+    """
+    database_name, view_name = table.get('tableName', 'unnamed_database.unnamed_table').split('.')
+    header = [f'# Table: "{database_name}"."{view_name}"']
+    if table.get('description', ''):
+        header.append(f"## Description:\n{table['description']}")
+    header.append("## Columns:")
+
+    lines = [(column.get('columnName'), format_column_line(column)) for column in table.get('schema', [])]
+    columns = [[name, line, calculate_tokens(line)] for name, line in lines]
+    joins = [association['where'] for association in table.get('associations', []) if association.get('where')]
+    column_names = [column.get('columnName') for column in table.get('schema', [])]
+
+    text = "\n".join(header + [line for _, line, _ in columns] + (["## Joins:"] + [f"→ {where}" for where in joins] if joins else []))
+    return {
+        "version": VIEW_FRAGMENT_VERSION,
+        "header": "\n".join(header),
+        "header_tokens": calculate_tokens("\n".join(header)),
+        "columns": columns,
+        "joins": joins,
+        "has_associations": bool(table.get('associations')),
+        "readable": f'<table>Table {table.get("tableName")} with columns {", ".join(column_names)}\n</table>\n',
+        "tokens": calculate_tokens(text)
+    }
+
+def get_view_fragment(table):
+    """
+    Returns the prompt fragment of a vector search table, precomputed at ingestion.
+    Views ingested without one, or with an older version, compute it once per request.
+    """
+    fragment = table.get('view_fragment')
+    if fragment is None or fragment.get('version') != VIEW_FRAGMENT_VERSION:
+        fragment = table['view_fragment'] = view_fragment(table['view_json'])
+    return fragment
+
 # Calculate the tokens of a given string
+@lru_cache(maxsize=None)
+def get_encoding(encoding = 'cl100k_base'):
+    return tiktoken.get_encoding(encoding)
+
 def calculate_tokens(string, encoding = 'cl100k_base'):
-    encoding = tiktoken.get_encoding(encoding)
-    num_tokens = len(encoding.encode(string))
+    num_tokens = len(get_encoding(encoding).encode(string))
     return num_tokens
 
 # Parse the XML tags in the LLM's response
@@ -223,6 +290,52 @@ def custom_tag_parser(text, tag, default=[]):
     
     return matches
 
+# Incremental version of custom_tag_parser for streamed LLM responses
+class StreamingTagParser:
+    """
+    Parses the first <tag></tag> element of a response that arrives in chunks.
+    feed() returns the new text inside the element, holding back anything that could be the start of the closing tag.
+    """
+    def __init__(self, tag):
+        self.open_tag = f"<{tag}>"
+        self.close_tag = f"</{tag}>"
+        self.text = ""
+        self.start = None
+        self.position = None
+        self.closed = False
+
+    def feed(self, chunk):
+        self.text += chunk
+        if self.closed:
+            return ""
+
+        if self.start is None:
+            start = self.text.find(self.open_tag)
+            if start == -1:
+                return ""
+            self.start = self.position = start + len(self.open_tag)
+
+        end = self.text.find(self.close_tag, self.position)
+        if end != -1:
+            self.closed = True
+        else:
+            end = len(self.text)
+            for i in range(len(self.close_tag) - 1, 0, -1):
+                if self.text.endswith(self.close_tag[:i]):
+                    end -= i
+                    break
+
+        new_text = self.text[self.position:end]
+        self.position = end
+        return new_text
+
+    @property
+    def content(self):
+        """Text of the element received so far, or None if the element has not started."""
+        if self.start is None:
+            return None
+        return self.text[self.start:self.position]
+
 def flatten_list(list_of_lists):
     flattened_list = [x for item in list_of_lists for x in (item if isinstance(item, list) else [item])]
     return flattened_list
@@ -277,6 +390,7 @@ def create_chunks(table, embeddings_token_limit):
         base_metadata = {
             "view_name": table['tableName'],
             "view_json": json.dumps(table),
+            "view_fragment": json.dumps(view_fragment(table)),
             "view_id": base_id,  # Same ID for all chunks of the same table
             "database_name": table['tableName'].split('.')[0]
         }
@@ -338,6 +452,7 @@ def prepare_schema(schema, embeddings_token_limit = 0):
         base_metadata = {
             "view_name": table['tableName'],
             "view_json": json.dumps(table),
+            "view_fragment": json.dumps(view_fragment(table)),
             "view_id": str(table['id']),
             "database_name": table['tableName'].split('.')[0],
             "last_update": int(time() * 1000)
@@ -417,6 +532,7 @@ class RefreshableBotoSession:
             refresh_using = self.__get_session_credentials,
             method = "sts-assume-role",
         )
+        self.credentials = refreshable_credentials
 
         session = get_session()
         session._credentials = refreshable_credentials
@@ -424,24 +540,104 @@ class RefreshableBotoSession:
         autorefresh_session = Session(botocore_session = session)
 
         return autorefresh_session
+
+    def start_background_refresh(self, interval = 60):
+        """
+        Periodically reads the credentials from a daemon thread. Botocore refreshes them when they are
+        within its advisory window before expiry, so requests never wait on the STS call themselves.
+        """
+        def refresh_loop():
+            while True:
+                sleep(interval)
+                try:
+                    self.credentials.get_frozen_credentials()
+                except Exception as e:
+                    logging.warning(f"Background refresh of AWS credentials failed: {str(e)}")
+
+        thread = threading.Thread(target = refresh_loop, name = f"aws-credentials-{self.session_name[:8]}", daemon = True)
+        thread.start()
+
+# Process-wide boto sessions and clients. Boto3 clients are thread-safe, so every Bedrock LLM
+# and embeddings model with the same connection parameters shares the same client and credentials.
+_boto_lock = threading.Lock()
+_boto_sessions = {}
+_boto_clients = {}
+
+def get_boto_client(service_name, region_name = None, access_key = None, secret_key = None, profile_name = None, sts_arn = None):
+    session_key = (region_name, access_key, secret_key, profile_name, sts_arn)
+    client_key = (service_name, *session_key)
+
+    client = _boto_clients.get(client_key)
+    if client is not None:
+        return client
+
+    with _boto_lock:
+        if client_key in _boto_clients:
+            return _boto_clients[client_key]
+
+        session = _boto_sessions.get(session_key)
+        if session is None:
+            refreshable_session_instance = RefreshableBotoSession(
+                region_name = region_name,
+                profile_name = profile_name,
+                sts_arn = sts_arn,
+                access_key = access_key,
+                secret_key = secret_key
+            )
+            session = refreshable_session_instance.refreshable_session()
+            refreshable_session_instance.start_background_refresh()
+            _boto_sessions[session_key] = session
+            logging.info(f"Created shared AWS session for region {region_name}")
+
+        client = session.client(
+            service_name,
+            config = Config(max_pool_connections = int(os.getenv("AWS_MAX_POOL_CONNECTIONS", 50)))
+        )
+        _boto_clients[client_key] = client
+        return client
     
-# Token Counter for LLMs
+# Token Counter for LLMs. Create one per invocation and pass it in the run config callbacks.
+# Counts come from the usage_metadata reported by the provider. Only when a model does not report usage
+# are the prompt and output tokenized with tiktoken. Being a sync handler, it is run in a worker thread
+# by langchain during async invocations, so the fallback never blocks the event loop.
 class TokenCounter(BaseCallbackHandler):
-    def __init__(self, llm):
-        self.llm = llm.llm
-        self.tokens = llm.tokens
-
-    def on_llm_start(self, serialized, prompts, **kwargs):
-        for p in prompts:
-            self.tokens['input_tokens'] += calculate_tokens(p)
-
-    def on_llm_end(self, response, **kwargs):
-        results = response.flatten()
-        for r in results:
-            self.tokens['output_tokens'] = calculate_tokens(r.generations[0][0].text)
+    def __init__(self):
+        self.tokens = {
+            'input_tokens': 0,
+            'output_tokens': 0,
+            'cached_tokens': 0,
+            'total_tokens': 0
+        }
+        self.prompts = {}
+
+    def on_llm_start(self, serialized, prompts, run_id = None, **kwargs):
+        self.prompts[run_id] = prompts
+
+    def on_chat_model_start(self, serialized, messages, run_id = None, **kwargs):
+        self.prompts[run_id] = [get_buffer_string(message_list) for message_list in messages]
+
+    def on_llm_end(self, response, run_id = None, **kwargs):
+        prompts = self.prompts.pop(run_id, [])
+        generations = [generation_list[0] for generation_list in response.generations if generation_list]
+
+        usage = [getattr(getattr(generation, 'message', None), 'usage_metadata', None) for generation in generations]
+        if generations and all(usage):
+            for usage_metadata in usage:
+                self.tokens['input_tokens'] += usage_metadata.get('input_tokens', 0)
+                self.tokens['output_tokens'] += usage_metadata.get('output_tokens', 0)
+                self.tokens['cached_tokens'] += (usage_metadata.get('input_token_details') or {}).get('cache_read', 0) or 0
+        else:
+            for p in prompts:
+                self.tokens['input_tokens'] += calculate_tokens(p)
+            for generation in generations:
+                self.tokens['output_tokens'] += calculate_tokens(generation.text)
         self.tokens['total_tokens'] = self.tokens['input_tokens'] + self.tokens['output_tokens']
 
+    def on_llm_error(self, error, run_id = None, **kwargs):
+        self.prompts.pop(run_id, None)
+
     def reset_tokens(self):
         self.tokens['input_tokens'] = 0
         self.tokens['output_tokens'] = 0
+        self.tokens['cached_tokens'] = 0
         self.tokens['total_tokens'] = 0
\ No newline at end of file
@@ -0,0 +1,187 @@
+import os
+import hashlib
+import logging
+import threading
+
+from time import time
+from collections import OrderedDict
+
+VDP_FLIGHT_SQL_URI = os.getenv('VDP_FLIGHT_SQL_URI', 'grpc://localhost:9994')
+VDP_FLIGHT_SQL_DATABASE = os.getenv('VDP_FLIGHT_SQL_DATABASE', 'admin')
+VDP_FLIGHT_SQL_POOL_SIZE = int(os.getenv('VDP_FLIGHT_SQL_POOL_SIZE', 4))
+VDP_FLIGHT_SQL_MAX_PRINCIPALS = int(os.getenv('VDP_FLIGHT_SQL_MAX_PRINCIPALS', 64))
+VDP_FLIGHT_SQL_IDLE_TIMEOUT = int(os.getenv('VDP_FLIGHT_SQL_IDLE_TIMEOUT', 300))
+
+def connection_kwargs(auth, database = VDP_FLIGHT_SQL_DATABASE):
+    """ADBC options to connect as the caller: basic auth for (username, password) tuples, the bearer token otherwise."""
+    db_kwargs = {
+        "adbc.flight.sql.rpc.call_header.database": database,
+        "adbc.flight.sql.rpc.call_header.timePrecision": 'milliseconds',
+    }
+    if isinstance(auth, tuple):
+        db_kwargs["username"], db_kwargs["password"] = auth
+    else:
+        db_kwargs["adbc.flight.sql.authorization_header"] = f"Bearer {auth}"
+    return db_kwargs
+
+def principal_key(auth):
+    return hashlib.sha256(repr(auth).encode('utf-8')).hexdigest()
+
+class FlightSQLPool:
+    """
+    Pool of ADBC Flight SQL connections to VDP, with up to pool_size idle connections per principal.
+    Connections are never shared between principals, so every query runs with the caller's permissions.
+    The least recently used principals are dropped (and their connections closed) past max_principals,
+    and idle connections older than idle_timeout seconds are closed instead of reused.
+    """
+    def __init__(self, uri = VDP_FLIGHT_SQL_URI, database = VDP_FLIGHT_SQL_DATABASE, pool_size = VDP_FLIGHT_SQL_POOL_SIZE,
+                 max_principals = VDP_FLIGHT_SQL_MAX_PRINCIPALS, idle_timeout = VDP_FLIGHT_SQL_IDLE_TIMEOUT):
+        self.uri = uri
+        self.database = database
+        self.pool_size = pool_size
+        self.max_principals = max_principals
+        self.idle_timeout = idle_timeout
+        self.idle = OrderedDict()
+        self.lock = threading.Lock()
+
+    def connect(self, auth):
+        from adbc_driver_flightsql.dbapi import connect
+
+        return connect(self.uri, db_kwargs = connection_kwargs(auth, self.database), autocommit = True)
+
+    def acquire(self, auth):
+        key = principal_key(auth)
+        expired = []
+        connection = None
+        with self.lock:
+            connections = self.idle.get(key)
+            while connections:
+                candidate, released_at = connections.pop()
+                if time() - released_at > self.idle_timeout:
+                    expired.append(candidate)
+                else:
+                    connection = candidate
+                    break
+            if key in self.idle:
+                self.idle.move_to_end(key)
+
+        for candidate in expired:
+            self._close(candidate)
+        return key, connection or self.connect(auth)
+
+    def release(self, key, connection):
+        evicted = []
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            self.idle.move_to_end(key)
+            if len(connections) < self.pool_size:
+                connections.append((connection, time()))
+                connection = None
+            while len(self.idle) > self.max_principals:
+                _, connections = self.idle.popitem(last = False)
+                evicted.extend(candidate for candidate, _ in connections)
+
+        for candidate in evicted + ([connection] if connection else []):
+            self._close(candidate)
+
+    def discard(self, connection):
+        self._close(connection)
+
+    def close(self):
+        with self.lock:
+            connections = [candidate for idle in self.idle.values() for candidate, _ in idle]
+            self.idle.clear()
+        for candidate in connections:
+            self._close(candidate)
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.close()
+        except Exception as e:
+            logging.debug(f"Error closing Flight SQL connection: {e}")
+
+def arrow_column_type(arrow_type):
+    """JSON type of an Arrow column, as in data_catalog.column_type."""
+    import pyarrow as pa
+
+    if pa.types.is_null(arrow_type):
+        return 'null'
+    if pa.types.is_boolean(arrow_type):
+        return 'boolean'
+    if pa.types.is_integer(arrow_type) or pa.types.is_floating(arrow_type) or pa.types.is_decimal(arrow_type):
+        return 'number'
+    return 'string'
+
+def arrow_to_columns(table):
+    """
+    Converts an Arrow table to the format of data_catalog.parse_execution_columns.
+    Decimals become floats and dates, times and any other non-primitive values become strings, like in the Data Catalog responses.
+    """
+    import pyarrow as pa
+
+    data, types = [], []
+    for column in table.columns:
+        column_type = arrow_column_type(column.type)
+        if pa.types.is_decimal(column.type):
+            column = column.cast(pa.float64())
+        elif column_type == 'string' and not pa.types.is_string(column.type) and not pa.types.is_large_string(column.type):
+            try:
+                column = column.cast(pa.string())
+            except (pa.ArrowNotImplementedError, pa.ArrowInvalid):
+                column = pa.chunked_array([[None if value is None else str(value) for value in column.to_pylist()]], pa.string())
+        data.append(column.to_pylist())
+        types.append(column_type)
+
+    return {
+        'columns': list(table.column_names),
+        'types': types,
+        'data': data,
+        'row_count': table.num_rows
+    }
+
+def read_limited(reader, limit):
+    """Reads record batches until limit rows, without fetching the rest of the result from the server."""
+    import pyarrow as pa
+
+    batches, rows = [], 0
+    for batch in reader:
+        if limit and rows + batch.num_rows >= limit:
+            batches.append(batch.slice(0, limit - rows))
+            break
+        batches.append(batch)
+        rows += batch.num_rows
+    return pa.Table.from_batches(batches, schema = reader.schema)
+
+flight_sql_pool = FlightSQLPool()
+
+def execute(vql, auth, limit, pool = flight_sql_pool):
+    """
+    Executes the VQL over Flight SQL with a pooled connection of the caller and returns the status code and
+    the columnar result, or the error message. Blocking: call it in a thread from async code.
+    """
+    try:
+        key, connection = pool.acquire(auth)
+    except Exception as e:
+        error_message = f"Failed to connect to the server: {str(e)}"
+        logging.error(f"{error_message}. VQL: {vql}")
+        return 500, error_message
+
+    from adbc_driver_flightsql.dbapi import ProgrammingError
+
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(vql)
+            table = read_limited(cursor.fetch_record_batch(), limit)
+    except Exception as e:
+        # Errors in the VQL leave the connection usable, anything else may not
+        if isinstance(e, ProgrammingError):
+            pool.release(key, connection)
+        else:
+            pool.discard(connection)
+        error_message = str(e)
+        logging.error(f"VDP Flight SQL execute VQL failed: {error_message}")
+        return 500, error_message
+
+    pool.release(key, connection)
+    return 200, arrow_to_columns(table)
@@ -0,0 +1,55 @@
+import re
+
+from utils.utils import get_view_fragment
+
+class ViewRecord:
+    """A view of the vector search, with everything the prompts need precomputed."""
+    __slots__ = ('name', 'quoted_name', 'view_id', 'view_json', 'fragment', 'tokens', 'table')
+
+    def __init__(self, table):
+        self.table = table
+        self.name = table['view_name']
+        self.view_id = str(table.get('view_id', table['view_json'].get('id')))
+        self.view_json = table['view_json']
+        self.fragment = get_view_fragment(table)
+        self.tokens = self.fragment['tokens']
+        database_name, _, view_name = self.name.partition('.')
+        self.quoted_name = f'"{database_name}"."{view_name}"' if view_name else f'"{database_name}"'
+
+class ViewContext(list):
+    """
+    The vector search tables of a request, built once from the output of get_relevant_tables.
+    It's still the list of table dicts the tools expect, plus a slotted record per view, a lookup by view name
+    and a matcher that finds the views referenced by a query in a single pass.
+    pruned_columns has, by view name, the columns left out of the schema of the VQL generation to fit its token budget.
+    """
+    __slots__ = ('records', 'by_name', 'pattern', 'pruned_columns')
+
+    def __init__(self, vector_search_tables = ()):
+        super().__init__(vector_search_tables)
+        self.records = [ViewRecord(table) for table in self]
+        self.by_name = {record.name: record for record in self.records}
+        self.pattern = None
+        self.pruned_columns = {}
+        if self.records:
+            # Longest names first, so a view isn't matched as the prefix of another one
+            names = sorted({record.name.lower() for record in self.records}, key = len, reverse = True)
+            self.pattern = re.compile(r'(?<![\w.])(' + '|'.join(re.escape(name) for name in names) + r')(?![\w])', re.IGNORECASE)
+
+    @classmethod
+    def of(cls, vector_search_tables):
+        """Returns vector_search_tables as a ViewContext, building it only if it isn't one already."""
+        if isinstance(vector_search_tables, cls):
+            return vector_search_tables
+        return cls(vector_search_tables)
+
+    def referenced_names(self, query):
+        """Names (lowercase) of the views referenced in the query, quoted or not."""
+        if self.pattern is None or not query:
+            return set()
+        return {match.lower() for match in self.pattern.findall(query.replace('"', ''))}
+
+    def referenced(self, query):
+        """The table dicts of the views referenced in the query, in vector search order."""
+        names = self.referenced_names(query)
+        return [record.table for record in self.records if record.name.lower() in names]
@@ -0,0 +1,494 @@
+import re
+
+# Tokens of the VQL subset generated by the LLM. Words are Unicode identifiers, like in VQL (año, región).
+# Any other character becomes an 'unknown' token, which makes the query opaque to the schema validation.
+TOKEN_PATTERN = re.compile(r"""
+      (?P<whitespace>\s+)
+    | (?P<comment>--[^\n]*|/\*.*?\*/)
+    | (?P<string>'(?:[^']|'')*')
+    | (?P<identifier>"(?:[^"]|"")*")
+    | (?P<number>(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?)
+    | (?P<word>[^\W\d][\w$]*)
+    | (?P<operator><>|!=|<=|>=|\|\||[-+*/%=<>(),.;])
+""", re.VERBOSE | re.DOTALL)
+
+# Keywords that start a clause of a SELECT statement (or combine two of them)
+CLAUSE_KEYWORDS = {
+    'SELECT', 'FROM', 'WHERE', 'GROUP', 'HAVING', 'ORDER', 'LIMIT', 'OFFSET', 'FETCH',
+    'UNION', 'EXCEPT', 'INTERSECT', 'MINUS', 'CONTEXT', 'TRACE'
+}
+JOIN_KEYWORDS = {'JOIN', 'INNER', 'LEFT', 'RIGHT', 'FULL', 'OUTER', 'CROSS', 'NATURAL', 'LATERAL'}
+
+# Words that are never column names: keywords, type names, date parts and functions that don't need parentheses
+KEYWORDS = CLAUSE_KEYWORDS | {
+    'ALL', 'AND', 'ANY', 'AS', 'ASC', 'AT', 'BETWEEN', 'BOTH', 'BY', 'CASE', 'CROSS', 'CURRENT', 'DESC',
+    'DISTINCT', 'ELSE', 'END', 'ESCAPE', 'EXISTS', 'FALSE', 'FILTER', 'FIRST', 'FOLLOWING', 'FULL', 'ILIKE',
+    'IN', 'INNER', 'INTERVAL', 'IS', 'JOIN', 'LAST', 'LEADING', 'LEFT', 'LIKE', 'NATURAL', 'NEXT', 'NOT',
+    'NULL', 'NULLS', 'ON', 'ONLY', 'OR', 'OUTER', 'OVER', 'PARTITION', 'PRECEDING', 'RANGE', 'REGEXP_LIKE',
+    'RIGHT', 'ROW', 'ROWS', 'SOME', 'THEN', 'TIES', 'TO', 'TRAILING', 'TRUE', 'UNBOUNDED', 'UNKNOWN',
+    'USING', 'WHEN', 'WITH', 'WITHIN', 'ZONE',
+    'CURRENT_DATE', 'CURRENT_TIMESTAMP', 'LOCALTIME', 'LOCALTIMESTAMP', 'NOW',
+    'BIGINT', 'BLOB', 'BOOL', 'BOOLEAN', 'CHAR', 'DATE', 'DECIMAL', 'DOUBLE', 'FLOAT', 'INT', 'INTEGER',
+    'LONG', 'NUMERIC', 'REAL', 'SMALLINT', 'TEXT', 'TIME', 'TIMESTAMP', 'TIMESTAMPTZ', 'VARCHAR',
+    'YEAR', 'QUARTER', 'MONTH', 'WEEK', 'DAY', 'HOUR', 'MINUTE', 'SECOND', 'MILLISECOND',
+    'DOW', 'DOY', 'DAYOFWEEK', 'DAYOFYEAR', 'EPOCH'
+}
+
+# Functions that the Data Catalog rejects, with the VQL alternatives listed in the VQL rules of the prompts
+FORBIDDEN_FUNCTIONS = {
+    'LENGTH', 'CHAR_LENGTH', 'CHARACTER_LENGTH', 'CURRENT_TIME', 'DIVIDE', 'MULTIPLY', 'DATE', 'STRFTIME',
+    'SUBSTRING', 'DATE_SUB', 'DATE_ADD', 'DATE_TRUNC', 'INTERVAL', 'ADDDATE', 'TO_CHAR', 'LPAD',
+    'STRING_AGG', 'ARRAY_AGG'
+}
+
+class Token:
+    def __init__(self, kind, value, start):
+        self.kind = kind
+        self.value = value
+        self.start = start
+        self.upper = value.upper() if kind == 'word' else value
+
+    @property
+    def is_name(self):
+        """Unquoted identifiers that are not keywords, and quoted identifiers."""
+        return self.kind == 'identifier' or (self.kind == 'word' and self.upper not in KEYWORDS)
+
+    @property
+    def name(self):
+        return self.value[1:-1].replace('""', '"') if self.kind == 'identifier' else self.value
+
+    def __repr__(self):
+        return f"Token({self.kind}, {self.value!r})"
+
+class VQLDiagnostic:
+    """A problem found in a VQL query. The category matches the error categories of prepare_vql, when there is one."""
+    def __init__(self, category, message, position = None):
+        self.category = category
+        self.message = message
+        self.position = position
+
+    def __repr__(self):
+        return f"VQLDiagnostic({self.category}, {self.message!r})"
+
+class QueryScope:
+    """
+    A SELECT statement (or WITH statement, or several SELECTs joined by set operations) and its subqueries.
+    clauses maps each clause keyword to the token indices where it appears in this scope, outside of any parentheses.
+    """
+    def __init__(self, start, parent = None, open_paren = None):
+        self.start = start
+        self.end = None
+        self.parent = parent
+        self.open_paren = open_paren
+        self.clauses = {}
+        self.subqueries = []
+        self.tables = []
+        self.aliases = {}
+        self.select_aliases = set()
+        self.ctes = set()
+        self.opaque = False
+
+    @property
+    def depth(self):
+        return 0 if self.parent is None else self.parent.depth + 1
+
+    def walk(self):
+        yield self
+        for subquery in self.subqueries:
+            yield from subquery.walk()
+
+    def visible_ctes(self):
+        scope, ctes = self, set()
+        while scope is not None:
+            ctes |= scope.ctes
+            scope = scope.parent
+        return ctes
+
+class ParsedVQL:
+    def __init__(self, vql, tokens, root, owners, errors):
+        self.vql = vql
+        self.tokens = tokens
+        self.root = root
+        self.owners = owners
+        self.errors = errors
+
+    def scopes(self):
+        return list(self.root.walk()) if self.root else []
+
+    def clause_end(self, scope, index):
+        """Index of the token where the clause starting at index ends, within the same scope."""
+        following = [i for indices in scope.clauses.values() for i in indices if i > index]
+        return min(following) if following else scope.end
+
+    def text(self, start, end):
+        """Original text of the tokens from start to end (exclusive)."""
+        if start >= end:
+            return ''
+        return self.vql[self.tokens[start].start:self.tokens[end - 1].start + len(self.tokens[end - 1].value)]
+
+def tokenize_vql(vql):
+    """Splits a VQL query into tokens. Returns the tokens and the diagnostics for unterminated strings and quoted identifiers."""
+    tokens, errors = [], []
+    position = 0
+    while position < len(vql):
+        match = TOKEN_PATTERN.match(vql, position)
+        if match is None:
+            character = vql[position]
+            if character in "'\"":
+                element = 'string literal' if character == "'" else 'quoted identifier'
+                errors.append(VQLDiagnostic('SYNTAX', f"Unterminated {element} starting at: {vql[position:position + 30]}", position))
+                break
+            # Not necessarily an error, just something this tokenizer doesn't know
+            tokens.append(Token('unknown', character, position))
+            position += 1
+            continue
+
+        kind = match.lastgroup
+        if kind not in ('whitespace', 'comment'):
+            tokens.append(Token(kind, match.group(), position))
+        position = match.end()
+    return tokens, errors
+
+def parse_vql(vql):
+    """
+    Tokenizes the query and splits it into scopes (the main query and its subqueries), with the position of each clause.
+    This is not a full VQL grammar: it only covers what's needed to validate the queries generated by the LLM.
+    """
+    tokens, errors = tokenize_vql(vql)
+    owners = [None] * len(tokens)
+    root = None
+
+    if tokens and (tokens[0].upper in ('SELECT', 'WITH') or tokens[0].value == '('):
+        root, index = _parse_scope(tokens, 0, owners, errors)
+        # Anything after the main query, other than a final semicolon, is unexpected
+        trailing = [token for token in tokens[index:] if token.value != ';']
+        if trailing:
+            errors.append(VQLDiagnostic('SYNTAX', f"Unexpected '{trailing[0].value}' after the end of the query.", trailing[0].start))
+    elif tokens:
+        errors.append(VQLDiagnostic('SYNTAX', "The query must start with SELECT or WITH.", tokens[0].start))
+
+    parsed = ParsedVQL(vql, tokens, root, owners, errors)
+    for token, owner in zip(tokens, owners):
+        if token.kind == 'unknown' and owner is not None:
+            owner.opaque = True
+    for scope in parsed.scopes():
+        _collect_ctes(parsed, scope)
+    for scope in parsed.scopes():
+        _collect_tables(parsed, scope)
+        _collect_select_aliases(parsed, scope)
+    return parsed
+
+def _parse_scope(tokens, start, owners, errors, parent = None, open_paren = None):
+    scope = QueryScope(start, parent, open_paren)
+    level = 0
+    index = start
+    while index < len(tokens):
+        token = tokens[index]
+        if token.value == '(':
+            if index + 1 < len(tokens) and tokens[index + 1].upper in ('SELECT', 'WITH'):
+                owners[index] = scope
+                subquery, index = _parse_scope(tokens, index + 1, owners, errors, scope, index)
+                scope.subqueries.append(subquery)
+                if index < len(tokens):
+                    owners[index] = scope
+                index += 1
+                continue
+            level += 1
+        elif token.value == ')':
+            if level == 0:
+                if parent is None:
+                    errors.append(VQLDiagnostic('SYNTAX', "Unbalanced parentheses: there is a ')' without a matching '('.", token.start))
+                    level = 1
+                else:
+                    scope.end = index
+                    return scope, index
+            level -= 1
+        elif token.value == ';' and level == 0 and parent is None:
+            break
+        elif level == 0 and token.kind == 'word' and token.upper in CLAUSE_KEYWORDS:
+            scope.clauses.setdefault(token.upper, []).append(index)
+        owners[index] = scope
+        index += 1
+
+    if level > 0 or parent is not None:
+        errors.append(VQLDiagnostic('SYNTAX', "Unbalanced parentheses: there is a '(' without a matching ')'.", tokens[start].start))
+    scope.end = index
+    return scope, index
+
+def _scope_tokens(parsed, scope, start, end):
+    """Indices of the tokens between start and end that belong to the scope itself, not to its subqueries."""
+    return [i for i in range(start, min(end, len(parsed.tokens))) if parsed.owners[i] is scope]
+
+def _collect_ctes(parsed, scope):
+    if parsed.tokens[scope.start].upper != 'WITH':
+        return
+    # WITH name [(columns)] AS (SELECT ...), name AS (...) SELECT ...
+    main_select = min(scope.clauses.get('SELECT', [scope.end]))
+    expect_name = True
+    level = 0
+    for i in _scope_tokens(parsed, scope, scope.start + 1, main_select):
+        token = parsed.tokens[i]
+        if token.value == '(':
+            level += 1
+        elif token.value == ')':
+            level -= 1
+        elif level == 0 and token.value == ',':
+            expect_name = True
+        elif level == 0 and expect_name and token.is_name and token.upper != 'RECURSIVE':
+            scope.ctes.add(token.name.lower())
+            expect_name = False
+
+def _read_name(parsed, index, end):
+    """Reads a dotted name (database.view or alias.column) starting at index. Returns the name parts and the next index."""
+    tokens = parsed.tokens
+    parts = [tokens[index].name]
+    index += 1
+    while index + 1 < end and tokens[index].value == '.' and tokens[index + 1].kind in ('word', 'identifier'):
+        parts.append(tokens[index + 1].name)
+        index += 2
+    return parts, index
+
+def _collect_tables(parsed, scope):
+    tokens = parsed.tokens
+    ctes = scope.visible_ctes()
+    for from_index in scope.clauses.get('FROM', []):
+        end = parsed.clause_end(scope, from_index)
+        expect_table = True
+        i = from_index + 1
+        while i < end:
+            token = tokens[i]
+            if token.value == '(':
+                subquery = next((s for s in scope.subqueries if s.open_paren == i), None)
+                if subquery is not None:
+                    # Derived table: its columns aren't known, so the scope can't be fully validated
+                    close = subquery.end
+                    alias, i = _read_alias(parsed, close + 1, end)
+                    if expect_table:
+                        scope.opaque = True
+                        if alias:
+                            scope.aliases[alias.lower()] = None
+                        expect_table = False
+                    continue
+                if expect_table:
+                    # Table functions or anything else we don't understand
+                    scope.opaque = True
+                    expect_table = False
+                i = _skip_parentheses(tokens, i, end)
+                continue
+            if token.value == ',' or token.upper == 'JOIN':
+                expect_table = True
+            elif token.upper in ('ON', 'USING'):
+                expect_table = False
+            elif expect_table and token.upper in ('LATERAL', 'FLATTEN'):
+                scope.opaque = True
+            elif expect_table and token.kind in ('word', 'identifier') and token.upper not in CLAUSE_KEYWORDS | JOIN_KEYWORDS:
+                parts, i = _read_name(parsed, i, end)
+                alias, i = _read_alias(parsed, i, end)
+                name = '.'.join(parts)
+                if len(parts) == 1 and name.lower() in ctes:
+                    scope.opaque = True
+                    scope.aliases[(alias or name).lower()] = None
+                else:
+                    scope.tables.append((parts, alias, token.start))
+                expect_table = False
+                continue
+            i += 1
+
+def _read_alias(parsed, index, end):
+    tokens = parsed.tokens
+    if index < end and tokens[index].upper == 'AS':
+        index += 1
+    if index < end and tokens[index].is_name:
+        return tokens[index].name, index + 1
+    return None, index
+
+def _skip_parentheses(tokens, index, end):
+    level = 0
+    while index < end:
+        if tokens[index].value == '(':
+            level += 1
+        elif tokens[index].value == ')':
+            level -= 1
+            if level == 0:
+                return index + 1
+        index += 1
+    return index
+
+def _collect_select_aliases(parsed, scope):
+    tokens = parsed.tokens
+    for select_index in scope.clauses.get('SELECT', []):
+        end = parsed.clause_end(scope, select_index)
+        for i in _scope_tokens(parsed, scope, select_index + 1, end):
+            token = tokens[i]
+            if not token.is_name:
+                continue
+            previous = tokens[i - 1]
+            following = tokens[i + 1] if i + 1 < len(tokens) else None
+            if following is not None and following.value in ('(', '.'):
+                continue
+            # "expression AS alias" or "expression alias"
+            if previous.upper == 'AS' or previous.value == ')' or previous.upper == 'END' or previous.kind in ('string', 'number', 'identifier') or (previous.kind == 'word' and previous.is_name):
+                if previous.value == '.':
+                    continue
+                scope.select_aliases.add(token.name.lower())
+
+def _schema_lookup(vector_search_tables):
+    """Maps database.view and view names (lowercase) to the lowercase column names of the view."""
+    full_names, view_names = {}, {}
+    for table in vector_search_tables:
+        if not isinstance(table, dict) or 'view_json' not in table:
+            return None, None
+        view_json = table['view_json']
+        table_name = view_json.get('tableName', table.get('view_name', '')).replace('"', '')
+        columns = {column['columnName'].lower() for column in view_json.get('schema', []) if 'columnName' in column}
+        full_names[table_name.lower()] = columns
+        view_names.setdefault(table_name.split('.')[-1].lower(), []).append(columns)
+    return full_names, view_names
+
+def validate_vql(vql, vector_search_tables = None):
+    """
+    Validates a VQL query without sending it to the Data Catalog. Returns a list of VQLDiagnostic.
+    Checks the syntax of the subset of VQL generated by the LLM, the constructs VQL doesn't support
+    (forbidden functions, LIMIT/FETCH in subqueries, OFFSET) and, when vector_search_tables is given,
+    that the tables and columns referenced exist in their schemas.
+    """
+    parsed = parse_vql(vql)
+    diagnostics = list(parsed.errors)
+    tokens = parsed.tokens
+
+    for i, token in enumerate(tokens):
+        if token.kind != 'word' or token.upper not in FORBIDDEN_FUNCTIONS or (i > 0 and tokens[i - 1].value == '.'):
+            continue
+        following = tokens[i + 1] if i + 1 < len(tokens) else None
+        # INTERVAL is also rejected as a literal keyword: INTERVAL '1' DAY
+        is_literal = token.upper == 'INTERVAL' and following is not None and following.kind in ('string', 'number')
+        if is_literal or (following is not None and following.value == '('):
+            diagnostics.append(VQLDiagnostic('FORBIDDEN_FUNCTION', f"{token.upper} is not permitted in VQL.", token.start))
+
+    for scope in parsed.scopes():
+        if scope.parent is not None:
+            for keyword in ('LIMIT', 'FETCH'):
+                if keyword in scope.clauses:
+                    diagnostics.append(VQLDiagnostic('LIMIT_SUBQUERY', f"There is a {keyword} in subquery, which is not permitted in VQL. Use ROW_NUMBER () instead.", tokens[scope.clauses[keyword][0]].start))
+        elif 'OFFSET' in scope.clauses:
+            diagnostics.append(VQLDiagnostic('LIMIT_OFFSET', "There is a LIMIT OFFSET in the main query, which is not permitted in VQL. Use ROW_NUMBER () instead.", tokens[scope.clauses['OFFSET'][0]].start))
+
+    # Queries with characters the tokenizer doesn't know can't be checked reliably against the schemas
+    if vector_search_tables and not parsed.errors and not any(token.kind == 'unknown' for token in tokens):
+        diagnostics.extend(_validate_schema(parsed, vector_search_tables))
+
+    unique_diagnostics = {}
+    for diagnostic in diagnostics:
+        unique_diagnostics.setdefault(diagnostic.message, diagnostic)
+    return list(unique_diagnostics.values())
+
+def _validate_schema(parsed, vector_search_tables):
+    full_names, view_names = _schema_lookup(vector_search_tables)
+    if full_names is None:
+        return []
+
+    diagnostics = []
+    tokens = parsed.tokens
+
+    for scope in parsed.scopes():
+        for parts, alias, position in scope.tables:
+            name = '.'.join(parts).lower()
+            if len(parts) == 1:
+                candidates = view_names.get(name, [])
+                columns = candidates[0] if len(candidates) == 1 else None
+            else:
+                columns = full_names.get(name)
+
+            if columns is None and not (len(parts) == 1 and len(view_names.get(name, [])) > 1):
+                diagnostics.append(VQLDiagnostic('UNKNOWN_TABLE', f"Table {'.'.join(parts)} does not exist or is not one of the available tables.", position))
+                scope.opaque = True
+            scope.aliases[(alias or parts[-1]).lower()] = columns
+            if alias is None and len(parts) > 1:
+                scope.aliases[name] = columns
+
+    if any(diagnostic.category == 'UNKNOWN_TABLE' for diagnostic in diagnostics):
+        return diagnostics
+
+    for scope in parsed.scopes():
+        from_ranges = [(i, parsed.clause_end(scope, i)) for i in scope.clauses.get('FROM', [])]
+        # The names of the CTEs of a WITH are not column references
+        start = min(scope.clauses.get('SELECT', [scope.end])) if tokens[scope.start].upper == 'WITH' else scope.start
+        indices = _scope_tokens(parsed, scope, start, scope.end)
+        skip_until = -1
+        for i in indices:
+            if i < skip_until:
+                continue
+            token = tokens[i]
+            if not token.is_name:
+                continue
+            previous = tokens[i - 1] if i > 0 else None
+            if previous is not None and (previous.value == '.' or previous.upper == 'AS'):
+                continue
+            following = tokens[i + 1] if i + 1 < len(tokens) else None
+            if following is not None and following.value == '(':
+                continue
+
+            in_from = any(start < i < end for start, end in from_ranges)
+            parts, next_index = _read_name(parsed, i, len(tokens))
+            skip_until = next_index
+
+            if in_from:
+                # Table names and aliases are handled in _collect_tables, but ON conditions are column references
+                if not _in_join_condition(parsed, scope, i, from_ranges):
+                    continue
+
+            if len(parts) == 1:
+                diagnostic = _check_unqualified_column(scope, parts[0], token.start)
+            else:
+                diagnostic = _check_qualified_column(scope, parts, token.start)
+            if diagnostic:
+                diagnostics.append(diagnostic)
+
+    return diagnostics
+
+def _in_join_condition(parsed, scope, index, from_ranges):
+    """Checks if the token at index comes after an ON of the FROM clause it belongs to, and before the next JOIN or comma."""
+    tokens = parsed.tokens
+    for start, end in from_ranges:
+        if start < index < end:
+            for i in range(index - 1, start, -1):
+                if parsed.owners[i] is not scope:
+                    continue
+                if tokens[i].upper == 'ON':
+                    return True
+                if tokens[i].upper == 'JOIN' or tokens[i].value == ',':
+                    return False
+    return False
+
+def _resolve_alias(scope, alias):
+    """Finds the columns of the table with this alias, looking in the enclosing scopes for correlated subqueries."""
+    while scope is not None:
+        if alias in scope.aliases:
+            return True, scope.aliases[alias]
+        scope = scope.parent
+    return False, None
+
+def _check_qualified_column(scope, parts, position):
+    column = parts[-1].lower()
+    qualifier = '.'.join(parts[:-1]).lower()
+    found, columns = _resolve_alias(scope, qualifier)
+    if not found and len(parts) > 2:
+        found, columns = _resolve_alias(scope, parts[-2].lower())
+    if not found:
+        return VQLDiagnostic('UNKNOWN_TABLE', f"{'.'.join(parts[:-1])} in {'.'.join(parts)} is not a table or alias of the query.", position)
+    if columns is not None and column not in columns:
+        return VQLDiagnostic('UNKNOWN_COLUMN', f"Column {parts[-1]} does not exist in {'.'.join(parts[:-1])}.", position)
+    return None
+
+def _check_unqualified_column(scope, name, position):
+    name = name.lower()
+    current = scope
+    while current is not None:
+        if current.opaque or name in current.select_aliases or name in current.aliases:
+            return None
+        if any(columns is None or name in columns for columns in current.aliases.values()):
+            return None
+        current = current.parent
+    if not scope.aliases:
+        return None
+    return VQLDiagnostic('UNKNOWN_COLUMN', f"Column {name} does not exist in any of the tables of the query.", position)
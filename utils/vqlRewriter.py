@@ -0,0 +1,278 @@
+import logging
+
+from collections import Counter
+from utils.vqlParser import parse_vql
+
+# Words that can't be used as aliases in VQL
+PROTECTED_WORDS = {
+    'ADD', 'ALL', 'ALTER', 'AND', 'ANY', 'AS', 'ASC', 'BASE', 'BOTH', 'CASE', 'CONNECT', 'CONTEXT', 'CREATE', 'CROSS',
+    'CURRENT_DATE', 'CURRENT_TIMESTAMP', 'CUSTOM', 'DATABASE', 'DEFAULT', 'DESC', 'DF', 'DISTINCT', 'DROP',
+    'EXISTS', 'FALSE', 'FETCH', 'FLATTEN', 'FROM', 'FULL', 'GRANT', 'GROUP', 'HASH', 'HAVING', 'HTML', 'IF', 'INNER',
+    'INTERSECT', 'INTO', 'IS', 'JDBC', 'JOIN', 'LDAP', 'LEADING', 'LEFT', 'LIMIT', 'LOCALTIME', 'LOCALTIMESTAMP',
+    'MERGE', 'MINUS', 'MY', 'NATURAL', 'NESTED', 'NOS', 'NOT', 'NULL', 'OBL', 'ODBC', 'OF', 'OFF', 'OFFSET', 'ON', 'ONE', 'OPT',
+    'OR', 'ORDER', 'ORDERED', 'PRIVILEGES', 'READ', 'REVERSEORDER', 'REVOKE', 'RIGHT', 'ROW', 'SELECT', 'SWAP',
+    'TABLE', 'TO', 'TRACE', 'TRAILING', 'TRUE', 'UNION', 'USER', 'USING', 'VIEW', 'WHEN', 'WHERE', 'WITH', 'WRITE', 'WS', 'ZERO'
+}
+
+# Number of times each rule fixed a query that would otherwise have needed an LLM call, since the process started
+rewrite_counts = Counter()
+
+def record_rewrite(rule):
+    rewrite_counts[rule] += 1
+    logging.info(f"VQL rewrite '{rule}' saved an LLM call ({rewrite_counts[rule]} times so far)")
+
+def get_rewrite_counts():
+    return dict(rewrite_counts)
+
+def rename_protected_aliases(vql):
+    """
+    Appends an underscore to the aliases that are protected words (... AS user -> ... AS user_),
+    and to the references to them in the same query (user.name, ORDER BY user). Returns the VQL and the renamed aliases.
+    If the query can't be parsed, only the aliases right after AS are renamed, token by token.
+    """
+    parsed = parse_vql(vql)
+    tokens = parsed.tokens
+    if parsed.errors:
+        return _rename_protected_definitions(vql, tokens)
+
+    renamed = {}
+    for i, token in enumerate(tokens[:-1]):
+        alias = tokens[i + 1]
+        if token.upper == 'AS' and alias.kind == 'word' and alias.upper in PROTECTED_WORDS and _at_scope_level(parsed, i):
+            renamed[alias.upper] = f"{alias.value}_"
+
+    if not renamed:
+        return vql, []
+
+    edits = []
+    for i, token in enumerate(tokens):
+        if token.kind != 'word' or token.upper not in renamed:
+            continue
+        previous = tokens[i - 1] if i > 0 else None
+        following = tokens[i + 1] if i + 1 < len(tokens) else None
+        is_definition = previous is not None and previous.upper == 'AS' and _at_scope_level(parsed, i - 1)
+        is_qualifier = following is not None and following.value == '.' and (previous is None or previous.value != '.')
+        is_order_reference = _in_clause(parsed, i, ('ORDER', 'HAVING')) and not (following is not None and following.value == '(')
+        if is_definition or is_qualifier or is_order_reference:
+            edits.append((token.start, token.start + len(token.value), renamed[token.upper]))
+
+    for word in renamed:
+        logging.info(f"Protected word '{word}' used as alias, appending underscore")
+    return _apply_edits(vql, edits), list(renamed)
+
+def _rename_protected_definitions(vql, tokens):
+    """Fallback of rename_protected_aliases for queries with syntax errors, where the scopes and references are unknown."""
+    edits, renamed = [], []
+    for i, token in enumerate(tokens[:-1]):
+        alias = tokens[i + 1]
+        following = tokens[i + 2] if i + 2 < len(tokens) else None
+        if token.upper == 'AS' and alias.kind == 'word' and alias.upper in PROTECTED_WORDS and not (following is not None and following.value == '('):
+            edits.append((alias.start, alias.start + len(alias.value), f"{alias.value}_"))
+            if alias.upper not in renamed:
+                renamed.append(alias.upper)
+                logging.info(f"Protected word '{alias.upper}' used as alias, appending underscore")
+    return _apply_edits(vql, edits), renamed
+
+def rewrite_vql(vql, error_categories):
+    """
+    Rewrites the VQL to fix the error categories that have a mechanical solution, without calling the LLM:
+
+    - LIMIT_SUBQUERY: a subquery with LIMIT/FETCH is wrapped in a query that filters on a ROW_NUMBER() column.
+    - LIMIT_OFFSET: LIMIT n OFFSET m in the main query is replaced by a filter on a ROW_NUMBER() range.
+
+    Returns the rewritten VQL and the categories that were fixed. The VQL is returned as is if a rule doesn't apply,
+    for example when the row order can't be expressed in the ROW_NUMBER() window or the columns of the query are not explicit.
+    """
+    fixed_categories = []
+    for category, is_target in (('LIMIT_SUBQUERY', lambda scope: scope.parent is not None), ('LIMIT_OFFSET', lambda scope: scope.parent is None)):
+        if category not in error_categories:
+            continue
+
+        # Rewrite one query at a time, as each rewrite changes the positions of the rest
+        rewritten = True
+        while rewritten:
+            rewritten = False
+            parsed = parse_vql(vql)
+            if parsed.errors:
+                return vql, fixed_categories
+            for scope in reversed(parsed.scopes()):
+                if not is_target(scope) or not any(keyword in scope.clauses for keyword in ('LIMIT', 'OFFSET', 'FETCH')):
+                    continue
+                new_vql = _rewrite_paging(parsed, scope)
+                if new_vql is None:
+                    return vql, fixed_categories
+                vql = new_vql
+                rewritten = True
+                break
+        fixed_categories.append(category)
+
+    return vql, fixed_categories
+
+def _at_scope_level(parsed, index):
+    """Checks if the token is outside of any parentheses of its scope (so an AS is an alias and not part of CAST(x AS type))."""
+    scope = parsed.owners[index]
+    level = 0
+    for i in range(scope.start, index):
+        if parsed.owners[i] is scope:
+            if parsed.tokens[i].value == '(':
+                level += 1
+            elif parsed.tokens[i].value == ')':
+                level -= 1
+    return level == 0
+
+def _in_clause(parsed, index, keywords):
+    scope = parsed.owners[index]
+    if scope is None:
+        return False
+    starts = [(i, keyword) for keyword, indices in scope.clauses.items() for i in indices if i < index]
+    return bool(starts) and max(starts)[1] in keywords
+
+def _apply_edits(vql, edits):
+    for start, end, text in sorted(edits, reverse = True):
+        vql = vql[:start] + text + vql[end:]
+    return vql
+
+def _split_items(parsed, scope, start, end):
+    """Splits the tokens from start to end at the commas that are outside of parentheses. Returns (start, end) ranges."""
+    items = []
+    level = 0
+    item_start = start
+    for i in range(start, end):
+        if parsed.owners[i] is not scope:
+            continue
+        value = parsed.tokens[i].value
+        if value == '(':
+            level += 1
+        elif value == ')':
+            level -= 1
+        elif value == ',' and level == 0:
+            items.append((item_start, i))
+            item_start = i + 1
+    items.append((item_start, end))
+    return [(item_start, item_end) for item_start, item_end in items if item_start < item_end]
+
+def _select_item(parsed, start, end):
+    """Returns the expression text and the output column name (as written in the query, or None if it has no name) of a select item."""
+    tokens = parsed.tokens
+    last = tokens[end - 1]
+    if end - start >= 2 and last.is_name and tokens[end - 2].upper == 'AS':
+        return parsed.text(start, end - 2), last.value
+    if end - start >= 2 and last.is_name and tokens[end - 2].value != '.' and (tokens[end - 2].value == ')' or tokens[end - 2].upper == 'END' or tokens[end - 2].kind in ('string', 'number') or tokens[end - 2].is_name):
+        return parsed.text(start, end - 1), last.value
+    # Plain column reference: column, alias.column or "database"."view"."column"
+    if all(tokens[i].value == '.' if (i - start) % 2 else tokens[i].kind in ('word', 'identifier') for i in range(start, end)) and last.is_name:
+        return parsed.text(start, end), last.value
+    return parsed.text(start, end), None
+
+def _read_paging(parsed, scope, start):
+    """Reads the LIMIT/OFFSET/FETCH clauses from start to the end of the scope. Returns (limit, offset), or None if they can't be rewritten."""
+    tokens = parsed.tokens
+    end = scope.end
+    while end > start and tokens[end - 1].value == ';':
+        end -= 1
+
+    limit, offset = None, 0
+    i = start
+    while i < end:
+        keyword = tokens[i].upper
+        if keyword == 'LIMIT' and i + 1 < end and tokens[i + 1].kind == 'number' and tokens[i + 1].value.isdigit():
+            limit = int(tokens[i + 1].value)
+            i += 2
+        elif keyword == 'OFFSET' and i + 1 < end and tokens[i + 1].kind == 'number' and tokens[i + 1].value.isdigit():
+            offset = int(tokens[i + 1].value)
+            i += 2
+            if i < end and tokens[i].upper in ('ROW', 'ROWS'):
+                i += 1
+        elif keyword == 'FETCH' and i + 1 < end and tokens[i + 1].upper in ('FIRST', 'NEXT'):
+            i += 2
+            limit = 1
+            if i < end and tokens[i].kind == 'number' and tokens[i].value.isdigit():
+                limit = int(tokens[i].value)
+                i += 1
+            if i + 1 < end and tokens[i].upper in ('ROW', 'ROWS') and tokens[i + 1].upper == 'ONLY':
+                i += 2
+            else:
+                return None
+        else:
+            return None
+    return limit, offset
+
+def _rewrite_paging(parsed, scope):
+    """Rewrites the LIMIT/OFFSET/FETCH of a scope as a filter on ROW_NUMBER(). Returns the new VQL, or None if the rule doesn't apply."""
+    tokens = parsed.tokens
+    if any(keyword in scope.clauses for keyword in ('UNION', 'EXCEPT', 'INTERSECT', 'MINUS', 'CONTEXT', 'TRACE')):
+        return None
+    if len(scope.clauses.get('SELECT', [])) != 1 or 'FROM' not in scope.clauses:
+        return None
+
+    select_index = scope.clauses['SELECT'][0]
+    paging_start = min(index for keyword in ('LIMIT', 'OFFSET', 'FETCH') for index in scope.clauses.get(keyword, []))
+    paging = _read_paging(parsed, scope, paging_start)
+    if paging is None:
+        return None
+    limit, offset = paging
+    if limit is None and offset == 0:
+        return None
+
+    select_end = parsed.clause_end(scope, select_index)
+    if select_index + 1 < select_end and tokens[select_index + 1].upper in ('DISTINCT', 'ALL'):
+        return None
+    items = [_select_item(parsed, start, end) for start, end in _split_items(parsed, scope, select_index + 1, select_end)]
+    names = [name.strip('"').lower() for _, name in items if name is not None]
+    if not items or len(names) != len(items) or len(set(names)) != len(names):
+        return None
+
+    expressions = {name.strip('"').lower(): expression for expression, name in items}
+    order_indices = scope.clauses.get('ORDER', [])
+    if order_indices:
+        order_index = order_indices[0]
+        if order_index + 1 >= len(tokens) or tokens[order_index + 1].upper != 'BY' or order_index > paging_start:
+            return None
+        order_items = []
+        for start, end in _split_items(parsed, scope, order_index + 2, paging_start):
+            first = tokens[start]
+            rest = parsed.text(start + 1, end)
+            # The window can't see the select aliases or positions, so they are replaced by their expressions
+            if first.kind == 'number' and first.value.isdigit() and 0 < int(first.value) <= len(items):
+                order_items.append(f"{items[int(first.value) - 1][0]} {rest}".strip())
+            elif first.is_name and first.name.lower() in expressions and (start + 1 == end or tokens[start + 1].value != '.'):
+                order_items.append(f"{expressions[first.name.lower()]} {rest}".strip())
+            else:
+                order_items.append(parsed.text(start, end))
+        order_by = ', '.join(order_items)
+        body_end = order_index
+    elif scope.parent is not None:
+        # LIMIT without ORDER BY in a subquery returns any rows, so any order will do
+        order_by = items[0][0]
+        body_end = paging_start
+    else:
+        # Pages without an order are not deterministic, leave it to the LLM
+        return None
+
+    row_number = 'row_num'
+    while row_number in expressions:
+        row_number += '_'
+
+    prefix = parsed.text(scope.start, select_index) if select_index > scope.start else ''
+    inner_query = (
+        f"{parsed.text(select_index, select_end)}, ROW_NUMBER() OVER (ORDER BY {order_by}) AS {row_number} "
+        f"{parsed.text(select_end, body_end)}"
+    )
+    conditions = []
+    if offset:
+        conditions.append(f"{row_number} > {offset}")
+    if limit is not None:
+        conditions.append(f"{row_number} <= {offset + limit}")
+    columns = ', '.join(name for _, name in items)
+    new_query = f"SELECT {columns} FROM ({inner_query}) AS paged_rows WHERE {' AND '.join(conditions)}"
+    if scope.parent is None:
+        new_query += f" ORDER BY {row_number}"
+    if prefix:
+        new_query = f"{prefix} {new_query}"
+
+    start = tokens[scope.start].start
+    last = scope.end - 1
+    while last > scope.start and tokens[last].value == ';':
+        last -= 1
+    end = tokens[last].start + len(tokens[last].value)
+    return parsed.vql[:start] + new_query + parsed.vql[end:]